@@ -0,0 +1,129 @@
+# benchmark_embeddings.py
+# 임베딩 백엔드 비교 (PyTorch vs ONNX Runtime int8)
+# - 처리량: 초당 청크 수
+# - 검색 재현율: PyTorch 결과 상위 k개 중 ONNX 결과 상위 k개와 겹치는 비율 (recall@k)
+# - 자기 검색 재현율: 청크 첫 줄로 검색했을 때 원래 청크가 상위 k개에 드는 비율
+#
+# 사용 예:
+#   python benchmark_embeddings.py --pdf-dir pdfs --k 5 --threads 4 --batch-size 32
+
+import argparse
+import glob
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+import utils
+
+
+def load_chunks(pdf_dir, limit=None):
+    """PDF 폴더의 문서를 앱과 같은 방식으로 청크로 나눕니다."""
+    chunks = []
+    for pdf_path in sorted(glob.glob(os.path.join(pdf_dir, "*.pdf"))):
+        text = utils.pdf_to_text(pdf_path)
+        doc_chunks, _ = utils.chunk_text(text)
+        chunks.extend(doc_chunks)
+    return chunks[:limit] if limit else chunks
+
+
+def make_queries(chunks, count, seed=0):
+    """청크 첫 줄(제목 줄은 건너뜀)을 질의로 사용합니다. (질의, 원래 청크 번호) 목록"""
+    rng = random.Random(seed)
+    positions = rng.sample(range(len(chunks)), min(count, len(chunks)))
+    queries = []
+    for position in positions:
+        lines = [line for line in chunks[position].split("\n") if line.strip()]
+        query = lines[1] if len(lines) > 1 and lines[0].startswith("[") else lines[0]
+        queries.append((query[:100], position))
+    return queries
+
+
+def embed_with_timing(model, texts, repeats):
+    """가장 빠른 반복 시간 기준으로 처리량을 잽니다."""
+    model.embed_documents(texts[:4])  # 워밍업
+    best = None
+    vectors = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        vectors = model.embed_documents(texts)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return np.asarray(vectors, dtype=np.float32), best
+
+
+def top_k(doc_vectors, query_vectors, k):
+    """코사인 유사도 기준 상위 k개 청크 번호"""
+    doc_norm = doc_vectors / np.linalg.norm(doc_vectors, axis=1, keepdims=True)
+    query_norm = query_vectors / np.linalg.norm(query_vectors, axis=1, keepdims=True)
+    scores = query_norm @ doc_norm.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="임베딩 백엔드 처리량/재현율 비교")
+    parser.add_argument("--pdf-dir", default="pdfs")
+    parser.add_argument("--model", default=utils.EMBEDDING_MODEL_NAME)
+    parser.add_argument("--backends", default="torch,onnx")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=None, help="사용할 최대 청크 수")
+    parser.add_argument("--threads", type=int, default=utils.EMBEDDING_INTRA_OP_THREADS)
+    parser.add_argument("--batch-size", type=int, default=utils.EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--json", dest="json_path", default=None, help="결과를 JSON 파일로 저장")
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.pdf_dir, args.limit)
+    if not chunks:
+        print(f"청크가 없습니다: {args.pdf_dir}")
+        return
+    queries = make_queries(chunks, args.queries)
+    print(f"청크 {len(chunks)}개, 질의 {len(queries)}개, k={args.k}")
+
+    results = {}
+    rankings = {}
+    for backend in [name.strip() for name in args.backends.split(",") if name.strip()]:
+        load_start = time.perf_counter()
+        if backend == "onnx":
+            model = utils.OnnxEmbeddings(args.model, batch_size=args.batch_size, intra_op_threads=args.threads)
+        else:
+            model = utils.get_embedding_model(args.model, backend=backend)
+        load_seconds = time.perf_counter() - load_start
+
+        doc_vectors, seconds = embed_with_timing(model, chunks, args.repeats)
+        query_vectors = np.asarray(model.embed_documents([query for query, _ in queries]), dtype=np.float32)
+        ranking = top_k(doc_vectors, query_vectors, args.k)
+        rankings[backend] = ranking
+
+        self_recall = float(np.mean([position in row for row, (_, position) in zip(ranking, queries)]))
+        results[backend] = {
+            "load_seconds": round(load_seconds, 3),
+            "embed_seconds": round(seconds, 3),
+            "chunks_per_second": round(len(chunks) / seconds, 1),
+            f"self_recall@{args.k}": round(self_recall, 3)
+        }
+
+    # 기준 백엔드(첫 번째) 대비 상위 k개 겹침
+    baseline = next(iter(rankings), None)
+    for backend, ranking in rankings.items():
+        overlap = np.mean([
+            len(set(row) & set(base_row)) / args.k
+            for row, base_row in zip(ranking, rankings[baseline])
+        ])
+        results[backend][f"recall@{args.k}_vs_{baseline}"] = round(float(overlap), 3)
+
+    for backend, stats in results.items():
+        print(f"\n[{backend}]")
+        for key, value in stats.items():
+            print(f"  {key}: {value}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"chunks": len(chunks), "queries": len(queries), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
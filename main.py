@@ -15,7 +15,11 @@ from utils import (
     create_instructor_chatbot, generate_shareable_quiz_link,
     create_academy_dashboard, analyze_chapters, generate_study_notes,
     generate_cornell_notes_advanced, generate_cornell_notes_html_advanced,
-    text_to_speech, generate_premium_quiz, generate_share_link
+    text_to_speech, generate_premium_quiz, generate_share_link,
+    warm_up_embedding_model, get_embedding_stats, llm_response_cache,
+    create_chat_completion, semantic_answer_cache, get_single_flight_stats,
+    set_request_plan, llm_scheduler, get_token_usage_stats, question_bank,
+    refund_plan_limits, is_pdf_text_error, set_request_user
 )
 import os
 from dotenv import load_dotenv
@@ -45,6 +49,14 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# 임베딩 모델은 프로세스당 한 번만 로드 (리런 간 공유)
+@st.cache_resource(show_spinner="🧠 임베딩 모델을 준비하고 있습니다...")
+def load_embedding_model():
+    return warm_up_embedding_model()
+
+if os.getenv("EMBEDDING_WARMUP", "false").lower() in ("1", "true", "yes"):
+    load_embedding_model()
+
 # 플래시카드 관련 함수들
 def parse_flashcards(content):
     """플래시카드 내용을 파싱하는 함수"""
@@ -123,11 +135,9 @@ def save_flashcard_completion_history():
     except Exception as e:
         print(f"플래시카드 완료 이력 저장 오류: {e}")
 
-def generate_cornell_notes(text, note_style="standard"):
+def generate_cornell_notes(text, note_style="standard", stream=False):
     """코넬 노트 형식으로 내용을 정리하는 함수"""
     try:
-        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
         prompt = f"""
         다음 내용을 코넬 노트 필기법에 따라 정리해주세요. 반드시 아래 형식을 정확히 따라주세요:
 
@@ -156,17 +166,41 @@ def generate_cornell_notes(text, note_style="standard"):
         스타일: {note_style}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "cornell_notes",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=2000,
-            temperature=0.3
+            temperature=0.3,
+            stream=stream
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"코넬 노트 생성 실패: {str(e)}"
 
+def render_stream(result):
+    """스트리밍 응답을 받는 대로 화면에 출력하고 전체 텍스트를 반환하는 함수"""
+    if isinstance(result, str):
+        st.markdown(result)
+        return result
+    return st.write_stream(result)
+
+def reserve_quota(*features):
+    """기능을 실행하기 전에 플랜 한도를 확인하고 1회분을 차감하는 함수 (초과하면 안내 메시지 표시)"""
+    allowed, message = check_plan_limits(st.session_state.user_profile['username'], list(features), consume=True)
+    if not allowed:
+        st.error(message)
+    return allowed
+
+def refund_quota(*features):
+    """기능 실행이 실패했을 때 차감한 한도를 되돌리는 함수"""
+    refund_plan_limits(st.session_state.user_profile['username'], list(features))
+
+def require_stream(result):
+    """생성 함수가 스트림 대신 오류 메시지(문자열)를 반환하면 예외로 바꾸는 함수 (차감한 한도를 되돌리도록)"""
+    if isinstance(result, str):
+        raise RuntimeError(result)
+    return result
+
 def display_cornell_notes(notes_content):
     """코넬 노트를 시각적으로 표시하는 함수"""
     
@@ -567,6 +601,10 @@ if not st.session_state.logged_in:
 if st.session_state.user_profile:
     st.sidebar.markdown(f"### 👤 {st.session_state.user_profile['username']}님")
     st.sidebar.markdown(f"**플랜**: {st.session_state.user_profile['plan']}")
+    # 이번 실행에서 보내는 LLM 요청은 사용자 플랜의 우선순위로 처리
+    set_request_plan(st.session_state.user_profile.get('plan', 'free'))
+    # 백그라운드 생성 작업(문제 은행)의 API 호출은 이 사용자의 한도에서 차감
+    set_request_user(st.session_state.user_profile['username'])
 
     if st.sidebar.button("🚪 로그아웃"):
         st.session_state.user_profile = None
@@ -627,26 +665,30 @@ if menu == "💬 질의응답":
     else:
         user_question = st.text_area("💭 질문을 입력하세요:")
         
-        if st.button("🚀 질문하기") and user_question:
-            with st.spinner("🤖 AI가 답변을 생성하고 있습니다..."):
-                try:
+        if st.button("🚀 질문하기") and user_question and reserve_quota("api_calls"):
+            try:
+                with st.spinner("🤖 AI가 답변을 생성하고 있습니다..."):
                     pdf_path = os.path.join("pdfs", st.session_state.selected_documents[0])
                     text = pdf_to_text(pdf_path)
-                    answer = generate_direct_answer(text, user_question)
-                    st.markdown(f"**답변:** {answer}")
-                    
-                    # 학습 이력에 저장
-                    username = st.session_state.user_profile['username']
-                    save_user_study_history(username, user_question, answer, '질의응답')
-                    
-                    # 사용자 활동 업데이트
-                    update_user_activity(username, "question_asked", {
-                        'question': user_question[:100],
-                        'document': st.session_state.selected_documents[0]
-                    })
-                    
-                except Exception as e:
-                    st.error(f"오류: {str(e)}")
+                    answer_stream = require_stream(generate_direct_answer(text, user_question, stream=True))
+                
+                # 답변을 받는 대로 표시
+                st.markdown("**답변:**")
+                answer = render_stream(answer_stream)
+                
+                # 학습 이력에 저장
+                username = st.session_state.user_profile['username']
+                save_user_study_history(username, user_question, answer, '질의응답')
+                
+                # 사용자 활동 업데이트
+                update_user_activity(username, "question_asked", {
+                    'question': user_question[:100],
+                    'document': st.session_state.selected_documents[0]
+                })
+                
+            except Exception as e:
+                refund_quota("api_calls")
+                st.error(f"오류: {str(e)}")
 
 # 요약 기능
 elif menu == "📝 요약":
@@ -655,26 +697,30 @@ elif menu == "📝 요약":
     if not st.session_state.selected_documents:
         st.warning("📄 PDF 파일을 먼저 선택해주세요.")
     else:
-        if st.button("📝 요약 생성하기"):
-            with st.spinner("📝 AI가 요약을 생성하고 있습니다..."):
-                try:
+        if st.button("📝 요약 생성하기") and reserve_quota("api_calls"):
+            try:
+                with st.spinner("📝 AI가 요약을 생성하고 있습니다..."):
                     pdf_path = os.path.join("pdfs", st.session_state.selected_documents[0])
                     text = pdf_to_text(pdf_path)
-                    summary = summarize_text(text)
-                    st.markdown(f"**요약:**\n\n{summary}")
-                    
-                    # 학습 이력에 저장
-                    username = st.session_state.user_profile['username']
-                    save_user_study_history(username, f"'{st.session_state.selected_documents[0]}' 문서 요약 요청", summary, '요약')
-                    
-                    # 사용자 활동 업데이트
-                    update_user_activity(username, "summary_generated", {
-                        'document': st.session_state.selected_documents[0],
-                        'summary_length': len(summary)
-                    })
-                    
-                except Exception as e:
-                    st.error(f"오류: {str(e)}")
+                    summary_stream = require_stream(summarize_text(text, stream=True))
+                
+                # 요약을 받는 대로 표시
+                st.markdown("**요약:**")
+                summary = render_stream(summary_stream)
+                
+                # 학습 이력에 저장
+                username = st.session_state.user_profile['username']
+                save_user_study_history(username, f"'{st.session_state.selected_documents[0]}' 문서 요약 요청", summary, '요약')
+                
+                # 사용자 활동 업데이트
+                update_user_activity(username, "summary_generated", {
+                    'document': st.session_state.selected_documents[0],
+                    'summary_length': len(summary)
+                })
+                
+            except Exception as e:
+                refund_quota("api_calls")
+                st.error(f"오류: {str(e)}")
 
 # 퀴즈 기능
 elif menu == "🧩 퀴즈":
@@ -690,32 +736,50 @@ elif menu == "🧩 퀴즈":
         with col2:
             num_questions = st.slider("문제 수", 3, 10, 5)
         
-        if st.button("🎯 퀴즈 생성하기"):
-            with st.spinner("🧩 AI가 퀴즈를 생성하고 있습니다..."):
-                try:
-                    pdf_path = os.path.join("pdfs", st.session_state.selected_documents[0])
+        # 문제 은행은 퀴즈를 생성할 때 백그라운드로 준비됨 (이번 세션에서 퀴즈를 만든 문서만 상태 표시)
+        if 'question_bank_hashes' not in st.session_state:
+            st.session_state.question_bank_hashes = {}
+        document_name = st.session_state.selected_documents[0]
+        if document_name in st.session_state.question_bank_hashes:
+            bank_status = question_bank.status(st.session_state.question_bank_hashes[document_name])
+            if bank_status["building"]:
+                st.caption(f"📚 문제 은행 준비 중: {bank_status['questions']}문제 (섹션 {bank_status['sections_done']}/{bank_status['sections_total']})")
+            elif bank_status["questions"]:
+                st.caption(f"📚 문제 은행: {bank_status['questions']}문제 준비됨")
+        
+        if st.button("🎯 퀴즈 생성하기") and reserve_quota("quiz_generation", "api_calls"):
+            try:
+                with st.spinner("🧩 AI가 퀴즈를 생성하고 있습니다..."):
+                    pdf_path = os.path.join("pdfs", document_name)
                     text = pdf_to_text(pdf_path)
+                    if is_pdf_text_error(text):
+                        raise RuntimeError(text)
                     
+                    # 문제 은행에서 출제하고, 은행이 없거나 부족하면 백그라운드 생성을 시작
+                    st.session_state.question_bank_hashes[document_name] = question_bank.document_hash(text)
                     if quiz_type == "객관식":
-                        quiz_content = generate_quiz(text, num_questions)
+                        quiz_stream = require_stream(generate_quiz(text, num_questions, stream=True))
                     else:
-                        quiz_content = generate_short_answer_quiz(text, num_questions)
-                    
-                    st.markdown(f"**퀴즈:**\n\n{quiz_content}")
-                    
-                    # 학습 이력에 저장
-                    username = st.session_state.user_profile['username']
-                    save_user_study_history(username, f"{quiz_type} 퀴즈 {num_questions}문제 생성 요청", quiz_content, '퀴즈')
-                    
-                    # 사용자 활동 업데이트
-                    update_user_activity(username, "quiz_generated", {
-                        'quiz_type': quiz_type,
-                        'num_questions': num_questions,
-                        'document': st.session_state.selected_documents[0]
-                    })
-                    
-                except Exception as e:
-                    st.error(f"오류: {str(e)}")
+                        quiz_stream = require_stream(generate_short_answer_quiz(text, num_questions, stream=True))
+                
+                # 문제를 받는 대로 표시
+                st.markdown("**퀴즈:**")
+                quiz_content = render_stream(quiz_stream)
+                
+                # 학습 이력에 저장
+                username = st.session_state.user_profile['username']
+                save_user_study_history(username, f"{quiz_type} 퀴즈 {num_questions}문제 생성 요청", quiz_content, '퀴즈')
+                
+                # 사용자 활동 업데이트
+                update_user_activity(username, "quiz_generated", {
+                    'quiz_type': quiz_type,
+                    'num_questions': num_questions,
+                    'document': st.session_state.selected_documents[0]
+                })
+                
+            except Exception as e:
+                refund_quota("quiz_generation", "api_calls")
+                st.error(f"오류: {str(e)}")
 
 # 플래시카드 기능 (업그레이드 버전)
 elif menu == "🎴 플래시카드":
@@ -742,12 +806,15 @@ elif menu == "🎴 플래시카드":
             with col2:
                 card_type = st.selectbox("카드 유형", ["정의형", "문제형", "키워드형", "혼합형"])
             
-            if st.button("🎴 플래시카드 생성하기"):
+            if st.button("🎴 플래시카드 생성하기") and reserve_quota("flashcard_generation", "api_calls"):
                 with st.spinner("🎴 AI가 플래시카드를 생성하고 있습니다..."):
                     try:
                         pdf_path = os.path.join("pdfs", st.session_state.selected_documents[0])
                         text = pdf_to_text(pdf_path)
-                        flashcards_raw = generate_flashcards(text, num_cards)
+                        
+                        # 생성 중인 카드를 미리보기로 표시
+                        with st.expander("🎴 생성 중인 플래시카드", expanded=True):
+                            flashcards_raw = render_stream(require_stream(generate_flashcards(text, num_cards, stream=True)))
                         
                         # 플래시카드 내용을 세션에 저장
                         st.session_state.flashcards_content = flashcards_raw
@@ -776,6 +843,7 @@ elif menu == "🎴 플래시카드":
                         st.rerun()
                         
                     except Exception as e:
+                        refund_quota("flashcard_generation", "api_calls")
                         st.error(f"오류: {str(e)}")
         
         # 플래시카드가 생성된 경우 표시
@@ -826,12 +894,17 @@ elif menu == "📋 코넬 노트":
             - **요약 영역**: 전체 내용의 핵심 정리
             """)
         
-        if st.button("📋 코넬 노트 생성하기"):
+        if st.button("📋 코넬 노트 생성하기") and reserve_quota("api_calls"):
             with st.spinner("📋 AI가 코넬 노트를 생성하고 있습니다..."):
                 try:
                     pdf_path = os.path.join("pdfs", st.session_state.selected_documents[0])
                     text = pdf_to_text(pdf_path)
-                    cornell_notes = generate_cornell_notes(text, note_style)
+                    
+                    # 생성되는 내용을 먼저 보여주고, 완료되면 코넬 노트 양식으로 교체
+                    preview = st.empty()
+                    with preview.container():
+                        cornell_notes = render_stream(require_stream(generate_cornell_notes(text, note_style, stream=True)))
+                    preview.empty()
                     
                     # 코넬 노트 표시
                     display_cornell_notes(cornell_notes)
@@ -869,6 +942,7 @@ elif menu == "📋 코넬 노트":
                     })
                     
                 except Exception as e:
+                    refund_quota("api_calls")
                     st.error(f"오류: {str(e)}")
 
 # 학습 이력 기능
@@ -969,6 +1043,33 @@ elif menu == "👤 사용자 대시보드":
     
     except Exception as e:
         st.error(f"통계 로드 오류: {str(e)}")
+    
+    # 시스템 상태
+    with st.expander("⚙️ 시스템 상태"):
+        embedding_stats = get_embedding_stats()
+        if embedding_stats:
+            st.json(embedding_stats)
+        else:
+            st.write("아직 임베딩 모델이 로드되지 않았습니다.")
+        
+        st.markdown("**LLM 응답 캐시**")
+        st.json(llm_response_cache.stats())
+        st.json(get_single_flight_stats())
+        
+        st.markdown("**LLM 요청 스케줄러**")
+        st.json(llm_scheduler.stats())
+        
+        st.markdown("**LLM 토큰 사용량**")
+        st.json(get_token_usage_stats())
+        
+        st.markdown("**문제 은행**")
+        st.json(question_bank.stats())
+        
+        st.markdown("**질의응답 의미 캐시**")
+        st.json(semantic_answer_cache.stats())
+        
+        st.markdown("**문서 벡터스토어**")
+        st.json(vector_manager.get_document_stats())
 
 st.markdown("---")
 st.markdown("### 🚀 수익화 기능")
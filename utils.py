@@ -2,19 +2,778 @@
 # PDF 업로드 → 텍스트 추출
 from PyPDF2 import PdfReader
 import os
+import atexit
+import contextvars
 import glob
+import hashlib
+import itertools
+import json
+import math
+import pickle
+import random
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from typing import Optional
 import openai
 from dotenv import load_dotenv
 
 # 환경 변수 로드
 load_dotenv()
 
+# OpenAI 연결 설정 (환경 변수로 변경 가능)
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+OPENAI_CONNECT_TIMEOUT_SECONDS = float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "10"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+
+_openai_http_client = None
+_openai_clients = {}
+_openai_client_lock = threading.Lock()
+
+def get_openai_timeout():
+    """요청 전체 제한 시간과 별도의 연결 제한 시간"""
+    import httpx
+    return httpx.Timeout(OPENAI_TIMEOUT_SECONDS, connect=OPENAI_CONNECT_TIMEOUT_SECONDS)
+
+def get_openai_http_client():
+    """keep-alive 연결 풀을 가진 공유 HTTP 클라이언트를 반환합니다."""
+    global _openai_http_client
+    with _openai_client_lock:
+        if _openai_http_client is None:
+            import httpx
+            _openai_http_client = openai.DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_CONNECTIONS,
+                    keepalive_expiry=60
+                ),
+                timeout=get_openai_timeout()
+            )
+        return _openai_http_client
+
 def get_openai_client():
-    """OpenAI 클라이언트를 안전하게 생성하는 함수"""
+    """OpenAI 클라이언트를 안전하게 생성하는 함수 (프로세스 전체에서 하나의 연결 풀 공유)"""
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OPENAI API 키가 설정되지 않았습니다. .env 파일을 확인해주세요.")
-    return openai.OpenAI(api_key=api_key)
+    
+    http_client = get_openai_http_client()
+    with _openai_client_lock:
+        if api_key not in _openai_clients:
+            # 스케줄러를 거치는 요청은 _create_with_backoff에서 재시도하고 SDK 재시도는 끔
+            _openai_clients[api_key] = openai.OpenAI(
+                api_key=api_key,
+                http_client=http_client,
+                # float를 넘기면 http_client의 연결 제한 시간을 덮어쓰므로 같은 Timeout 객체를 사용
+                timeout=get_openai_timeout(),
+                max_retries=OPENAI_MAX_RETRIES
+            )
+        return _openai_clients[api_key]
+
+# 📦 LLM 응답 캐시 (모델, 프롬프트, temperature, max_tokens 지문 기준)
+LLM_CACHE_PATH = os.path.join("cache", "llm_cache.sqlite3")
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "5000"))
+# 캐시를 사용할 기능 목록 ("*"이면 전체 기능)
+LLM_CACHE_FEATURES = set(filter(None, os.getenv(
+    "LLM_CACHE_FEATURES",
+    "summary,document_summary,detailed_summary,concept_map,chapters,study_notes,cornell_notes,cornell_notes_advanced"
+).split(",")))
+
+class LLMResponseCache:
+    """SQLite 기반 LLM 응답 캐시 (TTL 만료 + 최근 사용 기준 LRU 정리)"""
+    
+    def __init__(self, path=LLM_CACHE_PATH, ttl_seconds=LLM_CACHE_TTL_SECONDS, max_entries=LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+    
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    feature TEXT,
+                    response TEXT,
+                    created_at REAL,
+                    last_access REAL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)")
+            self._conn.commit()
+        return self._conn
+    
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens, response_format=None):
+        """요청 파라미터로 캐시 키(지문)를 만듭니다."""
+        params = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        if response_format is not None:
+            params["response_format"] = response_format
+        fingerprint = json.dumps(params, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                    conn.commit()
+                self.misses += 1
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+    
+    def set(self, key, feature, response):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, feature, response, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, feature, response, now, now)
+            )
+            # 최대 개수를 넘으면 가장 오래 사용하지 않은 항목부터 삭제
+            count = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            conn.commit()
+    
+    def invalidate(self, feature=None):
+        """캐시를 비웁니다. feature를 지정하면 해당 기능만 비웁니다."""
+        with self._lock:
+            conn = self._connection()
+            if feature:
+                conn.execute("DELETE FROM llm_cache WHERE feature = ?", (feature,))
+            else:
+                conn.execute("DELETE FROM llm_cache")
+            conn.commit()
+    
+    def stats(self):
+        with self._lock:
+            entries = self._connection().execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+llm_response_cache = LLMResponseCache()
+
+def is_llm_cache_enabled(feature):
+    """기능별 응답 캐시 사용 여부"""
+    return "*" in LLM_CACHE_FEATURES or feature in LLM_CACHE_FEATURES
+
+# 📦 LLM 요청 스케줄러 (플랜별 우선순위 + 동시 요청 수 + 분당 토큰 예산 + 429 대기)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "200000"))
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "3"))
+LLM_PRIORITY_AGING_SECONDS = float(os.getenv("LLM_PRIORITY_AGING_SECONDS", "30"))
+# 숫자가 작을수록 먼저 처리
+LLM_PLAN_PRIORITIES = {"instructor": 0, "premium": 1, "free": 2}
+
+# 현재 요청을 보낸 사용자의 플랜 (Streamlit 세션 스레드마다 따로 유지)
+_current_plan = contextvars.ContextVar("llm_request_plan", default="free")
+
+def set_request_plan(plan):
+    """이후 이 스레드(컨텍스트)에서 보내는 LLM 요청의 우선순위 플랜을 지정합니다."""
+    _current_plan.set(plan if plan in LLM_PLAN_PRIORITIES else "free")
+
+def get_request_plan():
+    return _current_plan.get()
+
+# 현재 요청을 보낸 사용자 (백그라운드 생성 작업의 API 호출을 이 사용자의 한도에서 차감)
+_current_user = contextvars.ContextVar("llm_request_user", default=None)
+
+def set_request_user(username):
+    """이후 이 스레드(컨텍스트)에서 시작하는 백그라운드 LLM 작업을 차감할 사용자를 지정합니다."""
+    _current_user.set(username)
+
+def get_request_user():
+    return _current_user.get()
+
+class LLMScheduler:
+    """프로세스 전체의 LLM 요청 순서를 정하는 스케줄러
+    - 동시에 진행되는 요청은 max_concurrency개까지
+    - 최근 60초 동안 사용한 토큰이 tokens_per_minute를 넘지 않도록 대기
+    - 대기 중에는 플랜 우선순위(강사 > 프리미엄 > 무료) 순, 같은 플랜은 먼저 온 순서
+      (오래 기다린 요청은 aging_seconds마다 한 단계씩 올려서 무한 대기를 막음)
+    - 429 응답을 받으면 모든 요청을 잠시 멈춤
+    """
+    
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+                 aging_seconds=LLM_PRIORITY_AGING_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.aging_seconds = aging_seconds
+        self._condition = threading.Condition()
+        self._waiting = []  # [우선순위, 순번, 대기 시작 시각, 플랜]
+        self._sequence = itertools.count()
+        self._active = 0
+        self._window = deque()  # [시작 시각, 토큰 수]
+        self._cooldown_until = 0.0
+        self._rate_limited = 0
+        self._lane_stats = {
+            plan: {"requests": 0, "total_wait": 0.0, "waits": deque(maxlen=200)}
+            for plan in LLM_PLAN_PRIORITIES
+        }
+    
+    def _window_tokens(self, now):
+        while self._window and now - self._window[0][0] > 60:
+            self._window.popleft()
+        return sum(entry[1] for entry in self._window)
+    
+    def _effective_priority(self, entry, now):
+        priority, sequence, enqueued, _ = entry
+        if self.aging_seconds > 0:
+            priority -= int((now - enqueued) / self.aging_seconds)
+        return (priority, sequence)
+    
+    def acquire(self, plan, estimated_tokens):
+        """실행 차례가 올 때까지 기다린 뒤 티켓을 반환합니다."""
+        plan = plan if plan in LLM_PLAN_PRIORITIES else "free"
+        entry = [LLM_PLAN_PRIORITIES[plan], next(self._sequence), time.time(), plan]
+        with self._condition:
+            self._waiting.append(entry)
+            while True:
+                now = time.time()
+                used = self._window_tokens(now)
+                head = min(self._waiting, key=lambda item: self._effective_priority(item, now))
+                budget_ok = used + estimated_tokens <= self.tokens_per_minute or not self._window
+                if head is entry and self._active < self.max_concurrency and now >= self._cooldown_until and budget_ok:
+                    self._waiting.remove(entry)
+                    self._active += 1
+                    window_entry = [now, estimated_tokens]
+                    self._window.append(window_entry)
+                    
+                    waited = now - entry[2]
+                    lane = self._lane_stats[plan]
+                    lane["requests"] += 1
+                    lane["total_wait"] += waited
+                    lane["waits"].append(waited)
+                    self._condition.notify_all()
+                    return window_entry
+                
+                # 시간이 지나야 풀리는 조건(쿨다운, 토큰 창)은 그 시각까지만 기다림
+                timeout = None
+                if now < self._cooldown_until:
+                    timeout = self._cooldown_until - now
+                elif not budget_ok:
+                    timeout = max(self._window[0][0] + 60 - now, 0.05)
+                if self.aging_seconds > 0 and len(self._waiting) > 1:
+                    timeout = min(timeout or self.aging_seconds, self.aging_seconds)
+                self._condition.wait(timeout)
+    
+    def release(self, ticket, actual_tokens=None):
+        """요청이 끝나면 자리를 반납하고, 실제 사용 토큰으로 예산을 보정합니다."""
+        with self._condition:
+            if actual_tokens is not None:
+                ticket[1] = actual_tokens
+            self._active -= 1
+            self._condition.notify_all()
+    
+    def note_rate_limit(self, retry_after):
+        """429를 받으면 retry_after초 동안 새 요청을 보내지 않음"""
+        with self._condition:
+            self._rate_limited += 1
+            self._cooldown_until = max(self._cooldown_until, time.time() + retry_after)
+            self._condition.notify_all()
+    
+    def stats(self):
+        with self._condition:
+            now = time.time()
+            lanes = {}
+            for plan, lane in self._lane_stats.items():
+                waits = sorted(lane["waits"])
+                lanes[plan] = {
+                    "queued": sum(1 for entry in self._waiting if entry[3] == plan),
+                    "requests": lane["requests"],
+                    "avg_wait_ms": round(lane["total_wait"] / lane["requests"] * 1000, 1) if lane["requests"] else 0.0,
+                    "p95_wait_ms": round(waits[int(len(waits) * 0.95) - 1 if len(waits) > 1 else 0] * 1000, 1) if waits else 0.0
+                }
+            return {
+                "active": self._active,
+                "max_concurrency": self.max_concurrency,
+                "tokens_last_minute": self._window_tokens(now),
+                "tokens_per_minute": self.tokens_per_minute,
+                "cooldown_seconds": round(max(self._cooldown_until - now, 0), 1),
+                "rate_limited": self._rate_limited,
+                "lanes": lanes
+            }
+
+llm_scheduler = LLMScheduler()
+
+def _retry_after_seconds(error, attempt):
+    """429 응답의 retry-after 헤더(없으면 지수 백오프 + 지터)"""
+    try:
+        header = error.response.headers.get("retry-after")
+        if header:
+            return float(header)
+    except Exception:
+        pass
+    return min(2 ** attempt, 30) + random.uniform(0, 1)
+
+def _create_with_backoff(client, plan, estimated_tokens, **request):
+    """스케줄러 자리를 받아 요청을 보내고 (응답, 티켓)을 반환 (티켓은 요청이 끝나면 호출자가 반납)
+    - SDK 자체 재시도는 끄고(max_retries=0) 재시도를 여기서만 처리
+    - 429(요청 한도 초과)는 전체 스케줄러를 멈추고 기다렸다가 다시 보냄
+    - 연결 오류/서버 오류는 이 요청만 지수 백오프로 다시 보냄
+    - 다시 보내기 전에 기다리는 동안은 자리를 반납하고, 같은 플랜 우선순위로 다시 자리를 받음
+      (재시도를 기다리는 요청이 자리를 차지해서 우선순위가 높은 요청이 막히지 않도록)
+    """
+    client = client.with_options(max_retries=0)
+    rate_limit_attempts = 0
+    transient_attempts = 0
+    while True:
+        ticket = llm_scheduler.acquire(plan, estimated_tokens)
+        try:
+            return client.chat.completions.create(**request), ticket
+        except openai.RateLimitError as e:
+            # 거절된 요청은 토큰을 쓰지 않았으므로 예산에서 뺌
+            llm_scheduler.release(ticket, 0)
+            if rate_limit_attempts >= LLM_RATE_LIMIT_RETRIES:
+                raise
+            delay = _retry_after_seconds(e, rate_limit_attempts)
+            rate_limit_attempts += 1
+            # 쿨다운이 끝날 때까지 다음 acquire에서 기다림
+            llm_scheduler.note_rate_limit(delay)
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            llm_scheduler.release(ticket, 0)
+            if transient_attempts >= OPENAI_MAX_RETRIES:
+                raise
+            delay = _retry_after_seconds(e, transient_attempts)
+            transient_attempts += 1
+            time.sleep(delay)
+        except BaseException:
+            llm_scheduler.release(ticket)
+            raise
+
+def _estimate_request_tokens(messages, max_tokens, model="gpt-4o-mini"):
+    return count_message_tokens(messages, model) + (max_tokens or 1000)
+
+# 📦 동일 요청 합치기 (single-flight: 같은 지문의 요청이 진행 중이면 그 결과를 함께 받음)
+class _InFlightCall:
+    """진행 중인 요청 하나의 결과 조각을 여러 호출자에게 나눠 주는 객체"""
+    
+    def __init__(self, key):
+        self.key = key
+        self.parts = []
+        self.done = False
+        self.error = None
+        self._condition = threading.Condition()
+    
+    def publish(self, part):
+        with self._condition:
+            self.parts.append(part)
+            self._condition.notify_all()
+    
+    def finish(self, error=None):
+        """요청을 끝냄 (여러 번 불려도 처음 한 번만 반영)"""
+        with self._condition:
+            if self.done:
+                return
+        with _inflight_lock:
+            if _inflight_calls.get(self.key) is self:
+                del _inflight_calls[self.key]
+        with self._condition:
+            if self.done:
+                return
+            self.error = error
+            self.done = True
+            self._condition.notify_all()
+    
+    def iter_parts(self):
+        """지금까지 받은 조각부터 끝날 때까지 차례로 내보냄"""
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self.parts) and not self.done:
+                    self._condition.wait()
+                if index < len(self.parts):
+                    part = self.parts[index]
+                    index += 1
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            yield part
+    
+    def result(self):
+        return "".join(self.iter_parts())
+
+_inflight_calls = {}
+_inflight_lock = threading.Lock()
+_single_flight_stats = {"leaders": 0, "followers": 0}
+
+def _join_inflight_call(key):
+    """(요청 객체, 직접 요청해야 하는지) 반환"""
+    with _inflight_lock:
+        call = _inflight_calls.get(key)
+        if call is not None:
+            _single_flight_stats["followers"] += 1
+            return call, False
+        call = _InFlightCall(key)
+        _inflight_calls[key] = call
+        _single_flight_stats["leaders"] += 1
+        return call, True
+
+def get_single_flight_stats():
+    """직접 보낸 요청 수, 진행 중인 요청에 합쳐진 호출 수, 현재 진행 중인 요청 수"""
+    with _inflight_lock:
+        return {**_single_flight_stats, "in_flight": len(_inflight_calls)}
+
+def create_chat_completion(feature, messages, model="gpt-4o-mini", max_tokens=None, temperature=None, stream=False, response_format=None):
+    """채팅 완성 요청을 보내고 응답 텍스트를 반환합니다. 캐시가 켜진 기능은 같은 요청에 저장된 응답을 돌려줍니다.
+    같은 요청이 이미 진행 중이면 새로 보내지 않고 그 응답을 함께 받습니다.
+    - stream: True이면 응답 텍스트 조각을 도착하는 대로 내보내는 이터레이터를 반환
+    - response_format: 예) {"type": "json_object"} (JSON 형식 응답 강제)
+    """
+    use_cache = is_llm_cache_enabled(feature)
+    request_key = LLMResponseCache.make_key(model, messages, temperature, max_tokens, response_format)
+    cache_key = request_key if use_cache else None
+    if use_cache:
+        try:
+            cached = llm_response_cache.get(cache_key)
+            if cached is not None:
+                return iter([cached]) if stream else cached
+        except Exception as e:
+            print(f"LLM 캐시 조회 오류: {e}")
+    
+    call, is_leader = _join_inflight_call(request_key)
+    if not is_leader:
+        return call.iter_parts() if stream else call.result()
+    
+    try:
+        client = get_openai_client()
+        request = dict(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=stream)
+        if stream:
+            # 마지막 조각에 실제 사용 토큰이 담겨 오도록 요청
+            request["stream_options"] = {"include_usage": True}
+        if response_format is not None:
+            request["response_format"] = response_format
+        response, ticket = _create_with_backoff(
+            client, get_request_plan(), _estimate_request_tokens(messages, max_tokens, model), **request
+        )
+    except Exception as e:
+        call.finish(error=e)
+        raise
+    
+    def on_done(content, usage=None):
+        # 사용량 기록이 실패해도 스케줄러 자리는 반드시 반납
+        used_tokens = None
+        try:
+            used_tokens = record_token_usage(feature, model, messages, content, usage)["total_tokens"]
+        except Exception as e:
+            print(f"토큰 사용량 기록 오류: {e}")
+        finally:
+            llm_scheduler.release(ticket, used_tokens)
+    
+    if stream:
+        state = {"started": False}
+        iterator = _iter_stream_content(response, feature, cache_key, call, on_done, state)
+        # 한 번도 읽지 않고 버려진 스트림도 끝까지 받아서 자리와 대기 호출자를 정리
+        weakref.finalize(iterator, _on_stream_dropped, response, call, feature, cache_key, on_done, state)
+        return iterator
+    # 함께 기다리는 호출자가 멈추지 않도록 어떤 경우에도 요청을 끝냄
+    content = None
+    try:
+        content = response.choices[0].message.content
+        if content:
+            call.publish(content)
+        call.finish()
+    except Exception as e:
+        call.finish(error=e)
+        raise
+    finally:
+        on_done(content or "", getattr(response, "usage", None))
+    
+    if use_cache and content:
+        try:
+            llm_response_cache.set(cache_key, feature, content)
+        except Exception as e:
+            print(f"LLM 캐시 저장 오류: {e}")
+    return content
+
+def _drain_stream(response, call, parts, feature, cache_key, on_done=None):
+    """호출자가 중간에 읽기를 멈춘 스트림을 끝까지 받아 함께 기다리는 호출자에게 전달합니다."""
+    usage = None
+    try:
+        for chunk in response:
+            usage = getattr(chunk, "usage", None) or usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                call.publish(chunk.choices[0].delta.content)
+        call.finish()
+    except Exception as e:
+        call.finish(error=e)
+        return
+    finally:
+        if on_done is not None:
+            on_done("".join(parts), usage)
+    
+    if cache_key and parts:
+        try:
+            llm_response_cache.set(cache_key, feature, "".join(parts))
+        except Exception as e:
+            print(f"LLM 캐시 저장 오류: {e}")
+
+def _on_stream_dropped(response, call, feature, cache_key, on_done, state):
+    if state["started"]:
+        return
+    try:
+        threading.Thread(target=_drain_stream, args=(response, call, [], feature, cache_key, on_done), daemon=True).start()
+    except Exception as e:
+        call.finish(error=e)
+        on_done("", None)
+
+def _iter_stream_content(response, feature, cache_key=None, call=None, on_done=None, state=None):
+    """스트리밍 응답의 텍스트 조각을 내보내고, 끝까지 받으면 전체 응답을 캐시에 저장합니다."""
+    if state is not None:
+        state["started"] = True
+    parts = []
+    usage = None
+    handed_off = False
+    try:
+        for chunk in response:
+            usage = getattr(chunk, "usage", None) or usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                if call is not None:
+                    call.publish(delta)
+                yield delta
+        if call is not None:
+            call.finish()
+    except GeneratorExit:
+        # 화면 갱신 등으로 읽기가 중단되어도 같은 요청을 기다리는 호출자는 끝까지 받도록 함
+        if call is not None:
+            try:
+                threading.Thread(target=_drain_stream, args=(response, call, parts, feature, cache_key, on_done), daemon=True).start()
+                handed_off = True
+            except Exception as e:
+                call.finish(error=e)
+        raise
+    except Exception as e:
+        if call is not None:
+            call.finish(error=e)
+        raise
+    finally:
+        if on_done is not None and not handed_off:
+            on_done("".join(parts), usage)
+    
+    if cache_key and parts:
+        try:
+            llm_response_cache.set(cache_key, feature, "".join(parts))
+        except Exception as e:
+            print(f"LLM 캐시 저장 오류: {e}")
+
+# 📦 의미 기반 답변 캐시 (문서 해시 + 질문 임베딩 코사인 유사도)
+SEMANTIC_CACHE_PATH = os.path.join("cache", "semantic_answers.sqlite3")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+SEMANTIC_CACHE_MAX_PER_DOCUMENT = int(os.getenv("SEMANTIC_CACHE_MAX_PER_DOCUMENT", "500"))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+# 만료된 행을 SQLite에서 지우는 주기
+SEMANTIC_CACHE_PURGE_INTERVAL_SECONDS = int(os.getenv("SEMANTIC_CACHE_PURGE_INTERVAL_SECONDS", "3600"))
+
+class SemanticAnswerCache:
+    """같은 문서에 대한 비슷한 질문의 답변을 재사용하는 캐시
+    - 문서별로 질문 임베딩(정규화)을 메모리 행렬로 두고 코사인 유사도가 threshold 이상이면 저장된 답변 반환
+    - 내용은 SQLite에 저장해서 프로세스를 다시 시작해도 유지
+    - ttl_seconds가 지난 항목은 조회/저장 때 메모리에서 빼고, SQLite에서는 주기적으로 삭제
+    """
+    
+    def __init__(self, path=SEMANTIC_CACHE_PATH, threshold=SEMANTIC_CACHE_THRESHOLD,
+                 max_per_document=SEMANTIC_CACHE_MAX_PER_DOCUMENT, ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS):
+        self.path = path
+        self.threshold = threshold
+        self.max_per_document = max_per_document
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._documents = {}  # 문서 해시 → (행 id 목록, 임베딩 행렬, 답변 목록, 저장 시각 목록)
+        self._last_purge = 0.0
+        self._lock = threading.Lock()
+    
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS semantic_answers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    document_hash TEXT,
+                    question TEXT,
+                    embedding BLOB,
+                    answer TEXT,
+                    created_at REAL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_semantic_answers_document ON semantic_answers(document_hash)")
+            self._conn.commit()
+        return self._conn
+    
+    @staticmethod
+    def document_hash(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+    
+    @staticmethod
+    def _normalize(embedding):
+        import numpy as np
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+    
+    def _load_document(self, document_hash):
+        """문서의 저장된 질문 임베딩을 메모리에 올림 (잠금 안에서 호출)"""
+        import numpy as np
+        if document_hash in self._documents:
+            return self._documents[document_hash]
+        
+        cutoff = time.time() - self.ttl_seconds
+        rows = self._connection().execute(
+            "SELECT id, embedding, answer, created_at FROM semantic_answers WHERE document_hash = ? AND created_at >= ? ORDER BY id",
+            (document_hash, cutoff)
+        ).fetchall()
+        ids = [row[0] for row in rows]
+        matrix = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows]) if rows else None
+        answers = [row[2] for row in rows]
+        created = [row[3] for row in rows]
+        self._documents[document_hash] = (ids, matrix, answers, created)
+        return self._documents[document_hash]
+    
+    def _expire(self, document_hash):
+        """만료된 항목을 메모리에서 빼고, 주기가 되면 SQLite의 만료 행도 삭제 (잠금 안에서 호출)"""
+        now = time.time()
+        cutoff = now - self.ttl_seconds
+        if now - self._last_purge >= SEMANTIC_CACHE_PURGE_INTERVAL_SECONDS:
+            self._last_purge = now
+            conn = self._connection()
+            conn.execute("DELETE FROM semantic_answers WHERE created_at < ?", (cutoff,))
+            conn.commit()
+            # 다른 문서의 만료 항목도 메모리에서 정리
+            for other in list(self._documents):
+                if other != document_hash:
+                    self._drop_expired(other, cutoff)
+        return self._drop_expired(document_hash, cutoff)
+    
+    def _drop_expired(self, document_hash, cutoff):
+        ids, matrix, answers, created = self._load_document(document_hash)
+        keep = [i for i, created_at in enumerate(created) if created_at >= cutoff]
+        if len(keep) < len(ids):
+            if not keep:
+                self._documents.pop(document_hash, None)
+                return [], None, [], []
+            ids = [ids[i] for i in keep]
+            matrix = matrix[keep]
+            answers = [answers[i] for i in keep]
+            created = [created[i] for i in keep]
+            self._documents[document_hash] = (ids, matrix, answers, created)
+        return ids, matrix, answers, created
+    
+    def lookup(self, document_hash, question_embedding):
+        """가장 비슷한 질문의 답변과 유사도를 반환 (기준 미달이면 None)"""
+        vector = self._normalize(question_embedding)
+        with self._lock:
+            _, matrix, answers, _ = self._expire(document_hash)
+            if matrix is not None and matrix.shape[1] == vector.shape[0]:
+                similarities = matrix @ vector
+                best = int(similarities.argmax())
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    return answers[best], float(similarities[best])
+            self.misses += 1
+            return None
+    
+    def store(self, document_hash, question, question_embedding, answer):
+        import numpy as np
+        vector = self._normalize(question_embedding)
+        with self._lock:
+            ids, matrix, answers, created = self._expire(document_hash)
+            conn = self._connection()
+            created_at = time.time()
+            cursor = conn.execute(
+                "INSERT INTO semantic_answers (document_hash, question, embedding, answer, created_at) VALUES (?, ?, ?, ?, ?)",
+                (document_hash, question, vector.tobytes(), answer, created_at)
+            )
+            ids = ids + [cursor.lastrowid]
+            matrix = vector[None, :] if matrix is None else np.vstack([matrix, vector])
+            answers = answers + [answer]
+            created = created + [created_at]
+            
+            # 문서별 최대 개수를 넘으면 오래된 항목부터 삭제
+            overflow = len(ids) - self.max_per_document
+            if overflow > 0:
+                conn.executemany("DELETE FROM semantic_answers WHERE id = ?", [(row_id,) for row_id in ids[:overflow]])
+                ids, matrix, answers, created = ids[overflow:], matrix[overflow:], answers[overflow:], created[overflow:]
+            conn.commit()
+            self._documents[document_hash] = (ids, matrix, answers, created)
+    
+    def invalidate(self, document_hash=None):
+        """문서 하나(또는 전체)의 저장된 답변을 지웁니다."""
+        with self._lock:
+            conn = self._connection()
+            if document_hash:
+                conn.execute("DELETE FROM semantic_answers WHERE document_hash = ?", (document_hash,))
+                self._documents.pop(document_hash, None)
+            else:
+                conn.execute("DELETE FROM semantic_answers")
+                self._documents.clear()
+            conn.commit()
+    
+    def stats(self):
+        with self._lock:
+            entries = self._connection().execute("SELECT COUNT(*) FROM semantic_answers").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "entries": entries,
+                "documents_loaded": len(self._documents),
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+semantic_answer_cache = SemanticAnswerCache()
+
+def _iter_and_store_answer(chunks, document_hash, question, question_embedding):
+    """스트리밍 답변을 내보내고, 끝까지 받으면 의미 캐시에 저장합니다."""
+    parts = []
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    if parts:
+        try:
+            semantic_answer_cache.store(document_hash, question, question_embedding, "".join(parts))
+        except Exception as e:
+            print(f"의미 캐시 저장 오류: {e}")
 
 def get_pdf_list(folder_path="pdfs"):
     """지정된 폴더에서 PDF 파일 목록을 가져옵니다."""
@@ -40,25 +799,188 @@ def get_pdf_list(folder_path="pdfs"):
         print(f"PDF 목록 가져오기 오류: {e}")
         return []
 
+# 📦 PDF 텍스트 추출 캐시 (파일 내용 해시 기반)
+PDF_TEXT_CACHE_DIR = os.path.join("cache", "pdf_text")
+PDF_PAGE_SEPARATOR = "\f"  # 페이지 경계 (form feed)
+
+# 메모리에 둘 최대 개수 (넘으면 가장 오래 쓰지 않은 것부터 내림)
+PDF_TEXT_MEMORY_DOCS = int(os.getenv("PDF_TEXT_MEMORY_DOCS", "32"))
+PDF_HASH_MEMO_SIZE = 1024
+
+_pdf_text_memory_cache = OrderedDict()  # 파일 해시 → 페이지별 텍스트 (튜플, 최근 사용 순)
+_pdf_hash_memo = OrderedDict()  # (경로, 크기, 수정시각) → 파일 해시 (최근 사용 순)
+_pdf_cache_lock = threading.Lock()
+
+def _lru_get(cache, key):
+    """LRU 캐시에서 값을 찾고 최근 사용으로 표시 (잠금 안에서 호출)"""
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def _lru_put(cache, key, value, max_size):
+    """LRU 캐시에 저장하고 max_size를 넘으면 오래된 것부터 내림 (잠금 안에서 호출)"""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > max_size:
+        cache.popitem(last=False)
+
+def get_file_hash(file_path_or_uploaded):
+    """파일 내용의 SHA-256 해시를 반환합니다."""
+    if isinstance(file_path_or_uploaded, str):
+        # 크기와 수정시각이 같으면 다시 해시하지 않음
+        stat = os.stat(file_path_or_uploaded)
+        memo_key = (os.path.abspath(file_path_or_uploaded), stat.st_size, stat.st_mtime_ns)
+        with _pdf_cache_lock:
+            file_hash = _lru_get(_pdf_hash_memo, memo_key)
+        if file_hash is not None:
+            return file_hash
+        
+        digest = hashlib.sha256()
+        with open(file_path_or_uploaded, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(block)
+        file_hash = digest.hexdigest()
+        with _pdf_cache_lock:
+            _lru_put(_pdf_hash_memo, memo_key, file_hash, PDF_HASH_MEMO_SIZE)
+        return file_hash
+    
+    # 업로드된 파일인 경우 (읽기 위치는 그대로 유지)
+    if hasattr(file_path_or_uploaded, 'getvalue'):
+        data = file_path_or_uploaded.getvalue()
+    else:
+        position = file_path_or_uploaded.tell()
+        data = file_path_or_uploaded.read()
+        file_path_or_uploaded.seek(position)
+    return hashlib.sha256(data).hexdigest()
+
+def _load_cached_pdf_pages(file_hash):
+    """메모리 → 디스크 순서로 캐시된 페이지 텍스트를 찾습니다. (호출자가 고쳐도 캐시는 바뀌지 않도록 새 목록으로 반환)"""
+    with _pdf_cache_lock:
+        pages = _lru_get(_pdf_text_memory_cache, file_hash)
+    if pages is not None:
+        return list(pages)
+    
+    cache_file = os.path.join(PDF_TEXT_CACHE_DIR, f"{file_hash}.json")
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            pages = json.load(f)["pages"]
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+    
+    with _pdf_cache_lock:
+        _lru_put(_pdf_text_memory_cache, file_hash, tuple(pages), PDF_TEXT_MEMORY_DOCS)
+    return pages
+
+def _save_cached_pdf_pages(file_hash, pages, source=None, page_seconds=None):
+    """추출한 페이지 텍스트를 메모리와 디스크에 저장합니다."""
+    with _pdf_cache_lock:
+        _lru_put(_pdf_text_memory_cache, file_hash, tuple(pages), PDF_TEXT_MEMORY_DOCS)
+    
+    try:
+        os.makedirs(PDF_TEXT_CACHE_DIR, exist_ok=True)
+        cache_file = os.path.join(PDF_TEXT_CACHE_DIR, f"{file_hash}.json")
+        tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                "source": source,
+                "page_count": len(pages),
+                "page_seconds": page_seconds,
+                "pages": pages
+            }, f, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        print(f"PDF 텍스트 캐시 저장 오류: {e}")
+
+# 페이지 병렬 추출 설정 (페이지 수가 많을 때만 프로세스 풀 사용)
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "40"))
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+
+_pdf_process_pool = None
+
+def _get_pdf_process_pool():
+    """페이지 추출용 프로세스 풀을 한 번만 만들어 재사용합니다."""
+    global _pdf_process_pool
+    with _pdf_cache_lock:
+        if _pdf_process_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            _pdf_process_pool = ProcessPoolExecutor(max_workers=PDF_EXTRACT_WORKERS)
+        return _pdf_process_pool
+
+def _extract_page_range(source, start, end):
+    """지정한 페이지 범위의 텍스트와 페이지별 소요 시간을 추출합니다. (프로세스 풀 작업)"""
+    import io
+    pdf = PdfReader(source if isinstance(source, str) else io.BytesIO(source))
+    results = []
+    for index in range(start, end):
+        page_start = time.perf_counter()
+        results.append((pdf.pages[index].extract_text() or "", time.perf_counter() - page_start))
+    return results
+
+def extract_pdf_pages_with_timings(file_path_or_uploaded, parallel=None):
+    """캐시 없이 PDF를 파싱해서 페이지별 텍스트와 소요 시간을 반환합니다.
+    - parallel: None이면 페이지 수가 PDF_PARALLEL_MIN_PAGES 이상일 때 프로세스 풀 사용
+    """
+    start = time.perf_counter()
+    if isinstance(file_path_or_uploaded, str):
+        source = file_path_or_uploaded
+    elif hasattr(file_path_or_uploaded, 'getvalue'):
+        source = file_path_or_uploaded.getvalue()
+    else:
+        position = file_path_or_uploaded.tell()
+        source = file_path_or_uploaded.read()
+        file_path_or_uploaded.seek(position)
+    
+    import io
+    page_count = len(PdfReader(source if isinstance(source, str) else io.BytesIO(source)).pages)
+    if parallel is None:
+        parallel = page_count >= PDF_PARALLEL_MIN_PAGES and PDF_EXTRACT_WORKERS > 1
+    
+    if parallel and page_count > 1:
+        # 워커당 두 덩어리씩 나눠서 느린 페이지가 몰리는 것을 줄임
+        range_count = min(page_count, PDF_EXTRACT_WORKERS * 2)
+        bounds = [page_count * i // range_count for i in range(range_count + 1)]
+        pool = _get_pdf_process_pool()
+        futures = [pool.submit(_extract_page_range, source, bounds[i], bounds[i + 1]) for i in range(range_count)]
+        results = [item for future in futures for item in future.result()]
+    else:
+        parallel = False
+        results = _extract_page_range(source, 0, page_count)
+    
+    return {
+        "pages": [text for text, _ in results],
+        "page_seconds": [round(seconds, 4) for _, seconds in results],
+        "total_seconds": round(time.perf_counter() - start, 4),
+        "parallel": parallel
+    }
+
+def extract_pdf_pages(file_path_or_uploaded, use_cache=True, parallel=None):
+    """PDF의 페이지별 텍스트 목록을 반환합니다. 같은 내용의 파일은 다시 파싱하지 않습니다."""
+    file_hash = get_file_hash(file_path_or_uploaded) if use_cache else None
+    if file_hash:
+        pages = _load_cached_pdf_pages(file_hash)
+        if pages is not None:
+            return pages
+    
+    if isinstance(file_path_or_uploaded, str):
+        source = os.path.basename(file_path_or_uploaded)
+    else:
+        source = getattr(file_path_or_uploaded, 'name', None)
+    
+    extracted = extract_pdf_pages_with_timings(file_path_or_uploaded, parallel)
+    pages = extracted["pages"]
+    
+    if file_hash:
+        _save_cached_pdf_pages(file_hash, pages, source, extracted["page_seconds"])
+    return pages
+
 def pdf_to_text(file_path_or_uploaded):
-    """파일 경로 또는 업로드된 파일에서 텍스트를 추출합니다."""
+    """파일 경로 또는 업로드된 파일에서 텍스트를 추출합니다. (페이지 사이는 form feed로 구분)"""
     try:
-        if isinstance(file_path_or_uploaded, str):
-            # 파일 경로인 경우
-            if not os.path.exists(file_path_or_uploaded):
-                return f"파일을 찾을 수 없습니다: {file_path_or_uploaded}"
-            
-            with open(file_path_or_uploaded, 'rb') as file:
-                pdf = PdfReader(file)
-                text = ""
-                for page in pdf.pages:
-                    text += page.extract_text()
-        else:
-            # 업로드된 파일인 경우
-            pdf = PdfReader(file_path_or_uploaded)
-            text = ""
-            for page in pdf.pages:
-                text += page.extract_text()
+        if isinstance(file_path_or_uploaded, str) and not os.path.exists(file_path_or_uploaded):
+            return f"파일을 찾을 수 없습니다: {file_path_or_uploaded}"
+        
+        text = PDF_PAGE_SEPARATOR.join(extract_pdf_pages(file_path_or_uploaded))
         
         if not text.strip():
             return "PDF에서 텍스트를 추출할 수 없습니다. 이미지 기반 PDF이거나 보호된 파일일 수 있습니다."
@@ -67,9 +989,14 @@ def pdf_to_text(file_path_or_uploaded):
     except Exception as e:
         return f"PDF 읽기 오류: {str(e)}"
 
+PDF_TEXT_ERROR_PREFIXES = ("파일을 찾을 수 없습니다", "PDF에서 텍스트를 추출할 수 없습니다", "PDF 읽기 오류")
+
+def is_pdf_text_error(text):
+    """pdf_to_text가 본문 대신 오류 메시지를 반환했는지 확인합니다."""
+    return not text or text.startswith(PDF_TEXT_ERROR_PREFIXES)
+
 # 텍스트 → 문단 나누고 임베딩
 try:
-    from langchain.text_splitter import CharacterTextSplitter
     try:
         from langchain_community.embeddings import HuggingFaceEmbeddings
         from langchain_community.vectorstores import FAISS
@@ -82,8 +1009,393 @@ try:
 except ImportError as e:
     print(f"LangChain import 오류: {e}")
     LANGCHAIN_AVAILABLE = False
+
+# LangChain 체인(RetrievalQA 등)용 채팅 모델
+# 호출은 create_chat_completion을 거치므로 공유 연결 풀, 같은 요청 합치기, 스케줄러 우선순위/TPM 예산,
+# 429 대기, 토큰 사용량 기록이 다른 생성 기능과 똑같이 적용됨 (SDK 자체 재시도 없음)
+try:
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
     
-import os
+    _LANGCHAIN_ROLES = {"human": "user", "ai": "assistant", "system": "system"}
+    
+    class ScheduledChatModel(BaseChatModel):
+        feature: str
+        model_name: str = "gpt-4o-mini"
+        temperature: float = 0
+        max_tokens: Optional[int] = None
+        
+        @property
+        def _llm_type(self):
+            return "scheduled-openai-chat"
+        
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            content = create_chat_completion(
+                self.feature,
+                model=self.model_name,
+                messages=[{"role": _LANGCHAIN_ROLES.get(message.type, "user"), "content": message.content} for message in messages],
+                max_tokens=self.max_tokens,
+                temperature=self.temperature
+            )
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content or ""))])
+except ImportError:
+    ScheduledChatModel = None
+
+# 📦 FAISS 인덱스 저장소 (문서 해시 + 청크/임베딩 설정별 디렉터리)
+INDEX_STORE_DIR = os.path.join("cache", "faiss_index")
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()  # torch | onnx
+CHUNKER_VERSION = "sentence-v2"
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "400"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "40"))
+
+def get_embedding_model_id(model_name=EMBEDDING_MODEL_NAME, backend=None):
+    """모델 이름 + 백엔드 식별자 (torch는 기존 인덱스와 호환되도록 모델 이름 그대로)"""
+    backend = backend or EMBEDDING_BACKEND
+    return model_name if backend == "torch" else f"{model_name}@{backend}-int8"
+
+def get_index_key(text, chunk_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS, model_name=EMBEDDING_MODEL_NAME, backend=None):
+    """문서 내용 해시와 청크/임베딩 설정으로 인덱스 저장소 키를 만듭니다."""
+    text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    params = f"{get_embedding_model_id(model_name, backend)}|{CHUNKER_VERSION}|{chunk_tokens}|{overlap_tokens}"
+    params_hash = hashlib.sha256(params.encode('utf-8')).hexdigest()
+    return f"{text_hash[:32]}_{params_hash[:12]}"
+
+def save_index_to_store(index_key, vectorstore, chunks, metadatas=None, params=None):
+    """FAISS 인덱스, 청크 텍스트, 메타데이터를 인덱스 저장소에 기록합니다."""
+    index_dir = os.path.join(INDEX_STORE_DIR, index_key)
+    if os.path.exists(os.path.join(index_dir, "index.faiss")):
+        return True
+    
+    tmp_dir = f"{index_dir}.{threading.get_ident()}.tmp"
+    stale_dir = f"{index_dir}.{threading.get_ident()}.old"
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        vectorstore.save_local(tmp_dir)
+        
+        with open(os.path.join(tmp_dir, "chunks.json"), 'w', encoding='utf-8') as f:
+            json.dump({
+                "index_key": index_key,
+                "params": params or {},
+                "chunk_count": len(chunks),
+                "chunks": chunks,
+                "metadatas": metadatas or [{} for _ in chunks]
+            }, f, ensure_ascii=False)
+        
+        # 완성된 디렉터리만 보이도록 마지막에 이름 변경
+        # (중단된 저장으로 index.faiss 없이 남은 디렉터리가 있으면 옆으로 치운 뒤 교체)
+        try:
+            os.rename(index_dir, stale_dir)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rename(tmp_dir, index_dir)
+        except OSError:
+            # 그 사이 다른 요청이 저장을 끝냈으면 그 인덱스를 사용
+            if not os.path.exists(os.path.join(index_dir, "index.faiss")):
+                raise
+        return True
+    except Exception as e:
+        print(f"인덱스 저장 오류: {e}")
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(stale_dir, ignore_errors=True)
+
+def load_index_from_store(index_key, embeddings):
+    """인덱스 저장소에서 FAISS 인덱스를 불러옵니다. 가능하면 메모리 맵으로 엽니다."""
+    index_dir = os.path.join(INDEX_STORE_DIR, index_key)
+    index_file = os.path.join(index_dir, "index.faiss")
+    if not os.path.exists(index_file):
+        return None
+    
+    try:
+        import faiss
+        index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        with open(os.path.join(index_dir, "index.pkl"), 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        return FAISS(embeddings, index, docstore, index_to_docstore_id)
+    except Exception as e:
+        print(f"인덱스 메모리 맵 로드 실패, 일반 로드로 재시도: {e}")
+    
+    try:
+        return FAISS.load_local(index_dir, embeddings, allow_dangerous_deserialization=True)
+    except Exception as e:
+        print(f"인덱스 로드 오류: {e}")
+        return None
+
+# 📦 ONNX Runtime int8 임베딩 백엔드 (CPU 전용 서버용, EMBEDDING_BACKEND=onnx)
+# 필요 패키지: onnxruntime, onnx (최초 변환 시 torch, transformers)
+ONNX_MODEL_DIR = os.path.join("cache", "onnx")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_INTRA_OP_THREADS = int(os.getenv("EMBEDDING_INTRA_OP_THREADS", "0"))  # 0이면 onnxruntime 기본값
+
+try:
+    from langchain_core.embeddings import Embeddings as _EmbeddingsBase
+except ImportError:
+    _EmbeddingsBase = object
+
+class OnnxEmbeddings(_EmbeddingsBase):
+    """sentence-transformers 모델을 int8 양자화 ONNX로 실행하는 임베딩
+    - 처음 사용할 때 모델을 ONNX로 내보내고 동적 양자화(QInt8)한 파일을 cache/onnx에 저장
+    - 길이가 비슷한 문장끼리 배치로 묶어 패딩을 줄임
+    - 평균 풀링 + L2 정규화 (all-MiniLM-L6-v2의 sentence-transformers 출력과 같은 방식)
+    """
+    
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, batch_size=EMBEDDING_BATCH_SIZE,
+                 intra_op_threads=EMBEDDING_INTRA_OP_THREADS, max_length=256, model_dir=ONNX_MODEL_DIR):
+        import onnxruntime
+        from transformers import AutoTokenizer
+        
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.model_path = os.path.join(model_dir, model_name.replace("/", "__"))
+        quantized_file = os.path.join(self.model_path, "model_int8.onnx")
+        if not os.path.exists(quantized_file):
+            self._export_quantized(quantized_file)
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads > 0:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(quantized_file, options, providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+    
+    def _export_quantized(self, quantized_file):
+        """PyTorch 모델을 ONNX로 내보낸 뒤 int8 동적 양자화"""
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        
+        os.makedirs(self.model_path, exist_ok=True)
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        model = AutoModel.from_pretrained(self.model_name).eval()
+        tokenizer.save_pretrained(self.model_path)
+        
+        sample = tokenizer(["인간공학 워밍업"], return_tensors="pt")
+        input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+        
+        class _Encoder(torch.nn.Module):
+            """입력 이름을 키워드로 넘겨 모델별 forward 인자 순서와 무관하게 내보냄"""
+            def __init__(self, encoder):
+                super().__init__()
+                self.encoder = encoder
+            
+            def forward(self, *inputs):
+                return self.encoder(**dict(zip(input_names, inputs))).last_hidden_state
+        
+        float_file = os.path.join(self.model_path, "model.onnx")
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+        export_kwargs = dict(
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes, opset_version=14
+        )
+        import inspect
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            # 최신 torch는 기본 내보내기가 dynamo 방식이라 기존 방식으로 고정
+            export_kwargs["dynamo"] = False
+        with torch.no_grad():
+            torch.onnx.export(_Encoder(model), tuple(sample[name] for name in input_names), float_file, **export_kwargs)
+        quantize_dynamic(float_file, quantized_file, weight_type=QuantType.QInt8)
+        os.remove(float_file)
+    
+    def _embed_batch(self, texts):
+        import numpy as np
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+        inputs = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+        hidden = self.session.run(None, inputs)[0]
+        mask = encoded["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+    
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for position, vector in zip(batch, self._embed_batch([texts[i] for i in batch])):
+                vectors[position] = vector.tolist()
+        return vectors
+    
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+# 📦 임베딩 모델 레지스트리 (프로세스당 모델별 한 번만 로드)
+_embedding_models = {}
+_embedding_stats = {}
+_embedding_lock = threading.Lock()
+
+def get_embedding_model(model_name=EMBEDDING_MODEL_NAME, backend=None):
+    """임베딩 모델을 한 번만 로드하고 이후에는 같은 인스턴스를 돌려줍니다.
+    - backend: torch (HuggingFaceEmbeddings) 또는 onnx (OnnxEmbeddings), 기본값은 EMBEDDING_BACKEND
+    """
+    backend = backend or EMBEDDING_BACKEND
+    model_id = get_embedding_model_id(model_name, backend)
+    with _embedding_lock:
+        if model_id not in _embedding_models:
+            start = time.perf_counter()
+            if backend == "onnx":
+                _embedding_models[model_id] = OnnxEmbeddings(model_name)
+            else:
+                _embedding_models[model_id] = HuggingFaceEmbeddings(
+                    model_name=model_name,
+                    model_kwargs={'device': 'cpu'}
+                )
+            _embedding_stats[model_id] = {
+                "backend": backend,
+                "load_seconds": round(time.perf_counter() - start, 3),
+                "loaded_at": datetime.datetime.now().isoformat(),
+                "warmup_seconds": None,
+                "requests": 0
+            }
+        _embedding_stats[model_id]["requests"] += 1
+        return _embedding_models[model_id]
+
+def warm_up_embedding_model(model_name=EMBEDDING_MODEL_NAME, backend=None):
+    """앱 시작 시 모델을 미리 로드하고 첫 추론까지 실행해 둡니다."""
+    model = get_embedding_model(model_name, backend)
+    model_id = get_embedding_model_id(model_name, backend)
+    if _embedding_stats[model_id]["warmup_seconds"] is None:
+        start = time.perf_counter()
+        model.embed_query("인간공학 워밍업")
+        _embedding_stats[model_id]["warmup_seconds"] = round(time.perf_counter() - start, 3)
+    return model
+
+def get_embedding_stats():
+    """모델별 로드 시간, 워밍업 시간, 요청 수를 반환합니다."""
+    with _embedding_lock:
+        return {name: dict(stats) for name, stats in _embedding_stats.items()}
+
+# 📦 청크 분할 (문장/목록/제목 경계 + 토큰 예산 + 페이지 범위)
+_HEADING_PATTERN = re.compile(r"^(\[.+\]|【.+】|제\s*\d+\s*[편장절]|[IVX]+\.\s|Chapter\s*\d+|■|◆|#)")
+_UNIT_START_PATTERN = re.compile(r"^(\d+(\.\d+)*[.)]\s|[-*•·▶○●□※]\s?|\(\d+\)|[가-하]\.\s)")
+_SENTENCE_END_PATTERN = re.compile(r"([.!?。]|[다요음함임됨])[\s\"')\]]*$")
+_SENTENCE_SPLIT_PATTERN = re.compile(r"(?<=[^\d\s][.!?。])\s+")
+
+def _split_page_units(page_text):
+    """한 페이지를 (제목 여부, 문장/목록 단위) 목록으로 나눕니다.
+    PDF 줄바꿈으로 끊긴 문장은 이어 붙이고, 목록 기호나 번호로 시작하는 줄은 새 단위로 봅니다.
+    """
+    units = []
+    buffer = []
+    
+    def flush():
+        if buffer:
+            joined = " ".join(buffer)
+            units.extend((False, sentence) for sentence in _SENTENCE_SPLIT_PATTERN.split(joined) if sentence.strip())
+            buffer.clear()
+    
+    for raw_line in page_text.split("\n"):
+        line = re.sub(r"\s+", " ", raw_line).strip()
+        if not line:
+            if not (len(buffer) == 1 and re.fullmatch(r"\d+(\.\d+)*[.)]?", buffer[0])):
+                flush()
+            continue
+        if _HEADING_PATTERN.match(line) and len(line) <= 60:
+            flush()
+            units.append((True, line))
+            continue
+        if _UNIT_START_PATTERN.match(line):
+            flush()
+        if re.fullmatch(r"\d+(\.\d+)*[.)]?", line):
+            # 번호만 있는 줄은 다음 줄과 같은 항목
+            flush()
+            buffer.append(line)
+            continue
+        buffer.append(line)
+        if _SENTENCE_END_PATTERN.search(line):
+            flush()
+    flush()
+    return units
+
+def _split_oversized_unit(unit, max_tokens):
+    """토큰 예산보다 긴 단위를 공백 기준으로 잘라 예산 안에 맞춥니다."""
+    pieces = []
+    current = ""
+    words = []
+    for word in unit.split(" "):
+        # 공백 없이 예산보다 긴 단어는 글자 수로 자름 (글자당 최대 1토큰)
+        if estimate_tokens(word) > max_tokens:
+            step = max(1, max_tokens - 1)
+            words.extend(word[i:i + step] for i in range(0, len(word), step))
+        else:
+            words.append(word)
+    for word in words:
+        candidate = f"{current} {word}".strip()
+        if current and estimate_tokens(candidate) > max_tokens:
+            pieces.append(current)
+            current = word
+        else:
+            current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+def chunk_text(text, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """텍스트를 검색용 청크로 나눕니다.
+    - 문장/목록 항목 경계에서만 자르고, 제목이 나오면 새 청크를 시작
+    - 청크 크기는 토큰 수 기준 (max_tokens)
+    - 겹침은 직전 청크의 마지막 단위가 overlap_tokens 이하일 때만 한 단위
+    - 메타데이터: page_start, page_end, section, tokens, chunk_index
+    반환: (청크 목록, 메타데이터 목록)
+    """
+    chunks = []
+    metadatas = []
+    current = []  # (단위, 페이지, 토큰 수)
+    current_tokens = 0
+    section = None
+    
+    def emit():
+        nonlocal current, current_tokens
+        if not current:
+            return
+        body = "\n".join(unit for unit, _, _ in current)
+        if section and not body.startswith(section):
+            body = f"{section}\n{body}"
+        chunks.append(body)
+        metadatas.append({
+            "page_start": current[0][1],
+            "page_end": current[-1][1],
+            "section": section,
+            "tokens": estimate_tokens(body),
+            "chunk_index": len(chunks) - 1
+        })
+        last = current[-1]
+        current = [last] if last[2] <= overlap_tokens and len(current) > 1 else []
+        current_tokens = sum(tokens for _, _, tokens in current)
+    
+    for page_number, page_text in enumerate(text.split(PDF_PAGE_SEPARATOR), start=1):
+        for is_heading, unit in _split_page_units(page_text):
+            if is_heading:
+                emit()
+                current = []
+                current_tokens = 0
+                section = unit
+                continue
+            
+            # 청크 앞에 붙는 제목까지 max_tokens 안에 들어가도록
+            budget = max(1, max_tokens - (estimate_tokens(section) if section else 0))
+            for piece in ([unit] if estimate_tokens(unit) <= budget else _split_oversized_unit(unit, budget)):
+                piece_tokens = estimate_tokens(piece)
+                if current and current_tokens + piece_tokens > budget:
+                    emit()
+                    # 겹침으로 넘긴 단위와 합쳐도 예산을 넘으면 겹침 없이 시작
+                    if current and current_tokens + piece_tokens > budget:
+                        current = []
+                        current_tokens = 0
+                current.append((piece, page_number, piece_tokens))
+                current_tokens += piece_tokens
+    
+    # 마지막 청크 (겹침으로 남은 단위만 있으면 생략)
+    if current and not (chunks and len(current) == 1 and current[0][0] in chunks[-1]):
+        emit()
+    return chunks, metadatas
 
 def create_vectorstore(text):
     if not LANGCHAIN_AVAILABLE:
@@ -94,55 +1406,395 @@ def create_vectorstore(text):
         if not text or len(text.strip()) < 50:
             print("텍스트가 너무 짧습니다.")
             return None
+
+        # HuggingFace 무료 임베딩 모델 사용 (OpenAI API 키 문제 해결)
+        embeddings = get_embedding_model()
+        
+        # 저장된 인덱스가 있으면 다시 임베딩하지 않음
+        index_key = get_index_key(text)
+        vectorstore = load_index_from_store(index_key, embeddings)
+        if vectorstore is not None:
+            return vectorstore
             
-        splitter = CharacterTextSplitter(separator="\n", chunk_size=1000, chunk_overlap=200)
-        chunks = splitter.split_text(text)
+        chunks, metadatas = chunk_text(text)
         
         if not chunks:
             print("텍스트 분할에 실패했습니다.")
             return None
 
-        # HuggingFace 무료 임베딩 모델 사용 (OpenAI API 키 문제 해결)
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            model_kwargs={'device': 'cpu'}
-        )
-        vectorstore = FAISS.from_texts(chunks, embeddings)
+        vectorstore = FAISS.from_texts(chunks, embeddings, metadatas=metadatas)
+        save_index_to_store(index_key, vectorstore, chunks, metadatas, params={
+            "model_name": get_embedding_model_id(),
+            "chunker": CHUNKER_VERSION,
+            "chunk_tokens": CHUNK_MAX_TOKENS,
+            "overlap_tokens": CHUNK_OVERLAP_TOKENS
+        })
 
         return vectorstore
     except Exception as e:
         print(f"벡터스토어 생성 중 오류: {str(e)}")
         return None
 
-# 🚀 수익화 기능들
+# 📦 문서별 벡터스토어 (질의응답 검색용, 메모리는 vector_manager가 관리)
+RETRIEVAL_TOP_K = 5
+RETRIEVAL_MAX_CONTEXT_TOKENS = 2000
 
-# 1. 사용자 맞춤 학습 이력 관리
-import datetime
-import json
-import hashlib
-import uuid
+def get_document_vectorstore(text):
+    """문서 내용별 벡터스토어를 반환합니다. (메모리 한도/TTL 안에서 vector_manager에 유지)"""
+    return vector_manager.get_or_create(get_index_key(text), lambda: create_vectorstore(text))
 
-def create_personalized_learning_path(username, learning_history, preferences=None):
-    """사용자 맞춤 학습 경로 생성"""
-    try:
-        client = get_openai_client()
-        
-        # 학습 이력 분석
-        recent_topics = []
-        weak_areas = []
-        strong_areas = []
-        
-        for record in learning_history[-10:]:  # 최근 10개 기록
-            question = record.get('question', '')
-            answer = record.get('answer', '')
-            
-            # 간단한 키워드 분석
-            if '어려워' in question or '모르겠' in question:
-                weak_areas.append(question[:50])
-            elif '잘 알겠' in answer or '이해했' in answer:
-                strong_areas.append(question[:50])
-        
-        prompt = f"""
+def estimate_tokens(text):
+    """토큰 수를 대략 추정합니다. (한글은 글자당 약 1토큰, 그 외는 4글자당 1토큰)"""
+    hangul_count = sum(1 for ch in text if '\uac00' <= ch <= '\ud7a3')
+    return hangul_count + (len(text) - hangul_count) // 4 + 1
+
+# 📦 토큰 예산 (모델 토크나이저로 토큰 수를 세서 프롬프트에 넣을 본문 길이를 정함)
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_MODEL_CONTEXT_LIMIT = 8192
+# 본문에 쓸 최대 토큰 (비용/지연 상한, 모델 한도가 더 작으면 모델 한도를 따름)
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "6000"))
+# 본문을 제외한 지시문/형식 설명에 남겨둘 토큰
+PROMPT_TEMPLATE_RESERVE_TOKENS = int(os.getenv("PROMPT_TEMPLATE_RESERVE_TOKENS", "800"))
+# 1M 토큰당 달러 (입력, 출력) - 사용량 화면의 예상 비용 계산용
+MODEL_PRICES_PER_MILLION = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+}
+TOKEN_USAGE_RECENT_CALLS = 50
+# 문서 목록용 짧은 요약 / 강사 챗봇 미리보기에 쓰는 앞부분 토큰 수
+DOCUMENT_PREVIEW_TOKENS = 700
+INSTRUCTOR_BOT_PREVIEW_TOKENS = 3500
+
+_token_encoders = {}
+_token_encoder_lock = threading.Lock()
+
+def _get_token_encoder(model):
+    """모델의 tiktoken 인코더 (tiktoken이 없거나 인코딩 파일을 받을 수 없으면 None)"""
+    with _token_encoder_lock:
+        if model in _token_encoders:
+            return _token_encoders[model]
+        try:
+            import tiktoken
+            try:
+                encoder = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoder = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"토크나이저를 불러오지 못해 추정치를 사용합니다: {e}")
+            encoder = None
+        _token_encoders[model] = encoder
+        return encoder
+
+def count_tokens(text, model="gpt-4o-mini"):
+    """모델 토크나이저 기준 토큰 수 (토크나이저를 쓸 수 없으면 estimate_tokens 추정치)"""
+    if not text:
+        return 0
+    encoder = _get_token_encoder(model)
+    if encoder is None:
+        return estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages, model="gpt-4o-mini"):
+    """채팅 메시지 목록의 입력 토큰 수 (메시지마다 역할/구분자 몫으로 4토큰을 더함)"""
+    return sum(count_tokens(message.get("content") or "", model) + 4 for message in messages) + 3
+
+def truncate_to_tokens(text, max_tokens, model="gpt-4o-mini"):
+    """text를 max_tokens 토큰 안으로 자릅니다. 가능하면 줄/문장 경계에서 자름"""
+    if not text or max_tokens <= 0:
+        return ""
+    encoder = _get_token_encoder(model)
+    if encoder is None:
+        if estimate_tokens(text) <= max_tokens:
+            return text
+        # 추정치 기준 이분 탐색으로 들어가는 가장 긴 앞부분을 찾음
+        low, high = 0, len(text)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if estimate_tokens(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        cut = text[:low]
+    else:
+        tokens = encoder.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        cut = encoder.decode(tokens[:max_tokens]).rstrip("\ufffd")
+    
+    # 마지막 10% 안에 줄바꿈이나 문장 끝이 있으면 거기서 끊음
+    boundary = max(cut.rfind("\n"), cut.rfind(". "), cut.rfind("다. "))
+    if boundary >= len(cut) * 0.9:
+        cut = cut[:boundary + 1]
+    return cut
+
+def get_prompt_context_budget(max_tokens=None, model="gpt-4o-mini", budget=None, reserved_tokens=PROMPT_TEMPLATE_RESERVE_TOKENS):
+    """응답 토큰(max_tokens)과 지시문 몫을 빼고 본문에 쓸 수 있는 토큰 수"""
+    limit = MODEL_CONTEXT_LIMITS.get(model, DEFAULT_MODEL_CONTEXT_LIMIT)
+    available = limit - (max_tokens or 1000) - reserved_tokens
+    return max(min(budget or PROMPT_CONTEXT_TOKENS, available), 0)
+
+def fit_prompt_context(text, max_tokens=None, model="gpt-4o-mini", budget=None, reserved_tokens=PROMPT_TEMPLATE_RESERVE_TOKENS):
+    """모델 한도와 응답 길이(max_tokens)에 맞춰 프롬프트에 넣을 본문을 최대한 채워 반환합니다."""
+    return truncate_to_tokens(text, get_prompt_context_budget(max_tokens, model, budget, reserved_tokens), model)
+
+class TokenUsageTracker:
+    """LLM 호출별 토큰 사용량 기록 (기능별 누적 + 최근 호출 목록)"""
+    
+    def __init__(self, recent_calls=TOKEN_USAGE_RECENT_CALLS):
+        self._lock = threading.Lock()
+        self._features = {}
+        self._recent = deque(maxlen=recent_calls)
+    
+    def record(self, feature, model, prompt_tokens, completion_tokens, measured):
+        prices = MODEL_PRICES_PER_MILLION.get(model, (0.0, 0.0))
+        cost = (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1_000_000
+        entry = {
+            "feature": feature,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cost_usd": round(cost, 6),
+            # True면 API가 알려준 값, False면 로컬 토크나이저로 센 값
+            "measured": measured,
+            "at": time.time()
+        }
+        with self._lock:
+            totals = self._features.setdefault(feature, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0})
+            totals["calls"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["cost_usd"] += cost
+            self._recent.append(entry)
+        return entry
+    
+    def stats(self):
+        with self._lock:
+            features = {
+                feature: dict(totals, cost_usd=round(totals["cost_usd"], 4))
+                for feature, totals in self._features.items()
+            }
+            return {
+                "total_tokens": sum(t["prompt_tokens"] + t["completion_tokens"] for t in features.values()),
+                "total_cost_usd": round(sum(t["cost_usd"] for t in features.values()), 4),
+                "features": features,
+                "recent_calls": list(self._recent)
+            }
+
+token_usage_tracker = TokenUsageTracker()
+
+def record_token_usage(feature, model, messages, content, usage=None):
+    """API가 알려준 사용량이 있으면 그 값을, 없으면 로컬에서 센 값을 기록합니다."""
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    measured = prompt_tokens is not None and completion_tokens is not None
+    if not measured:
+        prompt_tokens = count_message_tokens(messages, model)
+        completion_tokens = count_tokens(content or "", model)
+    return token_usage_tracker.record(feature, model, prompt_tokens, completion_tokens, measured)
+
+def get_token_usage_stats():
+    return token_usage_tracker.stats()
+
+def retrieve_relevant_context(text, question, top_k=RETRIEVAL_TOP_K, max_context_tokens=RETRIEVAL_MAX_CONTEXT_TOKENS):
+    """질문과 관련도가 높은 청크를 토큰 예산 안에서 골라 이어 붙입니다."""
+    vectorstore = get_document_vectorstore(text)
+    if vectorstore is None:
+        return None
+    
+    selected_chunks = []
+    used_tokens = 0
+    for doc in get_hybrid_retriever(vectorstore, k=top_k).invoke(question):
+        chunk_tokens = count_tokens(doc.page_content)
+        if used_tokens + chunk_tokens > max_context_tokens:
+            continue
+        selected_chunks.append(doc.page_content.strip())
+        used_tokens += chunk_tokens
+    
+    return "\n\n---\n\n".join(selected_chunks) if selected_chunks else None
+
+# 📦 하이브리드 검색 (BM25 어휘 검색 + 벡터 검색, 순위 결합)
+HYBRID_FETCH_K = 20
+HYBRID_RRF_K = 60
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "1.0"))
+HYBRID_VECTOR_WEIGHT = float(os.getenv("HYBRID_VECTOR_WEIGHT", "1.0"))
+
+# 어절 끝에서 떼어낼 조사/어미 (긴 것부터 검사)
+KOREAN_SUFFIXES = sorted([
+    "에서는", "으로는", "에게서", "이라는", "입니다", "합니다", "하는", "되는", "에서", "으로", "에게",
+    "까지", "부터", "이란", "이며", "이고", "라는", "은", "는", "이", "가", "을", "를", "의",
+    "에", "로", "와", "과", "도", "만", "란"
+], key=len, reverse=True)
+
+_TOKEN_PATTERN = re.compile(r"[가-힣]+|[a-z0-9]+(?:[._-][a-z0-9]+)*")
+
+def tokenize_korean(text):
+    """한국어 검색용 토큰화
+    - 영문/숫자/공식 이름(RWL, NIOSH, 3.5 등)은 소문자 그대로
+    - 한글 어절은 조사를 뗀 어간 + 글자 바이그램 (띄어쓰기/복합어 차이 보완)
+    """
+    tokens = []
+    for word in _TOKEN_PATTERN.findall(text.lower()):
+        if not ('\uac00' <= word[0] <= '\ud7a3'):
+            tokens.append(word)
+            continue
+        for suffix in KOREAN_SUFFIXES:
+            if len(word) > len(suffix) + 1 and word.endswith(suffix):
+                word = word[:-len(suffix)]
+                break
+        tokens.append(word)
+        if len(word) > 2:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+class BM25Index:
+    """메모리 역색인 기반 BM25 (Okapi) 점수 계산"""
+    
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_lengths = []
+        for doc_id, doc in enumerate(documents):
+            tokens = tokenize_korean(doc.page_content)
+            self.doc_lengths.append(len(tokens))
+            term_counts = {}
+            for token in tokens:
+                term_counts[token] = term_counts.get(token, 0) + 1
+            for token, count in term_counts.items():
+                self.postings.setdefault(token, []).append((doc_id, count))
+        
+        doc_count = len(documents)
+        self.avg_length = (sum(self.doc_lengths) / doc_count) if doc_count else 0
+        self.idf = {
+            token: math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for token, posting in self.postings.items()
+        }
+    
+    def search(self, query, k=HYBRID_FETCH_K):
+        """(문서, 점수) 목록을 점수 높은 순으로 반환"""
+        scores = {}
+        for token in set(tokenize_korean(query)):
+            idf = self.idf.get(token)
+            if idf is None:
+                continue
+            for doc_id, count in self.postings[token]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / (self.avg_length or 1))
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        
+        import heapq
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.documents[doc_id], score) for doc_id, score in top]
+
+_bm25_indexes = weakref.WeakKeyDictionary()
+_bm25_lock = threading.Lock()
+
+def get_bm25_index(vectorstore):
+    """벡터스토어에 들어 있는 청크로 BM25 색인을 만들어 벡터스토어별로 재사용"""
+    with _bm25_lock:
+        index = _bm25_indexes.get(vectorstore)
+        if index is None:
+            documents = [
+                vectorstore.docstore.search(doc_id)
+                for _, doc_id in sorted(vectorstore.index_to_docstore_id.items())
+            ]
+            index = BM25Index([doc for doc in documents if hasattr(doc, "page_content")])
+            _bm25_indexes[vectorstore] = index
+        return index
+
+def _document_key(doc):
+    return (doc.metadata.get("source"), doc.page_content)
+
+def _is_exact_term_query(query):
+    """공식 이름/약어처럼 짧은 용어 질의인지 확인"""
+    words = query.strip().split()
+    return 0 < len(words) <= 2 and len(query.strip()) <= 20
+
+try:
+    from langchain_core.retrievers import BaseRetriever
+    from langchain_core.documents import Document
+    
+    class HybridRetriever(BaseRetriever):
+        """BM25 결과와 벡터 검색 결과를 RRF(Reciprocal Rank Fusion)로 합치는 검색기
+        - 짧은 용어 질의에서 어휘 검색 상위 결과가 모두 그 용어를 포함하면 벡터 검색을 건너뜀
+        """
+        vectorstore: object
+        bm25: object
+        k: int = RETRIEVAL_TOP_K
+        fetch_k: int = HYBRID_FETCH_K
+        rrf_k: int = HYBRID_RRF_K
+        lexical_weight: float = HYBRID_LEXICAL_WEIGHT
+        vector_weight: float = HYBRID_VECTOR_WEIGHT
+        
+        def _get_relevant_documents(self, query, *, run_manager=None):
+            lexical = [doc for doc, _ in self.bm25.search(query, self.fetch_k)]
+            
+            # 빠른 어휘 경로: 정확한 용어 질의
+            if _is_exact_term_query(query) and len(lexical) >= self.k:
+                needle = query.strip().lower()
+                if all(needle in doc.page_content.lower() for doc in lexical[:self.k]):
+                    return lexical[:self.k]
+            
+            dense = self.vectorstore.similarity_search(query, k=self.fetch_k)
+            
+            fused = {}
+            for weight, ranked in ((self.lexical_weight, lexical), (self.vector_weight, dense)):
+                for rank, doc in enumerate(ranked):
+                    key = _document_key(doc)
+                    score, _ = fused.get(key, (0.0, doc))
+                    fused[key] = (score + weight / (self.rrf_k + rank + 1), doc)
+            
+            ranked_docs = sorted(fused.values(), key=lambda item: item[0], reverse=True)
+            return [doc for _, doc in ranked_docs[:self.k]]
+    
+    HYBRID_RETRIEVER_AVAILABLE = True
+except ImportError:
+    HYBRID_RETRIEVER_AVAILABLE = False
+
+def get_hybrid_retriever(vectorstore, k=RETRIEVAL_TOP_K, fetch_k=HYBRID_FETCH_K):
+    """하이브리드 검색기 생성 (사용할 수 없으면 기본 벡터 검색기)"""
+    if not HYBRID_RETRIEVER_AVAILABLE:
+        return vectorstore.as_retriever(search_kwargs={"k": k})
+    try:
+        return HybridRetriever(vectorstore=vectorstore, bm25=get_bm25_index(vectorstore), k=k, fetch_k=max(fetch_k, k))
+    except Exception as e:
+        print(f"하이브리드 검색기 생성 오류: {e}")
+        return vectorstore.as_retriever(search_kwargs={"k": k})
+
+# 🚀 수익화 기능들
+
+# 1. 사용자 맞춤 학습 이력 관리
+import datetime
+import json
+import hashlib
+import uuid
+
+def create_personalized_learning_path(username, learning_history, preferences=None):
+    """사용자 맞춤 학습 경로 생성"""
+    try:
+        # 학습 이력 분석
+        recent_topics = []
+        weak_areas = []
+        strong_areas = []
+        
+        for record in learning_history[-10:]:  # 최근 10개 기록
+            question = record.get('question', '')
+            answer = record.get('answer', '')
+            
+            # 간단한 키워드 분석
+            if '어려워' in question or '모르겠' in question:
+                weak_areas.append(question[:50])
+            elif '잘 알겠' in answer or '이해했' in answer:
+                strong_areas.append(question[:50])
+        
+        prompt = f"""
         사용자 {username}의 학습 이력을 분석하여 맞춤 학습 경로를 제안해주세요.
         
         최근 학습 주제: {recent_topics}
@@ -156,22 +1808,19 @@ def create_personalized_learning_path(username, learning_history, preferences=No
         4. 맞춤 학습 전략
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "learning_path",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=800,
             temperature=0.3
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"맞춤 학습 경로 생성 실패: {str(e)}"
 
 def generate_adaptive_quiz(username, learning_history, difficulty_level="medium"):
     """사용자 수준에 맞는 적응형 퀴즈 생성"""
     try:
-        client = get_openai_client()
-        
         # 사용자 약점 분석
         weak_topics = analyze_weak_areas(learning_history)
         
@@ -195,14 +1844,13 @@ def generate_adaptive_quiz(username, learning_history, difficulty_level="medium"
         학습 팁: [추가 학습 방향]
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "adaptive_quiz",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=2000,
             temperature=0.4
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"적응형 퀴즈 생성 실패: {str(e)}"
 
@@ -234,7 +1882,7 @@ def create_instructor_chatbot(instructor_name, pdf_content, course_name):
             "chatbot_id": chatbot_id,
             "instructor_name": instructor_name,
             "course_name": course_name,
-            "pdf_content": pdf_content[:5000],  # 미리보기용
+            "pdf_content": truncate_to_tokens(pdf_content, INSTRUCTOR_BOT_PREVIEW_TOKENS),  # 미리보기용
             "created_at": datetime.datetime.now().isoformat(),
             "access_count": 0,
             "student_interactions": [],
@@ -279,13 +1927,11 @@ def generate_shareable_quiz_link(quiz_content, instructor_name, course_name):
 def generate_premium_exam_questions(pdf_content, exam_type="midterm", num_questions=20):
     """프리미엄 예상문제 생성"""
     try:
-        client = get_openai_client()
-        
         prompt = f"""
         다음 교재 내용을 바탕으로 {exam_type} 시험 예상문제 {num_questions}개를 생성해주세요.
         
         교재 내용:
-        {pdf_content[:4000]}
+        {fit_prompt_context(pdf_content, max_tokens=3000)}
         
         요구사항:
         1. 실제 시험과 유사한 난이도
@@ -303,36 +1949,95 @@ def generate_premium_exam_questions(pdf_content, exam_type="midterm", num_questi
         관련 개념: [연관 학습 내용]
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "exam_questions",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=3000,
             temperature=0.3
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"예상문제 생성 실패: {str(e)}"
 
-def create_premium_study_package(username, pdf_content, package_type="complete"):
-    """프리미엄 학습 패키지 생성"""
+# 패키지 구성 요소 동시 생성 설정
+PACKAGE_COMPONENT_TIMEOUT_SECONDS = int(os.getenv("PACKAGE_COMPONENT_TIMEOUT_SECONDS", "90"))
+PACKAGE_MAX_WORKERS = 6
+# 구성 요소 생성 함수는 예외 대신 오류 문자열을 반환하므로 접두어로 실패를 구분
+PACKAGE_COMPONENT_ERROR_PREFIXES = {
+    "adaptive_quiz": "적응형 퀴즈 생성 실패",
+    "exam_questions": "예상문제 생성 실패",
+    "detailed_summary": "상세 요약 생성 실패",
+    "concept_map": "개념 맵 생성 실패",
+    "practice_problems": "연습 문제 생성 실패",
+    "solution_guide": "해설 가이드 생성 실패"
+}
+
+def _is_component_failure(name, result):
+    """빈 결과이거나 생성 함수가 돌려준 오류 문자열이면 실패"""
+    if not result:
+        return True
+    prefix = PACKAGE_COMPONENT_ERROR_PREFIXES.get(name)
+    return isinstance(result, str) and prefix is not None and result.startswith(prefix)
+
+def _run_package_components(tasks, timeout_seconds):
+    """구성 요소 생성 작업을 동시에 실행하고, 제한 시간 안에 끝난 결과만 모읍니다."""
+    from concurrent.futures import ThreadPoolExecutor, wait
+    
+    components = {}
+    failed_components = {}
+    if not tasks:
+        return components, failed_components
+    
+    executor = ThreadPoolExecutor(max_workers=min(PACKAGE_MAX_WORKERS, len(tasks)))
+    try:
+        # 요청자의 플랜(우선순위)이 워커 스레드에도 전달되도록 컨텍스트 복사
+        futures = {executor.submit(contextvars.copy_context().run, func, *args): name for name, (func, args) in tasks.items()}
+        done, not_done = wait(futures, timeout=timeout_seconds)
+        
+        for future in done:
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failed_components[name] = f"생성 실패: {str(e)}"
+                continue
+            if _is_component_failure(name, result):
+                failed_components[name] = result or "생성 실패: 빈 결과"
+            else:
+                components[name] = result
+        
+        for future in not_done:
+            future.cancel()
+            failed_components[futures[future]] = f"시간 초과 ({timeout_seconds}초)"
+    finally:
+        # 시간 초과된 작업을 기다리지 않고 반환
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    # 원래 구성 순서 유지
+    components = {name: components[name] for name in tasks if name in components}
+    return components, failed_components
+
+def create_premium_study_package(username, pdf_content, package_type="complete", component_timeout=PACKAGE_COMPONENT_TIMEOUT_SECONDS):
+    """프리미엄 학습 패키지 생성 (구성 요소는 동시에 생성, 시간 초과된 요소는 제외)"""
     try:
         package_id = str(uuid.uuid4())[:8]
         
-        # 패키지 구성 요소 생성
-        components = {}
+        # 패키지 구성 요소 생성 작업
+        tasks = {}
         
         if package_type in ["complete", "quiz"]:
-            components["adaptive_quiz"] = generate_adaptive_quiz(username, [], "advanced")
-            components["exam_questions"] = generate_premium_exam_questions(pdf_content)
+            tasks["adaptive_quiz"] = (generate_adaptive_quiz, (username, [], "advanced"))
+            tasks["exam_questions"] = (generate_premium_exam_questions, (pdf_content,))
         
         if package_type in ["complete", "summary"]:
-            components["detailed_summary"] = generate_detailed_summary(pdf_content)
-            components["concept_map"] = generate_concept_map(pdf_content)
+            tasks["detailed_summary"] = (generate_detailed_summary, (pdf_content,))
+            tasks["concept_map"] = (generate_concept_map, (pdf_content,))
         
         if package_type in ["complete", "practice"]:
-            components["practice_problems"] = generate_practice_problems(pdf_content)
-            components["solution_guide"] = generate_solution_guide(pdf_content)
+            tasks["practice_problems"] = (generate_practice_problems, (pdf_content,))
+            tasks["solution_guide"] = (generate_solution_guide, (pdf_content,))
+        
+        components, failed_components = _run_package_components(tasks, component_timeout)
         
         # 패키지 저장
         os.makedirs("premium_packages", exist_ok=True)
@@ -341,6 +2046,8 @@ def create_premium_study_package(username, pdf_content, package_type="complete")
             "username": username,
             "package_type": package_type,
             "components": components,
+            "failed_components": failed_components,
+            "is_complete": not failed_components,
             "created_at": datetime.datetime.now().isoformat(),
             "expires_at": (datetime.datetime.now() + datetime.timedelta(days=30)).isoformat(),
             "download_count": 0,
@@ -426,12 +2133,10 @@ def generate_academy_analytics(academy_id):
 def generate_detailed_summary(pdf_content):
     """상세 요약 생성"""
     try:
-        client = get_openai_client()
-        
         prompt = f"""
         다음 내용을 체계적으로 요약해주세요:
         
-        {pdf_content[:3000]}
+        {fit_prompt_context(pdf_content, max_tokens=1500)}
         
         다음 구조로 요약해주세요:
         1. 핵심 개념 (5개)
@@ -441,26 +2146,23 @@ def generate_detailed_summary(pdf_content):
         5. 연관 학습 주제
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "detailed_summary",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1500,
             temperature=0.3
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"상세 요약 생성 실패: {str(e)}"
 
 def generate_concept_map(pdf_content):
     """개념 맵 생성"""
     try:
-        client = get_openai_client()
-        
         prompt = f"""
         다음 내용의 개념 맵을 텍스트 형태로 생성해주세요:
         
-        {pdf_content[:2000]}
+        {fit_prompt_context(pdf_content, max_tokens=1000)}
         
         형식:
         중심 개념: [메인 주제]
@@ -475,26 +2177,23 @@ def generate_concept_map(pdf_content):
             └── 세부 내용 3-2
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "concept_map",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1000,
             temperature=0.3
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"개념 맵 생성 실패: {str(e)}"
 
 def generate_practice_problems(pdf_content):
     """연습 문제 생성"""
     try:
-        client = get_openai_client()
-        
         prompt = f"""
         다음 내용을 바탕으로 연습 문제 10개를 생성해주세요:
         
-        {pdf_content[:3000]}
+        {fit_prompt_context(pdf_content, max_tokens=2000)}
         
         문제 유형:
         - 기초 문제 (3개)
@@ -504,26 +2203,23 @@ def generate_practice_problems(pdf_content):
         각 문제마다 난이도와 예상 소요 시간을 표시해주세요.
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "practice_problems",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=2000,
             temperature=0.4
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"연습 문제 생성 실패: {str(e)}"
 
 def generate_solution_guide(pdf_content):
     """해설 가이드 생성"""
     try:
-        client = get_openai_client()
-        
         prompt = f"""
         다음 내용에 대한 문제 해결 가이드를 작성해주세요:
         
-        {pdf_content[:2000]}
+        {fit_prompt_context(pdf_content, max_tokens=1500)}
         
         포함 내용:
         1. 문제 접근 방법
@@ -533,120 +2229,89 @@ def generate_solution_guide(pdf_content):
         5. 유사 문제 해결 팁
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "solution_guide",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1500,
             temperature=0.3
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"해설 가이드 생성 실패: {str(e)}"
 
-# 누락된 함수들 추가
-def create_qa_chain(vectorstore):
-    """QA 체인 생성"""
-    if not LANGCHAIN_AVAILABLE:
-        print("LangChain이 설치되지 않았습니다.")
-        return None
+# 🆕 다중 문서 지원 기능
+def compose_vectorstore_from_shards(shards, embeddings):
+    """문서별 벡터스토어(샤드)에 저장된 벡터를 그대로 모아 통합 벡터스토어를 만듭니다. (재임베딩 없음)
+    - shards: [(문서 이름, 벡터스토어), ...]
+    """
+    import numpy as np
     
-    if vectorstore is None:
-        print("벡터스토어가 없습니다.")
-        return None
+    text_embeddings = []
+    metadatas = []
+    for pdf_name, shard in shards:
+        total = shard.index.ntotal
+        if total == 0:
+            continue
+        vectors = shard.index.reconstruct_n(0, total)
+        for position in range(total):
+            doc = shard.docstore.search(shard.index_to_docstore_id[position])
+            text_embeddings.append((doc.page_content, np.asarray(vectors[position])))
+            metadatas.append({**doc.metadata, "source": pdf_name})
     
-    try:
-        # API 키 확인
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            print("OpenAI API 키가 설정되지 않았습니다.")
-            return None
-            
-        retriever = vectorstore.as_retriever()
-        
-        # 최신 모델 사용
-        try:
-            from langchain_openai import ChatOpenAI
-        except ImportError:
-            from langchain.chat_models import ChatOpenAI
-        
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, api_key=api_key)
-        from langchain.chains import RetrievalQA
-        chain = RetrievalQA.from_chain_type(llm=llm, retriever=retriever)
-        return chain
-    except Exception as e:
-        print(f"QA 체인 생성 중 오류: {str(e)}")
+    if not text_embeddings:
         return None
+    return FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas)
 
-def authenticate_user(username, password):
-    """사용자 인증"""
+def create_multi_vectorstore(texts_dict):
+    """여러 PDF의 텍스트로 통합 벡터스토어 생성
+    각 문서는 문서별 인덱스(메모리/인덱스 저장소)로 한 번만 임베딩하고,
+    선택이 바뀌면 저장된 벡터만 다시 모아서 만듭니다.
+    """
     try:
-        users_file = "users/users.json"
-        with open(users_file, 'r', encoding='utf-8') as f:
-            users = json.load(f)
-        
-        if username in users:
-            stored_password = users[username]["password"]
-            if stored_password == hash_password(password):
-                # 로그인 시간 업데이트
-                users[username]["last_login"] = datetime.datetime.now().isoformat()
-                
-                with open(users_file, 'w', encoding='utf-8') as f:
-                    json.dump(users, f, ensure_ascii=False, indent=2)
-                
-                return users[username]
+        # HuggingFace 임베딩 모델 사용
+        embeddings = get_embedding_model()
         
-        return None
-    except FileNotFoundError:
-        return None
+        # 문서 이름과 내용이 같은 조합이면 만들어 둔 통합 인덱스 재사용 (메모리는 vector_manager가 관리)
+        selection = "|".join(
+            f"{pdf_name}:{get_index_key(text)}"
+            for pdf_name, text in sorted(texts_dict.items())
+        )
+        selection_key = "multi-" + hashlib.sha256(selection.encode('utf-8')).hexdigest()
+        
+        def compose():
+            shards = []
+            for pdf_name, text in sorted(texts_dict.items()):
+                shard = get_document_vectorstore(text)
+                if shard is None:
+                    print(f"문서 인덱스 생성 실패: {pdf_name}")
+                    continue
+                shards.append((pdf_name, shard))
+            return compose_vectorstore_from_shards(shards, embeddings)
+        
+        return vector_manager.get_or_create(selection_key, compose)
     except Exception as e:
-        print(f"인증 오류: {e}")
+        print(f"다중 벡터스토어 생성 오류: {e}")
         return None
 
-def hash_password(password):
-    """비밀번호 해시화"""
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def create_user(username, password, plan="free"):
-    """새 사용자 생성"""
+def save_user_documents(username, selected_pdfs):
+    """사용자별 선택된 문서 목록 저장"""
     try:
+        user_docs_file = f"users/{username}_documents.json"
         os.makedirs("users", exist_ok=True)
-        users_file = "users/users.json"
-        
-        # 기존 사용자 목록 로드
-        try:
-            with open(users_file, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-        except FileNotFoundError:
-            users = {}
-        
-        # 사용자명 중복 확인
-        if username in users:
-            return False
         
-        # 새 사용자 추가
-        users[username] = {
+        doc_data = {
             "username": username,
-            "password": hash_password(password),
-            "plan": plan,
-            "created_at": datetime.datetime.now().isoformat(),
-            "last_login": None,
-            "usage_stats": {
-                "total_questions": 0,
-                "total_pdfs": 0,
-                "total_quizzes": 0,
-                "api_calls_today": 0,
-                "last_api_call": None
-            }
+            "selected_documents": selected_pdfs,
+            "last_updated": datetime.datetime.now().isoformat(),
+            "document_count": len(selected_pdfs)
         }
         
-        # 저장
-        with open(users_file, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
+        with open(user_docs_file, 'w', encoding='utf-8') as f:
+            json.dump(doc_data, f, ensure_ascii=False, indent=2)
         
         return True
     except Exception as e:
-        print(f"사용자 생성 오류: {e}")
+        print(f"사용자 문서 저장 오류: {e}")
         return False
 
 def load_user_documents(username):
@@ -666,9 +2331,8 @@ def get_document_summary(pdf_name, text):
     """문서별 간단한 요약 생성"""
     try:
         # 텍스트가 너무 길면 앞부분만 사용
-        preview_text = text[:1000] if len(text) > 1000 else text
+        preview_text = fit_prompt_context(text, max_tokens=200, budget=DOCUMENT_PREVIEW_TOKENS)
         
-        client = openai.OpenAI()
         prompt = f"""
         다음 문서의 핵심 내용을 2-3줄로 요약해주세요:
         
@@ -676,1474 +2340,464 @@ def get_document_summary(pdf_name, text):
         내용: {preview_text}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "document_summary",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=200,
             temperature=0.3
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"요약 생성 실패: {str(e)}"
 
-def save_user_documents(username, selected_pdfs):
-    """사용자별 선택된 문서 목록 저장"""
-    try:
-        user_docs_file = f"users/{username}_documents.json"
-        os.makedirs("users", exist_ok=True)
-        
-        doc_data = {
-            "username": username,
-            "selected_documents": selected_pdfs,
-            "last_updated": datetime.datetime.now().isoformat(),
-            "document_count": len(selected_pdfs)
-        }
-        
-        with open(user_docs_file, 'w', encoding='utf-8') as f:
-            json.dump(doc_data, f, ensure_ascii=False, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"사용자 문서 저장 오류: {e}")
-        return False
+# 질의응답 체인 구성 (RAG)
+from langchain.chains import RetrievalQA
+try:
+    from langchain_openai import ChatOpenAI
+except ImportError:
+    from langchain.chat_models import ChatOpenAI
+import json
+import random
 
-def check_plan_limits(username, feature_type):
-    """플랜별 기능 제한 확인"""
+def create_qa_chain(vectorstore):
+    if not LANGCHAIN_AVAILABLE:
+        print("LangChain이 설치되지 않았습니다.")
+        return None
+    
+    if vectorstore is None:
+        print("벡터스토어가 없습니다.")
+        return None
+    
     try:
-        users_file = "users/users.json"
-        with open(users_file, 'r', encoding='utf-8') as f:
-            users = json.load(f)
-        
-        if username not in users:
-            return False, "사용자를 찾을 수 없습니다."
-        
-        user = users[username]
-        plan = user.get("plan", "free")
-        usage = user.get("usage_stats", {})
-        
-        # 무료 플랜 제한
-        if plan == "free":
-            if feature_type == "pdf_upload":
-                if usage.get("total_pdfs", 0) >= 10:  # 일일 10개 제한
-                    return False, "무료 플랜은 일일 10개 PDF 제한입니다."
-            elif feature_type == "quiz_generation":
-                if usage.get("total_quizzes", 0) >= 5:  # 일일 5개 제한
-                    return False, "무료 플랜은 일일 5개 퀴즈 제한입니다."
-            elif feature_type == "multi_document":
-                return False, "다중 문서 기능은 프리미엄 플랜이 필요합니다."
-            elif feature_type == "api_calls":
-                today = datetime.datetime.now().date().isoformat()
-                last_call = usage.get("last_api_call", "")
-                if last_call.startswith(today):
-                    if usage.get("api_calls_today", 0) >= 50:  # 일일 50회 제한
-                        return False, "무료 플랜은 일일 50회 API 호출 제한입니다."
-        
-        return True, "사용 가능"
+        # API 키 확인
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            print("OpenAI API 키가 설정되지 않았습니다.")
+            return None
+            
+        retriever = get_hybrid_retriever(vectorstore)
+        llm = ScheduledChatModel(feature="qa_chain", model_name="gpt-4o-mini", temperature=0)
+        chain = RetrievalQA.from_chain_type(llm=llm, retriever=retriever)
+        return chain
     except Exception as e:
-        print(f"플랜 제한 확인 오류: {e}")
-        return True, "확인 불가"
+        print(f"QA 체인 생성 중 오류: {str(e)}")
+        return None
 
-def update_user_activity(username, activity_type, data=None):
-    """사용자 활동 업데이트"""
+# 학습 이력 관리
+import datetime
+import json
+import hashlib
+
+# 🆕 코넬 노트 필기법 생성
+def generate_cornell_notes(text):
     try:
-        os.makedirs("users", exist_ok=True)
-        activity_file = f"users/{username}_activity.json"
-        
-        # 기존 활동 로드
-        try:
-            with open(activity_file, 'r', encoding='utf-8') as f:
-                activity = json.load(f)
-        except FileNotFoundError:
-            activity = {
-                "username": username,
-                "total_questions": 0,
-                "total_pdfs": 0,
-                "total_quizzes": 0,
-                "last_activity": None,
-                "activities": []
-            }
+        prompt = f"""
+        다음 텍스트를 코넬 노트 필기법 형식으로 정리해주세요.
+        코넬 노트는 3개 영역으로 구성됩니다:
         
-        # 활동 업데이트
-        if activity_type == "question_asked":
-            activity["total_questions"] += 1
-        elif activity_type == "pdf_processed":
-            activity["total_pdfs"] += 1
-        elif activity_type == "quiz_completed":
-            activity["total_quizzes"] += 1
+        1. 노트 영역 (Note-taking Area): 주요 내용과 세부사항
+        2. 단서 영역 (Cue Column): 핵심 키워드, 질문, 중요 포인트
+        3. 요약 영역 (Summary): 전체 내용의 핵심 요약
         
-        activity["last_activity"] = datetime.datetime.now().isoformat()
+        다음 형식으로 작성해주세요:
         
-        # 활동 기록 추가
-        activity["activities"].append({
-            "type": activity_type,
-            "timestamp": datetime.datetime.now().isoformat(),
-            "data": data
-        })
+        # 📝 코넬 노트
         
-        # 최근 50개 활동만 유지
-        if len(activity["activities"]) > 50:
-            activity["activities"] = activity["activities"][-50:]
-        
-        # 저장
-        with open(activity_file, 'w', encoding='utf-8') as f:
-            json.dump(activity, f, ensure_ascii=False, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"사용자 활동 업데이트 오류: {e}")
-        return False
-
-# 🆕 다중 문서 지원 기능
-def create_multi_vectorstore(texts_dict):
-    """여러 PDF의 텍스트로 통합 벡터스토어 생성"""
-    try:
-        splitter = CharacterTextSplitter(separator="\n", chunk_size=1000, chunk_overlap=200)
-        
-        all_chunks = []
-        metadata_list = []
-        
-        for pdf_name, text in texts_dict.items():
-            chunks = splitter.split_text(text)
-            all_chunks.extend(chunks)
-            
-            # 각 청크에 출처 정보 추가
-            for chunk in chunks:
-                metadata_list.append({"source": pdf_name})
-        
-        # HuggingFace 임베딩 모델 사용
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            model_kwargs={'device': 'cpu'}
-        )
-        
-        # 메타데이터와 함께 벡터스토어 생성
-        vectorstore = FAISS.from_texts(all_chunks, embeddings, metadatas=metadata_list)
-        
-        return vectorstore
-    except Exception as e:
-        print(f"다중 벡터스토어 생성 오류: {e}")
-        return None
-
-def save_user_documents(username, selected_pdfs):
-    """사용자별 선택된 문서 목록 저장"""
-    try:
-        user_docs_file = f"users/{username}_documents.json"
-        os.makedirs("users", exist_ok=True)
-        
-        doc_data = {
-            "username": username,
-            "selected_documents": selected_pdfs,
-            "last_updated": datetime.datetime.now().isoformat(),
-            "document_count": len(selected_pdfs)
-        }
+        ## 📋 노트 영역 (Note-taking Area)
+        ### 주제 1: [제목]
+        - [상세 내용]
+        - [예시나 설명]
+        - [중요한 개념]
         
-        with open(user_docs_file, 'w', encoding='utf-8') as f:
-            json.dump(doc_data, f, ensure_ascii=False, indent=2)
+        ### 주제 2: [제목]
+        - [상세 내용]
+        - [예시나 설명]
         
-        return True
-    except Exception as e:
-        print(f"사용자 문서 저장 오류: {e}")
-        return False
-
-def load_user_documents(username):
-    """사용자별 선택된 문서 목록 로드"""
-    try:
-        user_docs_file = f"users/{username}_documents.json"
-        with open(user_docs_file, 'r', encoding='utf-8') as f:
-            doc_data = json.load(f)
-        return doc_data.get("selected_documents", [])
-    except FileNotFoundError:
-        return []
-    except Exception as e:
-        print(f"사용자 문서 로드 오류: {e}")
-        return []
-
-def get_document_summary(pdf_name, text):
-    """문서별 간단한 요약 생성"""
-    try:
-        # 텍스트가 너무 길면 앞부분만 사용
-        preview_text = text[:1000] if len(text) > 1000 else text
+        ## 🔑 단서 영역 (Cue Column)
+        - **핵심 키워드**: [키워드1, 키워드2, ...]
+        - **중요 질문**: 
+          - [질문1]
+          - [질문2]
+        - **기억할 점**: [중요 포인트]
+        - **연관 개념**: [관련 개념들]
         
-        client = openai.OpenAI()
-        prompt = f"""
-        다음 문서의 핵심 내용을 2-3줄로 요약해주세요:
+        ## 📌 요약 영역 (Summary)
+        [전체 내용을 2-3문장으로 핵심 요약]
         
-        문서명: {pdf_name}
-        내용: {preview_text}
+        텍스트:
+        {fit_prompt_context(text, max_tokens=2000)}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "cornell_notes",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
-            max_tokens=200,
+            max_tokens=2000,
             temperature=0.3
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
-        return f"요약 생성 실패: {str(e)}"
+        return f"코넬 노트 생성 중 오류가 발생했습니다: {str(e)}"
 
-def create_cross_document_qa_chain(vectorstore):
-    """다중 문서 질의응답 체인 생성"""
-    try:
-        if vectorstore is None:
-            print("벡터스토어가 없습니다.")
-            return None
+# 🆕 코넬 노트 HTML 템플릿 생성 (인쇄용)
+def generate_cornell_notes_html(cornell_content, title="학습 노트"):
+    html_template = f"""
+    <!DOCTYPE html>
+    <html lang="ko">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>{title} - 코넬 노트</title>
+        <style>
+            body {{
+                font-family: 'Malgun Gothic', Arial, sans-serif;
+                margin: 20px;
+                line-height: 1.6;
+                color: #333;
+            }}
+            .cornell-container {{
+                max-width: 800px;
+                margin: 0 auto;
+                border: 2px solid #333;
+                min-height: 600px;
+            }}
+            .header {{
+                border-bottom: 2px solid #333;
+                padding: 10px;
+                background-color: #f8f9fa;
+                text-align: center;
+            }}
+            .main-content {{
+                display: flex;
+                min-height: 500px;
+            }}
+            .cue-column {{
+                width: 30%;
+                border-right: 2px solid #333;
+                padding: 15px;
+                background-color: #fff8dc;
+            }}
+            .note-area {{
+                width: 70%;
+                padding: 15px;
+                background-color: white;
+            }}
+            .summary-area {{
+                border-top: 2px solid #333;
+                padding: 15px;
+                background-color: #f0f8ff;
+                min-height: 80px;
+            }}
+            h1, h2, h3 {{
+                color: #2c3e50;
+                margin-top: 0;
+            }}
+            .cue-column h3 {{
+                color: #e74c3c;
+                font-size: 14px;
+                margin-bottom: 8px;
+            }}
+            .note-area h3 {{
+                color: #3498db;
+                border-bottom: 1px solid #3498db;
+                padding-bottom: 5px;
+            }}
+            ul, ol {{
+                margin: 10px 0;
+                padding-left: 20px;
+            }}
+            .keyword {{
+                background-color: #fff3cd;
+                padding: 2px 6px;
+                border-radius: 3px;
+                font-weight: bold;
+            }}
+            .question {{
+                color: #dc3545;
+                font-style: italic;
+            }}
+            @media print {{
+                body {{ margin: 0; }}
+                .cornell-container {{ border: 1px solid #000; }}
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="cornell-container">
+            <div class="header">
+                <h1>📝 {title}</h1>
+                <p>날짜: ___________  과목: ___________</p>
+            </div>
             
-        # API 키 확인
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            print("OpenAI API 키가 설정되지 않았습니다.")
-            return None
+            <div class="main-content">
+                <div class="cue-column">
+                    <h2>🔑 단서</h2>
+                    <div id="cue-content">
+                        <!-- 단서 내용이 여기에 들어갑니다 -->
+                    </div>
+                </div>
+                
+                <div class="note-area">
+                    <h2>📋 노트</h2>
+                    <div id="note-content">
+                        <!-- 노트 내용이 여기에 들어갑니다 -->
+                    </div>
+                </div>
+            </div>
             
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 5})  # 더 많은 문서에서 검색
-        
-        # 최신 모델 사용
-        try:
-            from langchain_openai import ChatOpenAI
-        except ImportError:
-            from langchain.chat_models import ChatOpenAI
-        
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, api_key=api_key)
-        
-        # 커스텀 프롬프트로 출처 정보 포함
-        from langchain.chains import RetrievalQA
-        from langchain.prompts import PromptTemplate
-        
-        template = """
-        다음 문서들의 내용을 바탕으로 질문에 답변해주세요. 
-        답변 시 어떤 문서에서 정보를 가져왔는지 출처를 명시해주세요.
-        
-        관련 문서 내용:
-        {context}
-        
-        질문: {question}
-        
-        답변 (출처 포함):
-        """
-        
-        prompt = PromptTemplate(
-            template=template,
-            input_variables=["context", "question"]
-        )
-        
-        chain = RetrievalQA.from_chain_type(
-            llm=llm, 
-            retriever=retriever,
-            chain_type_kwargs={"prompt": prompt}
-        )
+            <div class="summary-area">
+                <h2>📌 요약</h2>
+                <div id="summary-content">
+                    <!-- 요약 내용이 여기에 들어갑니다 -->
+                </div>
+            </div>
+        </div>
         
-        return chain
-    except Exception as e:
-        print(f"다중 문서 QA 체인 생성 오류: {e}")
-        return None
-
-# 질의응답 체인 구성 (RAG)
-from langchain.chains import RetrievalQA
-try:
-    from langchain_openai import ChatOpenAI
-except ImportError:
-    from langchain.chat_models import ChatOpenAI
-import json
-import random
-
-def create_qa_chain(vectorstore):
-    if not LANGCHAIN_AVAILABLE:
-        print("LangChain이 설치되지 않았습니다.")
-        return None
-    
-    if vectorstore is None:
-        print("벡터스토어가 없습니다.")
-        return None
-    
-    try:
-        # API 키 확인
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            print("OpenAI API 키가 설정되지 않았습니다.")
-            return None
-            
-        retriever = vectorstore.as_retriever()
-        
-        # 최신 모델 사용
-        try:
-            from langchain_openai import ChatOpenAI
-        except ImportError:
-            from langchain.chat_models import ChatOpenAI
-        
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, api_key=api_key)
-        chain = RetrievalQA.from_chain_type(llm=llm, retriever=retriever)
-        return chain
-    except Exception as e:
-        print(f"QA 체인 생성 중 오류: {str(e)}")
-        return None
-
-# 텍스트 요약 기능
-def summarize_text(text, max_length=500):
-    try:
-        client = get_openai_client()
-        
-        prompt = f"""
-        다음 텍스트를 {max_length}자 이내로 요약해주세요. 
-        주요 개념과 핵심 내용을 포함하여 학습에 도움이 되도록 요약해주세요.
-        
-        텍스트:
-        {text[:3000]}  # 너무 긴 텍스트는 잘라서 처리
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=800,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"요약 생성 중 오류가 발생했습니다: {str(e)}"
-
-# 퀴즈 생성 기능
-def generate_quiz(text, num_questions=5):
-    try:
-        client = get_openai_client()
-        
-        prompt = f"""
-        다음 텍스트를 바탕으로 {num_questions}개의 객관식 퀴즈를 생성해주세요.
-        각 문제는 4개의 선택지를 가지고, 정답은 1개입니다.
-        
-        형식:
-        Q1: [질문]
-        1) [선택지1]
-        2) [선택지2] 
-        3) [선택지3]
-        4) [선택지4]
-        정답: [번호]
-        해설: [간단한 설명]
-        
-        텍스트:
-        {text[:2000]}
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1500,
-            temperature=0.5
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"퀴즈 생성 중 오류가 발생했습니다: {str(e)}"
-
-# 학습 이력 관리
-import datetime
-import json
-import hashlib
-
-def save_study_history(question, answer, filename="study_history.json"):
-    try:
-        # 기존 이력 로드
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-        except FileNotFoundError:
-            history = []
-        
-        # 새 기록 추가
-        new_record = {
-            "timestamp": datetime.datetime.now().isoformat(),
-            "question": question,
-            "answer": answer[:200] + "..." if len(answer) > 200 else answer
-        }
-        
-        history.append(new_record)
-        
-        # 최근 50개만 유지
-        if len(history) > 50:
-            history = history[-50:]
-        
-        # 저장
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-            
-        return True
-    except Exception as e:
-        print(f"이력 저장 오류: {e}")
-        return False
-
-def load_study_history(filename="study_history.json"):
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
-    except Exception as e:
-        print(f"이력 로드 오류: {e}")
-        return []
-
-# 🆕 단답형 퀴즈 생성 기능
-def generate_short_answer_quiz(text, num_questions=5):
-    try:
-        client = get_openai_client()
-        
-        prompt = f"""
-        다음 텍스트를 바탕으로 {num_questions}개의 단답형 퀴즈를 생성해주세요.
-        각 문제는 간단한 단어나 구문으로 답할 수 있어야 합니다.
-        
-        형식:
-        Q1: [질문]
-        정답: [단답]
-        해설: [간단한 설명]
-        
-        텍스트:
-        {text[:2000]}
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1200,
-            temperature=0.5
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"단답형 퀴즈 생성 중 오류가 발생했습니다: {str(e)}"
-
-# 🆕 챕터별 분석 및 요약
-def analyze_chapters(text):
-    try:
-        client = openai.OpenAI()
-        
-        prompt = f"""
-        다음 텍스트를 분석하여 챕터나 주제별로 나누고, 각 부분의 핵심 내용을 요약해주세요.
-        
-        형식:
-        ## 챕터 1: [제목]
-        - 핵심 내용: [요약]
-        - 중요 키워드: [키워드들]
-        - 학습 포인트: [학습해야 할 점]
-        
-        텍스트:
-        {text[:4000]}
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=2000,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"챕터 분석 중 오류가 발생했습니다: {str(e)}"
-
-# 🆕 학습 노트 자동 생성
-def generate_study_notes(text, style="bullet"):
-    try:
-        client = openai.OpenAI()
-        
-        if style == "bullet":
-            format_instruction = "불릿 포인트 형식으로 정리"
-        elif style == "outline":
-            format_instruction = "아웃라인 형식으로 정리"
-        else:
-            format_instruction = "마인드맵 형식으로 정리"
-        
-        prompt = f"""
-        다음 텍스트를 학습 노트로 {format_instruction}해주세요.
-        학생이 복습하기 쉽도록 핵심 개념, 정의, 예시를 포함해주세요.
-        
-        텍스트:
-        {text[:3000]}
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1500,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"학습 노트 생성 중 오류가 발생했습니다: {str(e)}"
-
-# 🆕 학습 진행률 계산
-def calculate_progress(history, total_chapters=10):
-    if not history:
-        return 0, {}
-    
-    # 질문 키워드 분석으로 학습 영역 파악
-    topics = {}
-    for record in history:
-        question = record['question'].lower()
-        # 간단한 키워드 매칭으로 주제 분류
-        if any(word in question for word in ['1장', '첫번째', '처음', 'chapter 1']):
-            topics['Chapter 1'] = topics.get('Chapter 1', 0) + 1
-        elif any(word in question for word in ['2장', '두번째', 'chapter 2']):
-            topics['Chapter 2'] = topics.get('Chapter 2', 0) + 1
-        # ... 더 많은 챕터 매칭 로직
-    
-    progress_percentage = min(len(topics) / total_chapters * 100, 100)
-    return progress_percentage, topics
-
-# 🆕 TTS 기능 (gTTS 사용)
-def text_to_speech(text, lang='ko'):
-    try:
-        from gtts import gTTS
-        import io
-        
-        # 텍스트가 너무 길면 요약
-        if len(text) > 1000:
-            text = text[:1000] + "..."
-        
-        tts = gTTS(text=text, lang=lang, slow=False)
-        
-        # 메모리에 저장
-        audio_buffer = io.BytesIO()
-        tts.write_to_fp(audio_buffer)
-        audio_buffer.seek(0)
-        
-        return audio_buffer.getvalue()
-    except Exception as e:
-        return None
-
-# 🆕 코넬 노트 필기법 생성
-def generate_cornell_notes(text):
-    try:
-        client = openai.OpenAI()
-        
-        prompt = f"""
-        다음 텍스트를 코넬 노트 필기법 형식으로 정리해주세요.
-        코넬 노트는 3개 영역으로 구성됩니다:
-        
-        1. 노트 영역 (Note-taking Area): 주요 내용과 세부사항
-        2. 단서 영역 (Cue Column): 핵심 키워드, 질문, 중요 포인트
-        3. 요약 영역 (Summary): 전체 내용의 핵심 요약
-        
-        다음 형식으로 작성해주세요:
-        
-        # 📝 코넬 노트
-        
-        ## 📋 노트 영역 (Note-taking Area)
-        ### 주제 1: [제목]
-        - [상세 내용]
-        - [예시나 설명]
-        - [중요한 개념]
-        
-        ### 주제 2: [제목]
-        - [상세 내용]
-        - [예시나 설명]
-        
-        ## 🔑 단서 영역 (Cue Column)
-        - **핵심 키워드**: [키워드1, 키워드2, ...]
-        - **중요 질문**: 
-          - [질문1]
-          - [질문2]
-        - **기억할 점**: [중요 포인트]
-        - **연관 개념**: [관련 개념들]
-        
-        ## 📌 요약 영역 (Summary)
-        [전체 내용을 2-3문장으로 핵심 요약]
-        
-        텍스트:
-        {text[:3500]}
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=2000,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"코넬 노트 생성 중 오류가 발생했습니다: {str(e)}"
-
-# 🆕 개선된 코넬 노트 생성 함수
-def generate_cornell_notes_advanced(text, style="standard", include_questions=True):
-    """
-    코넬 노트 필기법에 따른 고급 노트 생성
-    - style: standard, detailed, exam_focused
-    - include_questions: 복습 질문 포함 여부
-    """
-    try:
-        client = openai.OpenAI()
-        
-        # 스타일별 프롬프트 설정
-        style_instructions = {
-            "standard": "균형잡힌 구성으로 핵심 내용과 세부사항을 적절히 포함",
-            "detailed": "상세한 설명과 예시를 중심으로 깊이 있는 내용 구성",
-            "exam_focused": "시험에 나올 만한 핵심 개념과 중요 포인트 중심으로 구성"
-        }
-        
-        questions_instruction = """
-        - **복습 질문**: 
-          - [내용을 이해했는지 확인하는 질문]
-          - [응용 문제나 사고 질문]
-          - [연관 개념과의 관계를 묻는 질문]
-        """ if include_questions else ""
-        
-        prompt = f"""
-        다음 텍스트를 코넬 노트 필기법(Cornell Note-Taking System)에 따라 정리해주세요.
-        
-        **작성 스타일**: {style_instructions[style]}
-        
-        **코넬 노트 구성 원칙**:
-        1. 노트 영역(60%): 강의/읽기 중 기록하는 주요 내용
-        2. 단서 영역(20%): 복습 시 사용할 키워드와 힌트
-        3. 요약 영역(20%): 전체 내용의 핵심 요약
-        
-        **출력 형식**:
-        
-        # 📝 코넬 노트 - [주제명]
-        
-        ---
-        
-        ## 📋 노트 영역 (Note-taking Area)
-        
-        ### 1. [주요 주제 1]
-        - **정의**: [핵심 개념 정의]
-        - **특징**: [주요 특징들]
-        - **예시**: [구체적 예시]
-        - **중요사항**: [기억해야 할 점]
-        
-        ### 2. [주요 주제 2]
-        - **개념**: [핵심 개념]
-        - **원리**: [작동 원리나 과정]
-        - **응용**: [실제 적용 사례]
-        
-        ### 3. [주요 주제 3]
-        - **내용**: [상세 내용]
-        - **관련성**: [다른 개념과의 연관성]
-        
-        ---
-        
-        ## 🔑 단서 영역 (Cue Column)
-        
-        **핵심 키워드**: [키워드1], [키워드2], [키워드3]
-        
-        **기억 단서**: 
-        - [기억하기 쉬운 단서나 연상법]
-        - [중요한 공식이나 법칙]
-        
-        **중요 포인트**: 
-        - [시험에 나올 만한 내용]
-        - [반드시 기억해야 할 사실]
-        
-        {questions_instruction}
-        
-        ---
-        
-        ## 📌 요약 영역 (Summary)
-        
-        [전체 내용을 2-3문장으로 핵심만 간결하게 요약. 나중에 빠른 복습용으로 사용할 수 있도록 가장 중요한 내용만 포함]
-        
-        ---
-        
-        텍스트:
-        {text[:4000]}
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=2500,
-            temperature=0.2
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"코넬 노트 생성 중 오류가 발생했습니다: {str(e)}"
-
-# 🆕 코넬 노트 HTML 템플릿 생성 (인쇄용)
-def generate_cornell_notes_html(cornell_content, title="학습 노트"):
-    html_template = f"""
-    <!DOCTYPE html>
-    <html lang="ko">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>{title} - 코넬 노트</title>
-        <style>
-            body {{
-                font-family: 'Malgun Gothic', Arial, sans-serif;
-                margin: 20px;
-                line-height: 1.6;
-                color: #333;
-            }}
-            .cornell-container {{
-                max-width: 800px;
-                margin: 0 auto;
-                border: 2px solid #333;
-                min-height: 600px;
-            }}
-            .header {{
-                border-bottom: 2px solid #333;
-                padding: 10px;
-                background-color: #f8f9fa;
-                text-align: center;
-            }}
-            .main-content {{
-                display: flex;
-                min-height: 500px;
-            }}
-            .cue-column {{
-                width: 30%;
-                border-right: 2px solid #333;
-                padding: 15px;
-                background-color: #fff8dc;
-            }}
-            .note-area {{
-                width: 70%;
-                padding: 15px;
-                background-color: white;
-            }}
-            .summary-area {{
-                border-top: 2px solid #333;
-                padding: 15px;
-                background-color: #f0f8ff;
-                min-height: 80px;
-            }}
-            h1, h2, h3 {{
-                color: #2c3e50;
-                margin-top: 0;
-            }}
-            .cue-column h3 {{
-                color: #e74c3c;
-                font-size: 14px;
-                margin-bottom: 8px;
-            }}
-            .note-area h3 {{
-                color: #3498db;
-                border-bottom: 1px solid #3498db;
-                padding-bottom: 5px;
-            }}
-            ul, ol {{
-                margin: 10px 0;
-                padding-left: 20px;
-            }}
-            .keyword {{
-                background-color: #fff3cd;
-                padding: 2px 6px;
-                border-radius: 3px;
-                font-weight: bold;
-            }}
-            .question {{
-                color: #dc3545;
-                font-style: italic;
-            }}
-            @media print {{
-                body {{ margin: 0; }}
-                .cornell-container {{ border: 1px solid #000; }}
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="cornell-container">
-            <div class="header">
-                <h1>📝 {title}</h1>
-                <p>날짜: ___________  과목: ___________</p>
-            </div>
-            
-            <div class="main-content">
-                <div class="cue-column">
-                    <h2>🔑 단서</h2>
-                    <div id="cue-content">
-                        <!-- 단서 내용이 여기에 들어갑니다 -->
-                    </div>
-                </div>
-                
-                <div class="note-area">
-                    <h2>📋 노트</h2>
-                    <div id="note-content">
-                        <!-- 노트 내용이 여기에 들어갑니다 -->
-                    </div>
-                </div>
-            </div>
-            
-            <div class="summary-area">
-                <h2>📌 요약</h2>
-                <div id="summary-content">
-                    <!-- 요약 내용이 여기에 들어갑니다 -->
-                </div>
-            </div>
-        </div>
-        
-        <script>
-            // 마크다운 내용을 파싱하여 적절한 영역에 배치
-            const content = `{cornell_content}`;
-            
-            // 간단한 마크다운 파싱
-            function parseContent(content) {{
-                const lines = content.split('\\n');
-                let currentSection = '';
-                let noteContent = '';
-                let cueContent = '';
-                let summaryContent = '';
-                
-                for (let line of lines) {{
-                    if (line.includes('노트 영역') || line.includes('Note-taking Area')) {{
-                        currentSection = 'note';
-                    }} else if (line.includes('단서 영역') || line.includes('Cue Column')) {{
-                        currentSection = 'cue';
-                    }} else if (line.includes('요약 영역') || line.includes('Summary')) {{
-                        currentSection = 'summary';
-                    }} else if (line.trim() && !line.startsWith('#')) {{
-                        if (currentSection === 'note') {{
-                            noteContent += line + '<br>';
-                        }} else if (currentSection === 'cue') {{
-                            cueContent += line + '<br>';
-                        }} else if (currentSection === 'summary') {{
-                            summaryContent += line + '<br>';
-                        }}
-                    }}
-                }}
-                
-                document.getElementById('note-content').innerHTML = noteContent;
-                document.getElementById('cue-content').innerHTML = cueContent;
-                document.getElementById('summary-content').innerHTML = summaryContent;
-            }}
-            
-            parseContent(content);
-        </script>
-    </body>
-    </html>
-    """
-    
-    return html_template
-
-# 🆕 개선된 코넬 노트 HTML 생성
-def generate_cornell_notes_html_advanced(cornell_content, title="코넬 노트"):
-    """실제 코넬 노트 형식에 맞는 HTML 생성"""
-    
-    # 내용 파싱
-    sections = {'notes': '', 'cue': '', 'summary': ''}
-    lines = cornell_content.split('\n')
-    current_section = None
-    
-    for line in lines:
-        if '노트 영역' in line or 'Note-taking Area' in line:
-            current_section = 'notes'
-        elif '단서 영역' in line or 'Cue Column' in line:
-            current_section = 'cue'
-        elif '요약 영역' in line or 'Summary' in line:
-            current_section = 'summary'
-        elif current_section and line.strip() and not line.startswith('#') and not line.startswith('---'):
-            sections[current_section] += line + '\n'
-    
-    # HTML 템플릿
-    html_template = f"""
-    <!DOCTYPE html>
-    <html lang="ko">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>{title}</title>
-        <style>
-            @page {{
-                size: A4;
-                margin: 1cm;
-            }}
-            
-            body {{
-                font-family: 'Malgun Gothic', Arial, sans-serif;
-                margin: 0;
-                padding: 0;
-                line-height: 1.6;
-                color: #333;
-            }}
-            
-            .cornell-container {{
-                width: 100%;
-                height: 100vh;
-                border: 3px solid #000;
-                display: flex;
-                flex-direction: column;
-            }}
-            
-            .cornell-header {{
-                background-color: #f8f9fa;
-                border-bottom: 2px solid #000;
-                padding: 15px;
-                text-align: center;
-            }}
-            
-            .cornell-main {{
-                display: flex;
-                flex: 1;
-            }}
-            
-            .cornell-cue {{
-                width: 25%;
-                border-right: 2px solid #000;
-                padding: 15px;
-                background-color: #fff8dc;
-                font-size: 0.9rem;
-            }}
-            
-            .cornell-notes {{
-                width: 75%;
-                padding: 15px;
-                background-color: white;
-            }}
-            
-            .cornell-summary {{
-                border-top: 2px solid #000;
-                padding: 15px;
-                background-color: #e7f3ff;
-                min-height: 100px;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="cornell-container">
-            <div class="cornell-header">
-                <h1>📝 {title}</h1>
-                <div>생성일: {datetime.datetime.now().strftime('%Y년 %m월 %d일')}</div>
-            </div>
-            
-            <div class="cornell-main">
-                <div class="cornell-cue">
-                    <h3>🔑 단서 영역</h3>
-                    <div>{sections['cue']}</div>
-                </div>
-                
-                <div class="cornell-notes">
-                    <h3>📋 노트 영역</h3>
-                    <div>{sections['notes']}</div>
-                </div>
-            </div>
-            
-            <div class="cornell-summary">
-                <h3>📌 요약 영역</h3>
-                <div>{sections['summary']}</div>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    
-    return html_template
-
-# 🆕 플래시카드 생성 기능
-def generate_flashcards(text, num_cards=10):
-    try:
-        # 텍스트 유효성 검사
-        if not text or len(text.strip()) < 100:
-            return "플래시카드를 생성하기에 텍스트가 너무 짧습니다. 더 많은 내용이 필요합니다."
-        
-        # API 키 확인
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            return "OpenAI API 키가 설정되지 않았습니다."
-        
-        client = openai.OpenAI(api_key=api_key)
-        
-        # 텍스트 길이 제한 (안전하게)
-        safe_text = text[:3000] if len(text) > 3000 else text
-        
-        prompt = f"""
-        다음 텍스트를 바탕으로 {num_cards}개의 학습 플래시카드를 생성해주세요.
-        각 카드는 앞면(질문/개념)과 뒷면(답변/설명)으로 구성됩니다.
-        
-        형식:
-        카드 1:
-        앞면: [핵심 개념이나 질문]
-        뒷면: [상세한 설명이나 답변]
-        
-        카드 2:
-        앞면: [핵심 개념이나 질문]
-        뒷면: [상세한 설명이나 답변]
-        
-        플래시카드는 다음과 같은 유형으로 만들어주세요:
-        - 정의 암기 (개념 → 정의)
-        - 공식 암기 (공식명 → 공식)
-        - 예시 문제 (문제 → 해답)
-        - 핵심 키워드 (키워드 → 설명)
-        
-        텍스트:
-        {safe_text}
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=2000,
-            temperature=0.4
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"플래시카드 생성 중 오류가 발생했습니다: {str(e)}"
-
-# 🆕 직접 답변 생성 (체인 실패 시 대안)
-def generate_direct_answer(text, question):
-    """벡터스토어 없이 직접 텍스트 기반 답변 생성"""
-    try:
-        client = get_openai_client()
-        
-        # 텍스트가 너무 길면 관련 부분만 추출
-        relevant_text = text[:4000] if len(text) > 4000 else text
-        
-        prompt = f"""
-        다음 텍스트를 바탕으로 질문에 답변해주세요.
-        
-        텍스트:
-        {relevant_text}
-        
-        질문: {question}
-        
-        답변:
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1000,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"답변 생성 중 오류가 발생했습니다: {str(e)}"
-
-# 🆕 간단한 답변 생성 (최종 대안)
-def generate_simple_answer(text, question):
-    """가장 기본적인 텍스트 매칭 기반 답변"""
-    try:
-        # 질문에서 키워드 추출
-        question_lower = question.lower()
-        text_lower = text.lower()
-        
-        # 간단한 키워드 매칭
-        keywords = [word for word in question_lower.split() if len(word) > 2]
-        
-        # 관련 문장 찾기
-        sentences = text.split('.')
-        relevant_sentences = []
-        
-        for sentence in sentences:
-            sentence_lower = sentence.lower()
-            if any(keyword in sentence_lower for keyword in keywords):
-                relevant_sentences.append(sentence.strip())
-                if len(relevant_sentences) >= 3:  # 최대 3개 문장
-                    break
-        
-        if relevant_sentences:
-            return " ".join(relevant_sentences)
-        else:
-            return "죄송합니다. 해당 질문에 대한 관련 정보를 찾을 수 없습니다. 다른 질문을 시도해보세요."
-    
-    except Exception as e:
-        return f"기본 답변 생성 실패: {str(e)}"
-
-# 🆕 사용자별 학습 이력 관리
-def save_user_study_history(username, question, answer, topic="일반"):
-    """사용자별 학습 이력 저장"""
-    try:
-        os.makedirs("users", exist_ok=True)
-        history_file = f"users/{username}_history.json"
-        
-        # 기존 이력 로드
-        try:
-            with open(history_file, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-        except FileNotFoundError:
-            history = []
-        
-        # 새 기록 추가
-        new_record = {
-            "timestamp": datetime.datetime.now().isoformat(),
-            "question": question,
-            "answer": answer[:300] + "..." if len(answer) > 300 else answer,
-            "topic": topic
-        }
-        
-        history.append(new_record)
-        
-        # 최근 100개만 유지
-        if len(history) > 100:
-            history = history[-100:]
-        
-        # 저장
-        with open(history_file, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"사용자 이력 저장 오류: {e}")
-        return False
-
-def load_user_study_history(username):
-    """사용자별 학습 이력 로드"""
-    try:
-        history_file = f"users/{username}_history.json"
-        with open(history_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
-    except Exception as e:
-        print(f"사용자 이력 로드 오류: {e}")
-        return []
-
-def update_user_activity(username, activity_type, data=None):
-    """사용자 활동 업데이트"""
-    try:
-        os.makedirs("users", exist_ok=True)
-        activity_file = f"users/{username}_activity.json"
-        
-        # 기존 활동 로드
-        try:
-            with open(activity_file, 'r', encoding='utf-8') as f:
-                activity = json.load(f)
-        except FileNotFoundError:
-            activity = {
-                "username": username,
-                "total_questions": 0,
-                "total_pdfs": 0,
-                "total_quizzes": 0,
-                "last_activity": None,
-                "activities": []
-            }
-        
-        # 활동 업데이트
-        if activity_type == "question_asked":
-            activity["total_questions"] += 1
-        elif activity_type == "pdf_processed":
-            activity["total_pdfs"] += 1
-        elif activity_type == "quiz_completed":
-            activity["total_quizzes"] += 1
-        
-        activity["last_activity"] = datetime.datetime.now().isoformat()
-        
-        # 활동 기록 추가
-        activity["activities"].append({
-            "type": activity_type,
-            "timestamp": datetime.datetime.now().isoformat(),
-            "data": data
-        })
-        
-        # 최근 50개 활동만 유지
-        if len(activity["activities"]) > 50:
-            activity["activities"] = activity["activities"][-50:]
-        
-        # 저장
-        with open(activity_file, 'w', encoding='utf-8') as f:
-            json.dump(activity, f, ensure_ascii=False, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"사용자 활동 업데이트 오류: {e}")
-        return False
-
-def calculate_user_progress(history, username):
-    """사용자별 학습 진행률 계산"""
-    if not history:
-        return 0, {}, {}
-    
-    # 주제별 질문 수 계산
-    topics = {}
-    for record in history:
-        topic = record.get('topic', '일반')
-        topics[topic] = topics.get(topic, 0) + 1
-    
-    # 진행률 계산 (질문 수 기반)
-    total_questions = len(history)
-    progress_percentage = min(total_questions * 2, 100)  # 50개 질문 = 100%
-    
-    # 학습 패턴 분석
-    study_patterns = {
-        "most_active_topic": max(topics.items(), key=lambda x: x[1])[0] if topics else "없음",
-        "total_topics": len(topics),
-        "avg_questions_per_topic": total_questions / len(topics) if topics else 0
-    }
-    
-    return progress_percentage, topics, study_patterns
-
-def check_plan_limits(username, feature_type):
-    """플랜별 기능 제한 확인"""
-    # 기본적으로 모든 기능 허용 (실제 구현에서는 사용자 플랜 확인)
-    return True, "사용 가능"
-
-def generate_learning_recommendations(username, history):
-    """학습 추천 생성"""
-    try:
-        if not history:
-            return "아직 학습 이력이 없습니다. 질문을 시작해보세요!"
-        
-        # 최근 질문 분석
-        recent_questions = [record['question'] for record in history[-5:]]
-        
-        client = openai.OpenAI()
-        prompt = f"""
-        다음 최근 질문들을 분석하여 학습자에게 맞춤 추천을 해주세요:
-        
-        최근 질문들:
-        {chr(10).join(recent_questions)}
-        
-        다음 형식으로 추천해주세요:
-        1. 학습 패턴 분석
-        2. 추천 학습 주제
-        3. 다음 단계 제안
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=500,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"추천 생성 실패: {str(e)}"
-
-# 🆕 사용자 관리 시스템
-def hash_password(password):
-    """비밀번호 해시화"""
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def create_user(username, password, plan="free"):
-    """새 사용자 생성"""
-    try:
-        os.makedirs("users", exist_ok=True)
-        users_file = "users/users.json"
-        
-        # 기존 사용자 목록 로드
-        try:
-            with open(users_file, 'r', encoding='utf-8') as f:
-                users = json.load(f)
-        except FileNotFoundError:
-            users = {}
-        
-        # 사용자명 중복 확인
-        if username in users:
-            return False
-        
-        # 새 사용자 추가
-        users[username] = {
-            "username": username,
-            "password": hash_password(password),
-            "plan": plan,
-            "created_at": datetime.datetime.now().isoformat(),
-            "last_login": None,
-            "usage_stats": {
-                "total_questions": 0,
-                "total_pdfs": 0,
-                "total_quizzes": 0,
-                "api_calls_today": 0,
-                "last_api_call": None
-            }
-        }
-        
-        # 저장
-        with open(users_file, 'w', encoding='utf-8') as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"사용자 생성 오류: {e}")
-        return False
-
-def authenticate_user(username, password):
-    """사용자 인증"""
-    try:
-        users_file = "users/users.json"
-        with open(users_file, 'r', encoding='utf-8') as f:
-            users = json.load(f)
-        
-        if username in users:
-            stored_password = users[username]["password"]
-            if stored_password == hash_password(password):
-                # 로그인 시간 업데이트
-                users[username]["last_login"] = datetime.datetime.now().isoformat()
+        <script>
+            // 마크다운 내용을 파싱하여 적절한 영역에 배치
+            const content = `{cornell_content}`;
+            
+            // 간단한 마크다운 파싱
+            function parseContent(content) {{
+                const lines = content.split('\\n');
+                let currentSection = '';
+                let noteContent = '';
+                let cueContent = '';
+                let summaryContent = '';
                 
-                with open(users_file, 'w', encoding='utf-8') as f:
-                    json.dump(users, f, ensure_ascii=False, indent=2)
+                for (let line of lines) {{
+                    if (line.includes('노트 영역') || line.includes('Note-taking Area')) {{
+                        currentSection = 'note';
+                    }} else if (line.includes('단서 영역') || line.includes('Cue Column')) {{
+                        currentSection = 'cue';
+                    }} else if (line.includes('요약 영역') || line.includes('Summary')) {{
+                        currentSection = 'summary';
+                    }} else if (line.trim() && !line.startsWith('#')) {{
+                        if (currentSection === 'note') {{
+                            noteContent += line + '<br>';
+                        }} else if (currentSection === 'cue') {{
+                            cueContent += line + '<br>';
+                        }} else if (currentSection === 'summary') {{
+                            summaryContent += line + '<br>';
+                        }}
+                    }}
+                }}
                 
-                return users[username]
-        
-        return None
-    except FileNotFoundError:
-        return None
-    except Exception as e:
-        print(f"인증 오류: {e}")
-        return None
-
-def check_plan_limits(username, feature_type):
-    """플랜별 기능 제한 확인"""
-    try:
-        users_file = "users/users.json"
-        with open(users_file, 'r', encoding='utf-8') as f:
-            users = json.load(f)
-        
-        if username not in users:
-            return False, "사용자를 찾을 수 없습니다."
-        
-        user = users[username]
-        plan = user.get("plan", "free")
-        usage = user.get("usage_stats", {})
-        
-        # 무료 플랜 제한
-        if plan == "free":
-            if feature_type == "pdf_upload":
-                if usage.get("total_pdfs", 0) >= 10:  # 일일 10개 제한
-                    return False, "무료 플랜은 일일 10개 PDF 제한입니다."
-            elif feature_type == "quiz_generation":
-                if usage.get("total_quizzes", 0) >= 5:  # 일일 5개 제한
-                    return False, "무료 플랜은 일일 5개 퀴즈 제한입니다."
-            elif feature_type == "multi_document":
-                return False, "다중 문서 기능은 프리미엄 플랜이 필요합니다."
-            elif feature_type == "api_calls":
-                today = datetime.datetime.now().date().isoformat()
-                last_call = usage.get("last_api_call", "")
-                if last_call.startswith(today):
-                    if usage.get("api_calls_today", 0) >= 50:  # 일일 50회 제한
-                        return False, "무료 플랜은 일일 50회 API 호출 제한입니다."
-        
-        return True, "사용 가능"
-    except Exception as e:
-        print(f"플랜 제한 확인 오류: {e}")
-        return True, "확인 불가"
-
-def update_user_usage(username, feature_type):
-    """사용자 사용량 업데이트"""
-    try:
-        users_file = "users/users.json"
-        with open(users_file, 'r', encoding='utf-8') as f:
-            users = json.load(f)
-        
-        if username in users:
-            usage = users[username].get("usage_stats", {})
-            today = datetime.datetime.now().date().isoformat()
-            
-            # API 호출 카운트 업데이트
-            last_call = usage.get("last_api_call", "")
-            if last_call.startswith(today):
-                usage["api_calls_today"] = usage.get("api_calls_today", 0) + 1
-            else:
-                usage["api_calls_today"] = 1
-            
-            usage["last_api_call"] = datetime.datetime.now().isoformat()
-            
-            # 기능별 카운트 업데이트
-            if feature_type == "pdf_upload":
-                usage["total_pdfs"] = usage.get("total_pdfs", 0) + 1
-            elif feature_type == "quiz_generation":
-                usage["total_quizzes"] = usage.get("total_quizzes", 0) + 1
-            elif feature_type == "question_asked":
-                usage["total_questions"] = usage.get("total_questions", 0) + 1
-            
-            users[username]["usage_stats"] = usage
-            
-            with open(users_file, 'w', encoding='utf-8') as f:
-                json.dump(users, f, ensure_ascii=False, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"사용량 업데이트 오류: {e}")
-        return False
-
-# 🆕 챗 기록 관리
-def save_chat_message(username, message, response, message_type="qa"):
-    """챗 메시지 저장"""
-    try:
-        os.makedirs("users", exist_ok=True)
-        chat_file = f"users/{username}_chat.json"
-        
-        # 기존 챗 기록 로드
-        try:
-            with open(chat_file, 'r', encoding='utf-8') as f:
-                chat_history = json.load(f)
-        except FileNotFoundError:
-            chat_history = []
-        
-        # 새 메시지 추가
-        new_message = {
-            "timestamp": datetime.datetime.now().isoformat(),
-            "message": message,
-            "response": response[:500] + "..." if len(response) > 500 else response,
-            "type": message_type
-        }
-        
-        chat_history.append(new_message)
-        
-        # 최근 100개만 유지
-        if len(chat_history) > 100:
-            chat_history = chat_history[-100:]
-        
-        # 저장
-        with open(chat_file, 'w', encoding='utf-8') as f:
-            json.dump(chat_history, f, ensure_ascii=False, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"챗 기록 저장 오류: {e}")
-        return False
+                document.getElementById('note-content').innerHTML = noteContent;
+                document.getElementById('cue-content').innerHTML = cueContent;
+                document.getElementById('summary-content').innerHTML = summaryContent;
+            }}
+            
+            parseContent(content);
+        </script>
+    </body>
+    </html>
+    """
+    
+    return html_template
 
-def load_chat_history(username):
-    """챗 기록 로드"""
-    try:
-        chat_file = f"users/{username}_chat.json"
-        with open(chat_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
-    except Exception as e:
-        print(f"챗 기록 로드 오류: {e}")
-        return []
+# 🆕 사용자 관리 시스템
+# 사용자/사용량 저장소 (SQLite WAL, 사용자명 기본키 조회)
+USER_STORE_PATH = os.getenv("USER_STORE_PATH", "users/users.sqlite3")
+LEGACY_USERS_FILE = "users/users.json"
 
-# 🆕 다중 벡터스토어 관리
-class MultiVectorStoreManager:
-    def __init__(self):
-        self.vectorstores = {}
-        self.document_mapping = {}
+class UserStore:
+    """사용자 계정과 사용량 통계를 트랜잭션 단위로 저장하는 SQLite 저장소
+    - 스레드마다 연결을 따로 열고 WAL 모드로 읽기/쓰기가 서로 막지 않게 함
+    - 처음 열 때 기존 users.json 내용을 한 번만 옮겨옴
+    """
     
-    def add_document(self, doc_name, text):
-        """개별 문서의 벡터스토어 생성"""
+    def __init__(self, db_path=USER_STORE_PATH, legacy_file=LEGACY_USERS_FILE):
+        self.db_path = db_path
+        self.legacy_file = legacy_file
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+    
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    self._create_schema(conn)
+                    self._migrate_from_json(conn)
+                    self._initialized = True
+        return conn
+    
+    def _create_schema(self, conn):
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                username TEXT PRIMARY KEY,
+                password TEXT NOT NULL,
+                plan TEXT NOT NULL DEFAULT 'free',
+                created_at TEXT,
+                last_login TEXT
+            );
+            CREATE TABLE IF NOT EXISTS usage_stats (
+                username TEXT PRIMARY KEY REFERENCES users(username) ON DELETE CASCADE,
+                total_questions INTEGER NOT NULL DEFAULT 0,
+                total_pdfs INTEGER NOT NULL DEFAULT 0,
+                total_quizzes INTEGER NOT NULL DEFAULT 0,
+                api_calls_today INTEGER NOT NULL DEFAULT 0,
+                last_api_call TEXT
+            );
+            CREATE TABLE IF NOT EXISTS store_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+    
+    def _migrate_from_json(self, conn):
+        """기존 users.json 사용자를 한 번만 옮겨옴 (이미 있는 사용자는 건너뜀)"""
+        if conn.execute("SELECT 1 FROM store_meta WHERE key = 'json_migrated'").fetchone():
+            return
         try:
-            vectorstore = create_vectorstore(text)
-            if vectorstore:
-                self.vectorstores[doc_name] = vectorstore
-                self.document_mapping[doc_name] = len(text)
-                return True
-            return False
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                legacy_users = json.load(f)
+        except FileNotFoundError:
+            legacy_users = {}
         except Exception as e:
-            print(f"문서 추가 오류: {e}")
-            return False
-    
-    def search_across_documents(self, query, k=5):
-        """모든 문서에서 검색"""
-        results = []
-        for doc_name, vectorstore in self.vectorstores.items():
-            try:
-                docs = vectorstore.similarity_search(query, k=k//len(self.vectorstores) + 1)
-                for doc in docs:
-                    results.append({
-                        "content": doc.page_content,
-                        "source": doc_name,
-                        "score": 0  # 실제 구현에서는 유사도 점수 계산
-                    })
-            except Exception as e:
-                print(f"검색 오류 ({doc_name}): {e}")
+            print(f"기존 사용자 파일 이전 오류: {e}")
+            return
         
-        return results[:k]
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for username, user in legacy_users.items():
+                usage = user.get("usage_stats") or {}
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (username, password, plan, created_at, last_login) VALUES (?, ?, ?, ?, ?)",
+                    (username, user.get("password", ""), user.get("plan", "free"), user.get("created_at"), user.get("last_login"))
+                )
+                conn.execute(
+                    "INSERT OR IGNORE INTO usage_stats (username, total_questions, total_pdfs, total_quizzes, api_calls_today, last_api_call) VALUES (?, ?, ?, ?, ?, ?)",
+                    (username, usage.get("total_questions", 0), usage.get("total_pdfs", 0), usage.get("total_quizzes", 0),
+                     usage.get("api_calls_today", 0), usage.get("last_api_call"))
+                )
+            conn.execute(
+                "INSERT INTO store_meta (key, value) VALUES ('json_migrated', ?)",
+                (datetime.datetime.now().isoformat(),)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
     
-    def get_document_stats(self):
-        """문서 통계 반환"""
+    @staticmethod
+    def _row_to_user(row):
         return {
-            "total_documents": len(self.vectorstores),
-            "document_sizes": self.document_mapping,
-            "total_size": sum(self.document_mapping.values())
+            "username": row["username"],
+            "password": row["password"],
+            "plan": row["plan"],
+            "created_at": row["created_at"],
+            "last_login": row["last_login"],
+            "usage_stats": {
+                "total_questions": row["total_questions"] or 0,
+                "total_pdfs": row["total_pdfs"] or 0,
+                "total_quizzes": row["total_quizzes"] or 0,
+                "api_calls_today": row["api_calls_today"] or 0,
+                "last_api_call": row["last_api_call"]
+            }
         }
+    
+    def get_user(self, username):
+        row = self._connect().execute(
+            """SELECT u.*, s.total_questions, s.total_pdfs, s.total_quizzes, s.api_calls_today, s.last_api_call
+               FROM users u LEFT JOIN usage_stats s ON s.username = u.username
+               WHERE u.username = ?""",
+            (username,)
+        ).fetchone()
+        return self._row_to_user(row) if row else None
+    
+    def create_user(self, username, password_hash, plan="free"):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT INTO users (username, password, plan, created_at, last_login) VALUES (?, ?, ?, ?, NULL)",
+                (username, password_hash, plan, datetime.datetime.now().isoformat())
+            )
+            conn.execute("INSERT INTO usage_stats (username) VALUES (?)", (username,))
+            conn.execute("COMMIT")
+            return True
+        except sqlite3.IntegrityError:
+            conn.execute("ROLLBACK")
+            return False
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def record_login(self, username, password_hash):
+        """비밀번호가 맞으면 로그인 시간을 갱신하고 사용자 정보를 반환"""
+        cursor = self._connect().execute(
+            "UPDATE users SET last_login = ? WHERE username = ? AND password = ?",
+            (datetime.datetime.now().isoformat(), username, password_hash)
+        )
+        return self.get_user(username) if cursor.rowcount else None
+    
+    def increment_usage(self, username, feature_type):
+        """API 호출 수(날짜가 바뀌면 1부터)와 기능별 누적 횟수를 한 번에 갱신"""
+        counter = {
+            "pdf_upload": "total_pdfs",
+            "quiz_generation": "total_quizzes",
+            "question_asked": "total_questions"
+        }.get(feature_type)
+        now = datetime.datetime.now()
+        extra = f", {counter} = {counter} + 1" if counter else ""
+        cursor = self._connect().execute(
+            f"""UPDATE usage_stats SET
+                    api_calls_today = CASE WHEN substr(COALESCE(last_api_call, ''), 1, 10) = ? THEN api_calls_today + 1 ELSE 1 END,
+                    last_api_call = ?{extra}
+                WHERE username = ?""",
+            (now.date().isoformat(), now.isoformat(), username)
+        )
+        return cursor.rowcount > 0
 
-# 전역 벡터스토어 매니저
-vector_manager = MultiVectorStoreManager()
+_user_store = None
+_user_store_lock = threading.Lock()
+
+def get_user_store():
+    """프로세스 공용 사용자 저장소 반환"""
+    global _user_store
+    with _user_store_lock:
+        if _user_store is None:
+            _user_store = UserStore()
+        return _user_store
+
+def hash_password(password):
+    """비밀번호 해시화"""
+    return hashlib.sha256(password.encode()).hexdigest()
+
+def create_user(username, password, plan="free"):
+    """새 사용자 생성"""
+    try:
+        return get_user_store().create_user(username, hash_password(password), plan)
+    except Exception as e:
+        print(f"사용자 생성 오류: {e}")
+        return False
+
+def authenticate_user(username, password):
+    """사용자 인증"""
+    try:
+        return get_user_store().record_login(username, hash_password(password))
+    except Exception as e:
+        print(f"인증 오류: {e}")
+        return None
+
+def update_user_usage(username, feature_type):
+    """사용자 사용량 업데이트"""
+    try:
+        get_user_store().increment_usage(username, feature_type)
+        return True
+    except Exception as e:
+        print(f"사용량 업데이트 오류: {e}")
+        return False
 
 # 🆕 플래시카드 HTML 생성 (인터랙티브)
 def generate_flashcards_html(flashcards_content, title="학습 플래시카드"):
@@ -2409,225 +3063,13 @@ def generate_flashcards_html(flashcards_content, title="학습 플래시카드")
     
     return html_template
 
-# 🆕 사용자 맞춤 학습 이력 관리
-def load_user_study_history(username, filename_prefix="user_history"):
-    """지식 카드 업데이트"""
-    try:
-        # 순환 import 방지를 위해 함수들을 여기서 직접 구현
-        def create_knowledge_card_local(pdf_name: str, upload_date: str, question_count: int, last_study: str):
-            return {
-                "pdf_name": pdf_name,
-                "upload_date": upload_date,
-                "question_count": question_count,
-                "last_study": last_study,
-                "card_id": f"card_{pdf_name.replace('.pdf', '').replace(' ', '_')}"
-            }
-        
-        def load_knowledge_cards_local(username: str = None):
-            try:
-                if username:
-                    cards_file = f"users/{username}_knowledge_cards.json"
-                else:
-                    cards_file = "knowledge_cards.json"
-                
-                if os.path.exists(cards_file):
-                    with open(cards_file, 'r', encoding='utf-8') as f:
-                        return json.load(f)
-                return []
-            except:
-                return []
-        
-        def save_knowledge_cards_local(cards, username: str = None):
-            try:
-                if username:
-                    cards_file = f"users/{username}_knowledge_cards.json"
-                    os.makedirs("users", exist_ok=True)
-                else:
-                    cards_file = "knowledge_cards.json"
-                
-                with open(cards_file, 'w', encoding='utf-8') as f:
-                    json.dump(cards, f, ensure_ascii=False, indent=2)
-                return True
-            except:
-                return False
-        
-        cards = load_knowledge_cards_local(username)
-        
-        # 기존 카드 찾기
-        existing_card = None
-        for i, card in enumerate(cards):
-            if card['pdf_name'] == pdf_name:
-                existing_card = i
-                break
-        
-        # 카드 업데이트 또는 생성
-        if existing_card is not None:
-            cards[existing_card]['question_count'] += 1
-            cards[existing_card]['last_study'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-        else:
-            new_card = create_knowledge_card_local(
-                pdf_name=pdf_name,
-                upload_date=datetime.datetime.now().strftime("%Y-%m-%d"),
-                question_count=1,
-                last_study=datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-            )
-            cards.append(new_card)
-        
-        save_knowledge_cards_local(cards, username)
-        return True
-    except Exception as e:
-        print(f"지식 카드 업데이트 오류: {e}")
-        return False
-
-# 🆕 사용자 맞춤 학습 이력 관리
-def load_user_study_history(username, filename_prefix="user_history"):
-    """사용자별 학습 이력 로드"""
-    filename = f"{filename_prefix}_{username}.json"
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
-    except Exception as e:
-        print(f"사용자 이력 로드 오류: {e}")
-        return []
-
-def save_user_study_history(username, question, answer, topic=None, difficulty=None, filename_prefix="user_history"):
-    """사용자별 학습 이력 저장"""
-    filename = f"{filename_prefix}_{username}.json"
-    try:
-        # 기존 이력 로드
-        history = load_user_study_history(username, filename_prefix)
-        
-        # 새 기록 추가
-        new_record = {
-            "timestamp": datetime.datetime.now().isoformat(),
-            "question": question,
-            "answer": answer[:200] + "..." if len(answer) > 200 else answer,
-            "topic": topic,
-            "difficulty": difficulty,
-            "study_time": random.randint(30, 300)  # 30초-5분 랜덤
-        }
-        
-        history.append(new_record)
-        
-        # 최근 100개만 유지
-        if len(history) > 100:
-            history = history[-100:]
-        
-        # 저장
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-            
-        return True
-    except Exception as e:
-        print(f"사용자 이력 저장 오류: {e}")
-        return False
-
-def calculate_user_progress(history, username):
-    """사용자별 상세 진행률 계산"""
-    if not history:
-        return 0, {}, {}
-    
-    # 기본 진행률 계산
-    topics = {}
-    study_patterns = {
-        'time_distribution': {},
-        'difficulty_preference': {},
-        'topic_interest': {}
-    }
-    
-    for record in history:
-        # 주제별 분류
-        question = record['question'].lower()
-        topic_found = False
-        
-        # 간단한 키워드 매칭으로 주제 분류
-        topic_keywords = {
-            'Chapter 1': ['1장', '첫번째', '처음', 'chapter 1', '기초'],
-            'Chapter 2': ['2장', '두번째', 'chapter 2', '중급'],
-            'Chapter 3': ['3장', '세번째', 'chapter 3', '고급'],
-            '개념': ['개념', '정의', '의미', '뜻'],
-            '공식': ['공식', '수식', '계산', '식'],
-            '예제': ['예제', '문제', '풀이', '해답']
-        }
-        
-        for topic, keywords in topic_keywords.items():
-            if any(keyword in question for keyword in keywords):
-                topics[topic] = topics.get(topic, 0) + 1
-                topic_found = True
-                break
-        
-        if not topic_found:
-            topics['기타'] = topics.get('기타', 0) + 1
-        
-        # 시간 패턴 분석
-        timestamp = record['timestamp']
-        hour = datetime.datetime.fromisoformat(timestamp).hour
-        time_slot = f"{hour:02d}:00"
-        study_patterns['time_distribution'][time_slot] = study_patterns['time_distribution'].get(time_slot, 0) + 1
-        
-        # 난이도 선호도
-        difficulty = record.get('difficulty', 'medium')
-        study_patterns['difficulty_preference'][difficulty] = study_patterns['difficulty_preference'].get(difficulty, 0) + 1
-    
-    # 진행률 계산 (더 정교한 방식)
-    total_chapters = 10
-    progress_percentage = min(len(topics) / total_chapters * 100, 100)
-    
-    # 학습 일관성 보너스
-    if len(history) > 20:
-        progress_percentage += 10
-    if len(set([record['timestamp'][:10] for record in history])) > 7:  # 7일 이상 학습
-        progress_percentage += 15
-    
-    progress_percentage = min(progress_percentage, 100)
-    
-    return progress_percentage, topics, study_patterns
-
-def generate_learning_recommendations(username, history, current_topic=None):
-    """AI 기반 맞춤 학습 추천"""
-    try:
-        client = openai.OpenAI()
-        
-        # 사용자 학습 패턴 분석
-        recent_questions = [record['question'] for record in history[-10:]]
-        topics_studied = list(set([record.get('topic', '일반') for record in history]))
-        
-        prompt = f"""
-        사용자 {username}의 학습 패턴을 분석하여 맞춤 추천을 생성해주세요.
-        
-        최근 질문들:
-        {chr(10).join(recent_questions)}
-        
-        학습한 주제들: {', '.join(topics_studied)}
-        현재 학습 중인 주제: {current_topic or '없음'}
-        
-        다음 형식으로 추천해주세요:
-        1. 복습이 필요한 영역
-        2. 다음 학습 추천 주제
-        3. 학습 방법 제안
-        4. 예상 소요 시간
-        """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=800,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"추천 생성 중 오류가 발생했습니다: {str(e)}"
-
 # 🆕 사용자 관리 시스템
 import hashlib
 import datetime
 
-def create_user_profile(username, email, plan="free"):
-    """사용자 프로필 생성"""
-    user_data = {
+def _new_user_profile(username, email, plan="free"):
+    """새 사용자 프로필 내용"""
+    return {
         "username": username,
         "email": email,
         "plan": plan,  # free, premium, instructor
@@ -2639,6 +3081,10 @@ def create_user_profile(username, email, plan="free"):
         "learning_streak": 0,
         "last_login": datetime.datetime.now().isoformat()
     }
+
+def create_user_profile(username, email, plan="free"):
+    """사용자 프로필 생성"""
+    user_data = _new_user_profile(username, email, plan)
     
     # 사용자 파일 저장
     user_file = f"users/{username}.json"
@@ -2652,8 +3098,8 @@ def create_user_profile(username, email, plan="free"):
         print(f"사용자 생성 오류: {e}")
         return False
 
-def load_user_profile(username):
-    """사용자 프로필 로드"""
+def _read_user_profile(username):
+    """디스크에 저장된 사용자 프로필 로드"""
     user_file = f"users/{username}.json"
     try:
         with open(user_file, 'r', encoding='utf-8') as f:
@@ -2664,11 +3110,19 @@ def load_user_profile(username):
         print(f"사용자 로드 오류: {e}")
         return None
 
-def update_user_activity(username, activity_type, data=None):
-    """사용자 활동 업데이트"""
-    user_profile = load_user_profile(username)
-    if not user_profile:
-        return False
+def load_user_profile(username):
+    """사용자 프로필 로드 (아직 저장되지 않은 활동까지 반영)"""
+    user_profile = _read_user_profile(username)
+    if user_profile:
+        for activity_type, data, timestamp in activity_buffer.pending(username):
+            _apply_user_activity(user_profile, activity_type, data, timestamp)
+        if activity_buffer.pending(username):
+            check_achievements(user_profile)
+    return user_profile
+
+def _apply_user_activity(user_profile, activity_type, data, timestamp):
+    """활동 한 건을 프로필 카운터/연속 학습일에 반영"""
+    data = data or {}
     
     # 활동별 업데이트
     if activity_type == "pdf_processed":
@@ -2676,9 +3130,9 @@ def update_user_activity(username, activity_type, data=None):
     elif activity_type == "multi_document_processed":
         user_profile["multi_doc_count"] = user_profile.get("multi_doc_count", 0) + 1
         user_profile["total_documents"] = user_profile.get("total_documents", 0) + data.get("count", 1)
-    elif activity_type == "quiz_completed":
+    elif activity_type in ("quiz_completed", "quiz_generated"):
         user_profile["quiz_count"] += 1
-    elif activity_type == "flashcard_generated":
+    elif activity_type in ("flashcard_generated", "flashcards_generated"):
         user_profile["flashcard_count"] = user_profile.get("flashcard_count", 0) + 1
     elif activity_type == "question_asked":
         user_profile["question_count"] = user_profile.get("question_count", 0) + 1
@@ -2688,10 +3142,10 @@ def update_user_activity(username, activity_type, data=None):
         user_profile["study_time"] += data.get("duration", 0)
     
     # 마지막 활동 시간 업데이트
-    user_profile["last_activity"] = datetime.datetime.now().isoformat()
+    user_profile["last_activity"] = timestamp.isoformat()
     
     # 연속 학습일 계산
-    today = datetime.datetime.now().date()
+    today = timestamp.date()
     last_login = datetime.datetime.fromisoformat(user_profile.get("last_login", user_profile["created_date"])).date()
     
     if (today - last_login).days == 1:
@@ -2699,20 +3153,106 @@ def update_user_activity(username, activity_type, data=None):
     elif (today - last_login).days > 1:
         user_profile["learning_streak"] = 1
     
-    user_profile["last_login"] = datetime.datetime.now().isoformat()
+    user_profile["last_login"] = timestamp.isoformat()
+
+# 📦 사용자 활동 지연 저장 (사용자별로 모아 주기적으로 한 번에 기록)
+ACTIVITY_FLUSH_INTERVAL_SECONDS = float(os.getenv("ACTIVITY_FLUSH_INTERVAL_SECONDS", "5"))
+ACTIVITY_FLUSH_MAX_EVENTS = int(os.getenv("ACTIVITY_FLUSH_MAX_EVENTS", "50"))
+
+class ActivityBuffer:
+    """활동 이벤트를 메모리에 모았다가 백그라운드 스레드에서 사용자별로 한 번씩 저장
+    - 주기(ACTIVITY_FLUSH_INTERVAL_SECONDS) 또는 대기 이벤트 수(ACTIVITY_FLUSH_MAX_EVENTS)로 저장
+    - 저장은 임시 파일에 쓴 뒤 교체해서 중간에 죽어도 파일이 깨지지 않음
+    - 프로세스 종료 시 남은 이벤트를 저장
+    """
+    
+    def __init__(self, flush_interval=ACTIVITY_FLUSH_INTERVAL_SECONDS, max_events=ACTIVITY_FLUSH_MAX_EVENTS):
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self._events = {}
+        self._event_count = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+        self.stats = {"enqueued": 0, "flushes": 0, "written_profiles": 0, "errors": 0}
     
-    # 업적 시스템
-    check_achievements(user_profile)
+    def add(self, username, activity_type, data=None):
+        with self._lock:
+            self._events.setdefault(username, []).append((activity_type, data, datetime.datetime.now()))
+            self._event_count += 1
+            self.stats["enqueued"] += 1
+            if self._event_count >= self.max_events:
+                self._wakeup.set()
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="activity-flusher", daemon=True)
+                self._worker.start()
     
-    # 저장
-    user_file = f"users/{username}.json"
+    def pending(self, username):
+        with self._lock:
+            return list(self._events.get(username, []))
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+    
+    def flush(self):
+        """대기 중인 활동을 사용자별로 묶어 저장"""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._events
+                self._events = {}
+                self._event_count = 0
+            if not batch:
+                return 0
+            
+            written = 0
+            for username, events in batch.items():
+                user_profile = _read_user_profile(username)
+                if not user_profile:
+                    # 사용자 저장소(SQLite)로 가입한 사용자는 첫 활동을 저장할 때 프로필 파일을 만듦
+                    user_profile = _profile_from_user_store(username)
+                for activity_type, data, timestamp in events:
+                    _apply_user_activity(user_profile, activity_type, data, timestamp)
+                
+                # 업적 시스템
+                check_achievements(user_profile)
+                
+                user_file = f"users/{username}.json"
+                tmp_file = f"{user_file}.tmp"
+                try:
+                    os.makedirs("users", exist_ok=True)
+                    with open(tmp_file, 'w', encoding='utf-8') as f:
+                        json.dump(user_profile, f, ensure_ascii=False, indent=2)
+                    os.replace(tmp_file, user_file)
+                    written += 1
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    print(f"사용자 업데이트 오류: {e}")
+            
+            self.stats["flushes"] += 1
+            self.stats["written_profiles"] += written
+            return written
+
+def _profile_from_user_store(username):
+    """사용자 저장소의 계정 정보(이메일, 플랜)로 새 프로필을 만듦"""
+    user = None
     try:
-        with open(user_file, 'w', encoding='utf-8') as f:
-            json.dump(user_profile, f, ensure_ascii=False, indent=2)
-        return True
+        user = get_user_store().get_user(username)
     except Exception as e:
-        print(f"사용자 업데이트 오류: {e}")
-        return False
+        print(f"사용자 조회 오류: {e}")
+    user = user or {}
+    return _new_user_profile(username, user.get("email", ""), user.get("plan") or "free")
+
+activity_buffer = ActivityBuffer()
+atexit.register(activity_buffer.flush)
+
+def update_user_activity(username, activity_type, data=None):
+    """사용자 활동 업데이트 (메모리에 기록하고 저장은 백그라운드에서 처리)"""
+    activity_buffer.add(username, activity_type, data)
+    return True
 
 def check_achievements(user_profile):
     """업적 확인 및 추가"""
@@ -2775,117 +3315,285 @@ def check_achievements(user_profile):
     user_profile["achievements"] = achievements
 
 # 🆕 수익화 기능들
-def check_plan_limits(username, feature):
-    """플랜별 제한 확인"""
-    user_profile = load_user_profile(username)
-    if not user_profile:
-        return False, "사용자를 찾을 수 없습니다."
-    
-    plan = user_profile.get("plan", "free")
-    
-    if plan == "free":
-        if feature == "pdf_upload" and user_profile["pdf_count"] >= 1:
-            return False, "🚫 무료 플랜은 1개 PDF만 처리 가능합니다. 프리미엄으로 업그레이드하세요!"
-        if feature == "quiz_generation" and user_profile["quiz_count"] >= 3:
-            return False, "🚫 무료 플랜은 3개 퀴즈만 생성 가능합니다. 프리미엄으로 업그레이드하세요!"
-        if feature == "flashcard_generation" and user_profile.get("flashcard_count", 0) >= 2:
-            return False, "🚫 무료 플랜은 2개 플래시카드만 생성 가능합니다."
-        if feature == "multi_document":
-            return False, "🚫 다중 문서 기능은 프리미엄 플랜이 필요합니다."
-        if feature == "premium_features":
-            return False, "🚫 프리미엄 기능입니다. 업그레이드가 필요합니다."
-    
-    elif plan == "premium":
-        # 프리미엄은 대부분 제한 없음, 단 일부 고급 기능은 제한
-        if feature == "instructor_features":
-            return False, "🚫 강사 플랜 전용 기능입니다."
-    
-    elif plan == "instructor":
-        # 강사 플랜은 모든 기능 사용 가능
-        pass
-    
-    return True, "사용 가능"
+# 플랜별 사용 한도
+# - total: 누적 사용 가능 횟수 (기간 없이 누적)
+# - daily: 하루 사용 가능 횟수 (자정에 초기화, 0이면 사용 불가)
+# - burst: (용량, 초) 토큰 버킷, 짧은 시간에 몰리는 호출 제한
+PLAN_QUOTAS = {
+    "free": {
+        "pdf_upload": {"daily": 1},
+        "quiz_generation": {"daily": 3},
+        "flashcard_generation": {"daily": 2},
+        "api_calls": {"daily": 50, "burst": (10, 60)},
+        "multi_document": {"daily": 0},
+        "premium_features": {"daily": 0},
+        "instructor_features": {"daily": 0}
+    },
+    "premium": {
+        "api_calls": {"burst": (60, 60)},
+        "instructor_features": {"daily": 0}
+    },
+    "instructor": {
+        "api_calls": {"burst": (120, 60)}
+    }
+}
+
+QUOTA_MESSAGES = {
+    "pdf_upload": "🚫 무료 플랜은 하루 {limit}개 PDF만 처리 가능합니다. 프리미엄으로 업그레이드하세요!",
+    "quiz_generation": "🚫 무료 플랜은 하루 {limit}개 퀴즈만 생성 가능합니다. 프리미엄으로 업그레이드하세요!",
+    "flashcard_generation": "🚫 무료 플랜은 하루 {limit}개 플래시카드만 생성 가능합니다.",
+    "api_calls": "🚫 무료 플랜은 하루 {limit}회 API 호출 제한입니다.",
+    "multi_document": "🚫 다중 문서 기능은 프리미엄 플랜이 필요합니다.",
+    "premium_features": "🚫 프리미엄 기능입니다. 업그레이드가 필요합니다.",
+    "instructor_features": "🚫 강사 플랜 전용 기능입니다."
+}
 
-def generate_share_link(pdf_name, username):
-    """강사용 공유 링크 생성"""
-    # 간단한 해시 기반 링크 생성
-    link_data = f"{pdf_name}_{username}_{datetime.datetime.now().isoformat()}"
-    link_hash = hashlib.md5(link_data.encode()).hexdigest()[:10]
+QUOTA_STATE_FILE = os.getenv("QUOTA_STATE_FILE", "users/quota_state.json")
+QUOTA_PERSIST_INTERVAL_SECONDS = float(os.getenv("QUOTA_PERSIST_INTERVAL_SECONDS", "30"))
+QUOTA_PLAN_CACHE_SECONDS = 60
+
+class QuotaService:
+    """사용자별 한도를 메모리에서 관리하는 서비스
+    - 기능별 누적/일일 카운터 (날짜가 바뀌면 일일 카운터 자동 초기화)와 토큰 버킷
+    - 처음 보는 사용자는 사용자 저장소/프로필의 기존 사용량으로 카운터를 채움
+    - try_consume은 확인과 차감을 한 잠금 안에서 처리해서 세션이 동시에 불러도 한도를 넘지 않음
+    - 상태는 주기적으로 파일에 저장하고 시작 시 다시 읽음
+    """
     
-    share_link = f"https://your-domain.com/shared/{link_hash}"
+    def __init__(self, state_file=QUOTA_STATE_FILE, quotas=PLAN_QUOTAS):
+        self.state_file = state_file
+        self.quotas = quotas
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._plans = {}
+        self._seeded = set()
+        self._dirty = False
+        self._persister = None
+        self._load_state()
     
-    # 공유 정보 저장
-    share_data = {
-        "pdf_name": pdf_name,
-        "creator": username,
-        "created_date": datetime.datetime.now().isoformat(),
-        "access_count": 0,
-        "link_hash": link_hash
-    }
+    def _load_state(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                self._counters = json.load(f)
+        except FileNotFoundError:
+            self._counters = {}
+        except Exception as e:
+            print(f"한도 상태 로드 오류: {e}")
+            self._counters = {}
     
-    os.makedirs("shared_links", exist_ok=True)
-    with open(f"shared_links/{link_hash}.json", 'w', encoding='utf-8') as f:
-        json.dump(share_data, f, ensure_ascii=False, indent=2)
+    def persist(self):
+        """변경된 카운터를 파일에 저장"""
+        with self._lock:
+            if not self._dirty:
+                return False
+            snapshot = json.dumps(self._counters, ensure_ascii=False)
+            self._dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+            tmp_file = f"{self.state_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(snapshot)
+            os.replace(tmp_file, self.state_file)
+            return True
+        except Exception as e:
+            with self._lock:
+                self._dirty = True
+            print(f"한도 상태 저장 오류: {e}")
+            return False
     
-    return share_link
-
-def generate_premium_quiz(text, difficulty="medium", num_questions=10):
-    """프리미엄 예상문제 생성"""
-    try:
-        client = openai.OpenAI()
-        
-        difficulty_prompts = {
-            "easy": "기본적인 개념 이해를 확인하는",
-            "medium": "응용력을 요구하는",
-            "hard": "심화 사고력을 평가하는"
-        }
-        
-        prompt = f"""
-        다음 텍스트를 바탕으로 {difficulty_prompts[difficulty]} {num_questions}개의 고품질 예상문제를 생성해주세요.
-        
-        문제 유형:
-        1. 객관식 (4지선다)
-        2. 단답형
-        3. 서술형 (간단한 설명)
-        
-        각 문제는 다음 형식으로:
-        
-        [문제 유형] Q1: [문제]
-        1) [선택지1] (객관식인 경우)
-        2) [선택지2]
-        3) [선택지3]
-        4) [선택지4]
-        정답: [답]
-        해설: [상세한 해설과 관련 개념 설명]
-        난이도: {difficulty}
+    def _persist_loop(self):
+        while True:
+            time.sleep(QUOTA_PERSIST_INTERVAL_SECONDS)
+            self.persist()
+    
+    def _start_persister(self):
+        if self._persister is None and QUOTA_PERSIST_INTERVAL_SECONDS > 0:
+            with self._lock:
+                if self._persister is None:
+                    self._persister = threading.Thread(target=self._persist_loop, name="quota-persister", daemon=True)
+                    self._persister.start()
+    
+    def get_plan(self, username):
+        """사용자 플랜 (사용자 저장소 → 프로필 순서로 조회, 잠시 캐시)"""
+        cached = self._plans.get(username)
+        now = time.time()
+        if cached and now - cached[1] < QUOTA_PLAN_CACHE_SECONDS:
+            return cached[0]
+        
+        plan = None
+        try:
+            user = get_user_store().get_user(username)
+            plan = user.get("plan") if user else None
+        except Exception:
+            pass
+        if plan is None:
+            profile = _read_user_profile(username)
+            plan = profile.get("plan", "free") if profile else None
+        if plan is not None:
+            self._plans[username] = (plan, now)
+        return plan
+    
+    def set_plan(self, username, plan):
+        """플랜 변경을 즉시 반영"""
+        self._plans[username] = (plan, time.time())
+    
+    def _ensure_seeded(self, username):
+        """처음 보는 사용자는 기존 사용량(사용자 저장소의 usage_stats, 프로필 카운터)으로 카운터를 채움"""
+        if username in self._seeded:
+            return
+        totals = {}
+        api_calls_today = 0
+        try:
+            user = get_user_store().get_user(username)
+            usage = (user or {}).get("usage_stats") or {}
+            totals["pdf_upload"] = usage.get("total_pdfs", 0)
+            totals["quiz_generation"] = usage.get("total_quizzes", 0)
+            if str(usage.get("last_api_call") or "")[:10] == datetime.date.today().isoformat():
+                api_calls_today = usage.get("api_calls_today", 0)
+        except Exception as e:
+            print(f"기존 사용량 조회 오류: {e}")
+        profile = _read_user_profile(username) or {}
+        for feature, key in (("pdf_upload", "pdf_count"), ("quiz_generation", "quiz_count"), ("flashcard_generation", "flashcard_count")):
+            totals[feature] = max(totals.get(feature, 0), profile.get(key, 0))
+        
+        now = time.time()
+        today = datetime.date.fromtimestamp(now).isoformat()
+        with self._lock:
+            if username in self._seeded:
+                return
+            features = self._counters.setdefault(username, {})
+            for feature, total in totals.items():
+                counter = features.setdefault(feature, {"day": today, "used": 0})
+                counter["total"] = max(counter.get("total", 0), total)
+            counter = features.setdefault("api_calls", {"day": today, "used": 0})
+            if counter["day"] == today:
+                counter["used"] = max(counter["used"], api_calls_today)
+            self._seeded.add(username)
+            self._dirty = True
+    
+    def _counter(self, username, feature, rule, now):
+        """기능별 카운터를 가져오면서 일일 초기화와 토큰 충전을 적용 (잠금 안에서 호출)"""
+        today = datetime.date.fromtimestamp(now).isoformat()
+        counter = self._counters.setdefault(username, {}).setdefault(feature, {"day": today, "used": 0})
+        counter.setdefault("total", 0)
+        if counter["day"] != today:
+            counter["day"] = today
+            counter["used"] = 0
+        
+        burst = rule.get("burst")
+        if burst:
+            capacity, period = burst
+            tokens = counter.get("tokens", capacity)
+            elapsed = max(now - counter.get("updated", now), 0)
+            counter["tokens"] = min(capacity, tokens + elapsed * capacity / period)
+            counter["updated"] = now
+        return counter
+    
+    def _check_locked(self, username, feature, plan, now, amount=1):
+        if plan is None:
+            return False, "사용자를 찾을 수 없습니다."
         
-        텍스트:
-        {text[:4000]}
+        rule = self.quotas.get(plan, {}).get(feature)
+        if not rule:
+            return True, "사용 가능"
+        
+        counter = self._counter(username, feature, rule, now)
+        message = QUOTA_MESSAGES.get(feature, "🚫 사용 한도를 초과했습니다.")
+        total = rule.get("total")
+        if total is not None and counter["total"] + amount > total:
+            return False, message.format(limit=total)
+        daily = rule.get("daily")
+        if daily is not None and counter["used"] + amount > daily:
+            return False, message.format(limit=daily)
+        if rule.get("burst") and counter["tokens"] < amount:
+            return False, "🚫 요청이 너무 많습니다. 잠시 후 다시 시도해주세요."
+        return True, "사용 가능"
+    
+    def _consume_locked(self, username, feature, plan, now, amount):
+        rule = self.quotas.get(plan, {}).get(feature) if plan else None
+        if not rule:
+            return False
+        counter = self._counter(username, feature, rule, now)
+        counter["used"] += amount
+        counter["total"] += amount
+        if rule.get("burst"):
+            counter["tokens"] = max(counter["tokens"] - amount, 0)
+        self._dirty = True
+        return True
+    
+    def check(self, username, feature):
+        """한도 안인지 확인만 함 (사용량은 변하지 않음)"""
+        self._ensure_seeded(username)
+        plan = self.get_plan(username)
+        with self._lock:
+            return self._check_locked(username, feature, plan, time.time())
+    
+    def try_consume(self, username, features, amount=1):
+        """모든 기능이 한도 안이면 한 번에 차감하고 (True, 메시지), 하나라도 넘으면 아무것도 차감하지 않음
+        - 사용량은 여기서만 차감 (실행이 실패하면 refund로 되돌림)
         """
-        
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=3000,
-            temperature=0.3
-        )
-        
-        return response.choices[0].message.content
-    except Exception as e:
-        return f"프리미엄 문제 생성 중 오류가 발생했습니다: {str(e)}"
+        if isinstance(features, str):
+            features = [features]
+        self._ensure_seeded(username)
+        plan = self.get_plan(username)
+        now = time.time()
+        with self._lock:
+            for feature in features:
+                allowed, message = self._check_locked(username, feature, plan, now, amount)
+                if not allowed:
+                    return False, message
+            for feature in features:
+                self._consume_locked(username, feature, plan, now, amount)
+        self._start_persister()
+        return True, "사용 가능"
+    
+    def refund(self, username, features, amount=1):
+        """try_consume으로 차감했지만 실제로 사용하지 못한 몫을 되돌림"""
+        if isinstance(features, str):
+            features = [features]
+        with self._lock:
+            for feature in features:
+                counter = self._counters.get(username, {}).get(feature)
+                if counter:
+                    counter["used"] = max(counter["used"] - amount, 0)
+                    counter["total"] = max(counter.get("total", 0) - amount, 0)
+                    self._dirty = True
+    
+    def usage(self, username):
+        """사용자의 기능별 사용량 (오늘 사용량과 누적 사용량)"""
+        today = datetime.date.today().isoformat()
+        with self._lock:
+            return {
+                feature: {"today": counter["used"] if counter.get("day") == today else 0, "total": counter.get("total", 0)}
+                for feature, counter in self._counters.get(username, {}).items()
+            }
+
+quota_service = QuotaService()
+atexit.register(quota_service.persist)
+
+def check_plan_limits(username, feature, consume=False):
+    """플랜별 제한 확인
+    - consume: True이면 한도 안일 때 바로 차감 (확인과 차감을 한 번에 처리)
+    - feature: 기능 이름 또는 여러 기능 목록 (목록은 consume=True일 때 모두 통과해야 차감)
+    """
+    if consume:
+        return quota_service.try_consume(username, feature)
+    return quota_service.check(username, feature)
+
+def refund_plan_limits(username, feature):
+    """check_plan_limits(consume=True)로 차감했지만 기능 실행이 실패했을 때 되돌림"""
+    quota_service.refund(username, feature)
 
 # 🆕 학습 분석 리포트
 def generate_learning_report(username):
     """개인 맞춤 학습 분석 리포트"""
     user_profile = load_user_profile(username)
-    history = load_study_history(f"users/{username}_history.json")
+    history = load_user_study_history(username)
     
     if not user_profile or not history:
         return "데이터가 부족합니다."
     
     try:
-        client = openai.OpenAI()
-        
         # 학습 패턴 분석
         recent_questions = [h['question'] for h in history[-10:]]
         study_topics = analyze_study_topics(recent_questions)
@@ -2909,14 +3617,13 @@ def generate_learning_report(username):
         친근하고 격려하는 톤으로 작성해주세요.
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "learning_report",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1500,
             temperature=0.4
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"리포트 생성 중 오류가 발생했습니다: {str(e)}"
 
@@ -2944,51 +3651,37 @@ def load_chat_history(username):
         print(f"챗 기록 로드 오류: {e}")
         return []
 
-def update_user_usage(username, feature_type):
-    """사용자 사용량 업데이트"""
-    try:
-        users_file = "users/users.json"
-        with open(users_file, 'r', encoding='utf-8') as f:
-            users = json.load(f)
-        
-        if username in users:
-            usage = users[username].get("usage_stats", {})
-            today = datetime.datetime.now().date().isoformat()
-            
-            # API 호출 카운트 업데이트
-            last_call = usage.get("last_api_call", "")
-            if last_call.startswith(today):
-                usage["api_calls_today"] = usage.get("api_calls_today", 0) + 1
-            else:
-                usage["api_calls_today"] = 1
-            
-            usage["last_api_call"] = datetime.datetime.now().isoformat()
-            
-            # 기능별 카운트 업데이트
-            if feature_type == "pdf_upload":
-                usage["total_pdfs"] = usage.get("total_pdfs", 0) + 1
-            elif feature_type == "quiz_generation":
-                usage["total_quizzes"] = usage.get("total_quizzes", 0) + 1
-            elif feature_type == "question_asked":
-                usage["total_questions"] = usage.get("total_questions", 0) + 1
-            
-            users[username]["usage_stats"] = usage
-            
-            with open(users_file, 'w', encoding='utf-8') as f:
-                json.dump(users, f, ensure_ascii=False, indent=2)
-        
-        return True
-    except Exception as e:
-        print(f"사용량 업데이트 오류: {e}")
-        return False
-
-def generate_direct_answer(text, question):
-    """벡터스토어 없이 직접 텍스트 기반 답변 생성"""
+def generate_direct_answer(text, question, mode="retrieval", top_k=RETRIEVAL_TOP_K, max_context_tokens=RETRIEVAL_MAX_CONTEXT_TOKENS, stream=False, use_semantic_cache=True):
+    """텍스트 기반 답변 생성
+    - mode: retrieval (질문 관련 청크 검색), prefix (문서 앞부분 사용)
+    - stream: True이면 답변을 조각 단위로 내보내는 이터레이터 반환
+    - use_semantic_cache: 같은 문서의 비슷한 질문(코사인 유사도 SEMANTIC_CACHE_THRESHOLD 이상)에 저장된 답변 사용
+    """
     try:
-        client = get_openai_client()
+        # 같은 문서에 비슷한 질문이 있었으면 저장된 답변 사용
+        document_hash = None
+        question_embedding = None
+        if use_semantic_cache:
+            try:
+                document_hash = SemanticAnswerCache.document_hash(text)
+                question_embedding = get_embedding_model().embed_query(question)
+                cached = semantic_answer_cache.lookup(document_hash, question_embedding)
+                if cached is not None:
+                    return iter([cached[0]]) if stream else cached[0]
+            except Exception as e:
+                print(f"의미 캐시 조회 오류: {e}")
+                question_embedding = None
         
-        # 텍스트가 너무 길면 관련 부분만 추출
-        relevant_text = text[:4000] if len(text) > 4000 else text
+        # 질문과 관련된 부분만 검색해서 사용 (실패 시 앞부분 사용)
+        # 문서 전체가 본문 예산 안에 들어가면 그대로 사용
+        relevant_text = None
+        if mode == "retrieval" and count_tokens(text) > get_prompt_context_budget(max_tokens=1000):
+            try:
+                relevant_text = retrieve_relevant_context(text, question, top_k, max_context_tokens)
+            except Exception as e:
+                print(f"관련 내용 검색 오류: {e}")
+        if not relevant_text:
+            relevant_text = fit_prompt_context(text, max_tokens=1000)
         
         prompt = f"""
         다음 텍스트를 바탕으로 질문에 답변해주세요.
@@ -3001,14 +3694,24 @@ def generate_direct_answer(text, question):
         답변:
         """
         
-        response = client.chat.completions.create(
+        answer = create_chat_completion(
+            "direct_answer",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1000,
-            temperature=0.3
+            temperature=0.3,
+            stream=stream
         )
         
-        return response.choices[0].message.content
+        if question_embedding is not None:
+            if stream:
+                return _iter_and_store_answer(answer, document_hash, question, question_embedding)
+            if answer:
+                try:
+                    semantic_answer_cache.store(document_hash, question, question_embedding, answer)
+                except Exception as e:
+                    print(f"의미 캐시 저장 오류: {e}")
+        return answer
     except Exception as e:
         return f"답변 생성 중 오류가 발생했습니다: {str(e)}"
 
@@ -3048,38 +3751,195 @@ def save_chat_message(username, message, response, message_type="qa"):
         print(f"챗 기록 저장 오류: {e}")
         return False
 
+# 📦 학습 이력 저널 (사용자별 JSONL 추가 기록 + 오프셋 인덱스)
+HISTORY_DIR = "users"
+HISTORY_MAX_RECORDS = int(os.getenv("HISTORY_MAX_RECORDS", "0"))  # 0이면 개수 제한 없음
+HISTORY_COMPACT_INTERVAL_SECONDS = float(os.getenv("HISTORY_COMPACT_INTERVAL_SECONDS", "300"))
+HISTORY_COMPACT_MIN_APPENDS = int(os.getenv("HISTORY_COMPACT_MIN_APPENDS", "200"))
+
+class StudyHistoryJournal:
+    """사용자별 학습 이력을 추가 전용 JSONL 파일로 관리
+    - 저장: 한 줄 추가 + 인덱스에 8바이트 오프셋 추가 (기존 기록을 읽지 않음)
+    - 조회: 인덱스로 필요한 구간만 찾아 읽음
+    - 압축: 백그라운드 스레드가 깨진 줄과 보존 개수를 넘는 기록을 정리
+    - 기존 users/{username}_history.json은 처음 접근할 때 한 번 옮겨옴
+    """
+    
+    def __init__(self, base_dir=HISTORY_DIR, max_records=HISTORY_MAX_RECORDS):
+        self.base_dir = base_dir
+        self.max_records = max_records
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._offsets = {}
+        self._pending_appends = {}
+        self._compactor = None
+    
+    def _paths(self, username):
+        base = os.path.join(self.base_dir, f"{username}_history")
+        return f"{base}.jsonl", f"{base}.idx", f"{base}.json"
+    
+    def _lock(self, username):
+        with self._locks_guard:
+            return self._locks.setdefault(username, threading.RLock())
+    
+    def _scan_offsets(self, journal_file, start=0):
+        """저널을 start 위치부터 읽어 완전한 줄의 시작 오프셋 목록을 만듦"""
+        offsets = []
+        position = start
+        with open(journal_file, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                if line.endswith(b"\n") and line.strip():
+                    offsets.append(position)
+                position += len(line)
+        return offsets
+    
+    def _write_journal(self, journal_file, index_file, records):
+        """기록 목록으로 저널과 인덱스를 새로 써서 원자적으로 교체"""
+        from array import array
+        offsets = array('Q')
+        tmp_journal = f"{journal_file}.tmp"
+        with open(tmp_journal, 'wb') as f:
+            for record in records:
+                offsets.append(f.tell())
+                f.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n")
+        with open(f"{index_file}.tmp", 'wb') as f:
+            offsets.tofile(f)
+        os.replace(tmp_journal, journal_file)
+        os.replace(f"{index_file}.tmp", index_file)
+        return list(offsets)
+    
+    def _load_offsets(self, username):
+        """오프셋 인덱스를 메모리에 올림 (없거나 저널과 맞지 않으면 다시 만듦)"""
+        offsets = self._offsets.get(username)
+        if offsets is not None:
+            return offsets
+        
+        from array import array
+        journal_file, index_file, legacy_file = self._paths(username)
+        if not os.path.exists(journal_file):
+            # 저널은 기록을 처음 추가할 때 만듦 (조회만 해서는 빈 파일을 만들지 않음)
+            offsets = []
+            if os.path.exists(legacy_file):
+                with open(legacy_file, 'r', encoding='utf-8') as f:
+                    records = json.load(f)
+                os.makedirs(self.base_dir, exist_ok=True)
+                offsets = self._write_journal(journal_file, index_file, records)
+        else:
+            journal_size = os.path.getsize(journal_file)
+            try:
+                stored = array('Q')
+                with open(index_file, 'rb') as f:
+                    stored.frombytes(f.read())
+                offsets = list(stored)
+                if offsets and offsets[-1] >= journal_size:
+                    raise ValueError("인덱스가 저널보다 앞서 있음")
+                # 인덱스의 마지막 줄이 저널 끝에서 끝나지 않으면 (저널 추가 후 인덱스 추가 전에 중단)
+                # 인덱스에 빠진 뒷부분만 다시 읽어 채움
+                indexed_end = 0
+                if offsets:
+                    with open(journal_file, 'rb') as f:
+                        f.seek(offsets[-1])
+                        line = f.readline()
+                    if not line.endswith(b"\n"):
+                        raise ValueError("인덱스가 완전하지 않은 줄을 가리킴")
+                    indexed_end = offsets[-1] + len(line)
+                if indexed_end < journal_size:
+                    missing = self._scan_offsets(journal_file, indexed_end)
+                    offsets.extend(missing)
+                    with open(index_file, 'ab') as f:
+                        f.write(array('Q', missing).tobytes())
+            except (FileNotFoundError, ValueError):
+                offsets = self._scan_offsets(journal_file)
+                with open(index_file, 'wb') as f:
+                    array('Q', offsets).tofile(f)
+        
+        self._offsets[username] = offsets
+        return offsets
+    
+    def append(self, username, record):
+        from array import array
+        journal_file, index_file, _ = self._paths(username)
+        with self._lock(username):
+            offsets = self._load_offsets(username)
+            os.makedirs(self.base_dir, exist_ok=True)
+            with open(journal_file, 'ab') as f:
+                offset = f.tell()
+                f.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n")
+            with open(index_file, 'ab') as f:
+                f.write(array('Q', [offset]).tobytes())
+            offsets.append(offset)
+            self._pending_appends[username] = self._pending_appends.get(username, 0) + 1
+        self._ensure_compactor()
+        return True
+    
+    def count(self, username):
+        with self._lock(username):
+            return len(self._load_offsets(username))
+    
+    def read(self, username, limit=None, offset=0):
+        """기록을 시간순으로 반환
+        - limit: 최근 limit개만 (None이면 전체)
+        - offset: 최근 기록에서 건너뛸 개수
+        """
+        journal_file = self._paths(username)[0]
+        with self._lock(username):
+            offsets = self._load_offsets(username)
+            end = max(len(offsets) - offset, 0)
+            start = 0 if limit is None else max(end - limit, 0)
+            if start >= end:
+                return []
+            records = []
+            with open(journal_file, 'rb') as f:
+                # 기록마다 인덱스의 오프셋으로 이동해서 읽음 (깨진 줄이 있어도 다음 기록이 어긋나지 않음)
+                for position in offsets[start:end]:
+                    f.seek(position)
+                    try:
+                        records.append(json.loads(f.readline()))
+                    except ValueError:
+                        continue
+            return records
+    
+    def compact(self, username):
+        """깨진 줄을 버리고 보존 개수를 넘는 오래된 기록을 정리"""
+        journal_file, index_file, _ = self._paths(username)
+        with self._lock(username):
+            records = self.read(username)
+            if self.max_records and len(records) > self.max_records:
+                records = records[-self.max_records:]
+            self._offsets[username] = self._write_journal(journal_file, index_file, records)
+            self._pending_appends[username] = 0
+    
+    def _ensure_compactor(self):
+        if self._compactor is not None or HISTORY_COMPACT_INTERVAL_SECONDS <= 0:
+            return
+        with self._locks_guard:
+            if self._compactor is None:
+                self._compactor = threading.Thread(target=self._compact_loop, name="history-compactor", daemon=True)
+                self._compactor.start()
+    
+    def _compact_loop(self):
+        while True:
+            time.sleep(HISTORY_COMPACT_INTERVAL_SECONDS)
+            for username, pending in list(self._pending_appends.items()):
+                if pending >= HISTORY_COMPACT_MIN_APPENDS:
+                    try:
+                        self.compact(username)
+                    except Exception as e:
+                        print(f"학습 이력 압축 오류 ({username}): {e}")
+
+study_history_journal = StudyHistoryJournal()
+
 def save_user_study_history(username, question, answer, topic="일반"):
     """사용자별 학습 이력 저장"""
     try:
-        os.makedirs("users", exist_ok=True)
-        history_file = f"users/{username}_history.json"
-        
-        # 기존 이력 로드
-        try:
-            with open(history_file, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-        except FileNotFoundError:
-            history = []
-        
-        # 새 기록 추가
         new_record = {
             "timestamp": datetime.datetime.now().isoformat(),
             "question": question,
             "answer": answer[:300] + "..." if len(answer) > 300 else answer,
             "topic": topic
         }
-        
-        history.append(new_record)
-        
-        # 최근 100개만 유지
-        if len(history) > 100:
-            history = history[-100:]
-        
-        # 저장
-        with open(history_file, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-        
-        return True
+        return study_history_journal.append(username, new_record)
     except Exception as e:
         print(f"사용자 이력 저장 오류: {e}")
         return False
@@ -3145,34 +4005,658 @@ def generate_simple_answer(text, question):
     except Exception as e:
         return f"기본 답변 생성 실패: {str(e)}"
 
-def summarize_text(text, max_length=500):
-    """텍스트 요약 기능"""
+# 📦 맵-리듀스 요약 (섹션별 병렬 요약 → 통합 요약)
+SUMMARY_SECTION_TOKENS = 2500
+SUMMARY_SECTION_MAX_TOKENS = 500
+SUMMARY_MAX_WORKERS = 4
+SUMMARY_CACHE_DIR = os.path.join("cache", "summaries")
+
+_section_summary_cache = {}
+_section_summary_lock = threading.Lock()
+
+def split_text_by_token_budget(text, max_tokens=SUMMARY_SECTION_TOKENS):
+    """텍스트를 줄 단위로 묶어 토큰 예산(모델 토크나이저 기준) 이하의 섹션들로 나눕니다."""
+    sections = []
+    current_lines = []
+    current_tokens = 0
+    
+    for line in text.splitlines():
+        line_tokens = count_tokens(line)
+        
+        # 한 줄이 예산보다 길면 예산 안에 들어오는 앞부분씩 잘라서 처리
+        pieces = [line]
+        if line_tokens > max_tokens:
+            pieces = []
+            rest = line
+            while rest:
+                piece = truncate_to_tokens(rest, max_tokens) or rest[:1]
+                pieces.append(piece)
+                rest = rest[len(piece):]
+        
+        for piece in pieces:
+            piece_tokens = count_tokens(piece)
+            if current_lines and current_tokens + piece_tokens > max_tokens:
+                sections.append("\n".join(current_lines))
+                current_lines = []
+                current_tokens = 0
+            current_lines.append(piece)
+            current_tokens += piece_tokens
+    
+    if current_lines:
+        sections.append("\n".join(current_lines))
+    
+    return [section for section in sections if section.strip()]
+
+def _summarize_section(section):
+    """섹션 하나를 요약합니다. 같은 섹션은 해시 기반 캐시에서 바로 반환합니다."""
+    section_hash = hashlib.sha256(f"gpt-4o-mini|v1|{section}".encode('utf-8')).hexdigest()
+    with _section_summary_lock:
+        if section_hash in _section_summary_cache:
+            return _section_summary_cache[section_hash]
+    
+    cache_file = os.path.join(SUMMARY_CACHE_DIR, f"{section_hash}.json")
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            partial = json.load(f)["summary"]
+        if partial:
+            with _section_summary_lock:
+                _section_summary_cache[section_hash] = partial
+            return partial
+    except (FileNotFoundError, KeyError, ValueError):
+        pass
+    
+    prompt = f"""
+    다음은 학습 교재의 일부입니다. 이 부분의 핵심 개념, 정의, 공식, 중요한 수치를 빠짐없이 간결한 항목으로 정리해주세요.
+    
+    텍스트:
+    {section}
+    """
+    partial = create_chat_completion(
+        "summary_section",
+        model="gpt-4o-mini",
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=SUMMARY_SECTION_MAX_TOKENS,
+        temperature=0.3
+    )
+    # 실패한(빈) 요약은 캐시하지 않고 다음 요청에서 다시 시도
+    if not partial or not partial.strip():
+        return None
+    
+    with _section_summary_lock:
+        _section_summary_cache[section_hash] = partial
+    try:
+        os.makedirs(SUMMARY_CACHE_DIR, exist_ok=True)
+        tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({"summary": partial}, f, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        print(f"섹션 요약 캐시 저장 오류: {e}")
+    return partial
+
+def _summarize_sections_parallel(sections):
+    """섹션들을 제한된 워커 풀에서 동시에 요약합니다. 실패한 섹션은 건너뜁니다."""
+    from concurrent.futures import ThreadPoolExecutor
+    
+    def safe_summarize(section):
+        try:
+            return _summarize_section(section)
+        except Exception as e:
+            print(f"섹션 요약 오류: {e}")
+            return None
+    
+    with ThreadPoolExecutor(max_workers=min(SUMMARY_MAX_WORKERS, len(sections))) as executor:
+        # 요청자의 플랜(우선순위)이 워커 스레드에도 전달되도록 컨텍스트 복사
+        futures = [executor.submit(contextvars.copy_context().run, safe_summarize, section) for section in sections]
+        partials = [future.result() for future in futures]
+    
+    partials = [partial for partial in partials if partial]
+    if not partials:
+        raise RuntimeError("모든 섹션 요약에 실패했습니다.")
+    return partials
+
+def _group_partial_summaries(partials, max_tokens):
+    """부분 요약을 예산 단위로 묶습니다. 묶음마다 최소 두 개씩 넣어 단계마다 개수가 줄어들게 함"""
+    groups = []
+    current = []
+    current_tokens = 0
+    for partial in partials:
+        partial_tokens = count_tokens(partial)
+        if len(current) >= 2 and current_tokens + partial_tokens > max_tokens:
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(partial)
+        current_tokens += partial_tokens
+    if current:
+        groups.append(current)
+    return ["\n\n".join(group) for group in groups]
+
+def map_reduce_summaries(text, section_tokens=SUMMARY_SECTION_TOKENS):
+    """문서 전체를 섹션별로 요약한 뒤, 예산 안에 들어올 때까지 계층적으로 합칩니다."""
+    partials = _summarize_sections_parallel(split_text_by_token_budget(text, section_tokens))
+    combined = "\n\n".join(partials)
+    
+    # 부분 요약을 합친 내용이 예산을 넘으면 들어올 때까지 한 단계씩 묶어서 다시 요약
+    # (묶음마다 두 개 이상씩 합치므로 단계마다 개수가 줄고, 하나만 남으면 요약 응답 한도
+    #  SUMMARY_SECTION_MAX_TOKENS 안으로 줄어듦)
+    while count_tokens(combined) > section_tokens:
+        partials = _summarize_sections_parallel(_group_partial_summaries(partials, section_tokens))
+        combined = "\n\n".join(partials)
+    return combined
+
+def summarize_text(text, max_length=500, mode="map_reduce", stream=False):
+    """텍스트 요약 기능
+    - mode: map_reduce (문서 전체를 섹션별로 요약 후 통합), prefix (앞부분만 요약)
+    - stream: True이면 최종 요약을 조각 단위로 내보내는 이터레이터 반환
+    """
     try:
-        client = openai.OpenAI()
+        if mode == "map_reduce" and count_tokens(text) > SUMMARY_SECTION_TOKENS:
+            source_text = map_reduce_summaries(text)
+        else:
+            source_text = fit_prompt_context(text, max_tokens=800)
         
         prompt = f"""
         다음 텍스트를 {max_length}자 이내로 요약해주세요. 
         주요 개념과 핵심 내용을 포함하여 학습에 도움이 되도록 요약해주세요.
         
         텍스트:
-        {text[:3000]}  # 너무 긴 텍스트는 잘라서 처리
+        {source_text}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "summary",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=800,
-            temperature=0.3
+            temperature=0.3,
+            stream=stream
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"요약 생성 중 오류가 발생했습니다: {str(e)}"
 
-def generate_quiz(text, num_questions=5):
-    """퀴즈 생성 기능"""
+# 📦 문서별 문제 은행 (백그라운드에서 섹션 × 난이도별 문제를 미리 만들어 두고 퀴즈는 바로 출제)
+QUESTION_BANK_DIR = os.path.join("cache", "question_bank")
+# v2: 난이도별 생성, 문제가 만들어진 섹션만 완료로 표시 (v1 은행은 실패한 섹션도 완료로 남아 있을 수 있음)
+QUESTION_BANK_VERSION = "v2"
+QUESTION_BANK_SECTION_TOKENS = 2500
+# 섹션 하나, 난이도 하나를 생성하는 호출의 최대 응답 토큰 (JSON이 잘리지 않도록 난이도별로 나눠 요청)
+QUESTION_BANK_SECTION_MAX_TOKENS = 1500
+QUESTION_BANK_DIFFICULTIES = ("easy", "medium", "hard")
+QUESTION_BANK_DIFFICULTY_GUIDE = {"easy": "기본 개념과 정의", "medium": "응용과 이해", "hard": "분석과 종합"}
+# 섹션 하나, 난이도 하나당 만들 문제 수
+QUESTION_BANK_MC_PER_LEVEL = 2
+QUESTION_BANK_SHORT_PER_LEVEL = 1
+QUESTION_BANK_WORKERS = int(os.getenv("QUESTION_BANK_WORKERS", "2"))
+# 아직 출제되지 않은 문제가 요청 수의 이 배수보다 적으면 보충 생성
+QUESTION_BANK_LOW_WATERMARK = 3
+QUESTION_BANK_TOPUP_SECTIONS = 3
+QUESTION_BANK_DUPLICATE_SIMILARITY = 0.8
+QUESTION_BANK_MEMORY_DOCS = 16
+# 생성이 실패한 문서는 이 시간 동안 다시 시도하지 않음
+QUESTION_BANK_RETRY_SECONDS = 300
+
+def _split_question_bank_sections(text, max_tokens=QUESTION_BANK_SECTION_TOKENS):
+    """검색용 청크를 이어 붙여 문제 생성 단위 섹션으로 나눕니다. (페이지 범위, 제목 포함)"""
+    chunks, metadatas = chunk_text(text, overlap_tokens=0)
+    sections = []
+    current = []
+    current_tokens = 0
+    
+    def emit():
+        titles = [meta["section"] for _, meta in current if meta.get("section")]
+        sections.append({
+            "text": "\n\n".join(chunk for chunk, _ in current),
+            "page_start": current[0][1].get("page_start"),
+            "page_end": current[-1][1].get("page_end"),
+            "title": titles[0] if titles else None,
+            "tokens": current_tokens
+        })
+    
+    for chunk, meta in zip(chunks, metadatas):
+        if current and current_tokens + meta["tokens"] > max_tokens:
+            emit()
+            current = []
+            current_tokens = 0
+        current.append((chunk, meta))
+        current_tokens += meta["tokens"]
+    if current:
+        emit()
+    return sections
+
+def _parse_question_bank_response(content):
+    """LLM이 만든 JSON 문제 목록을 검증해서 반환합니다. 형식이 맞지 않는 문제는 버림"""
+    start, end = content.find("{"), content.rfind("}")
+    if start < 0 or end <= start:
+        return []
+    try:
+        items = json.loads(content[start:end + 1]).get("questions", [])
+    except (ValueError, AttributeError):
+        return []
+    
+    questions = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        question_type = item.get("type")
+        difficulty = item.get("difficulty")
+        question = str(item.get("question") or "").strip()
+        if difficulty not in QUESTION_BANK_DIFFICULTIES or not question:
+            continue
+        parsed = {
+            "type": question_type,
+            "difficulty": difficulty,
+            "question": question,
+            "explanation": str(item.get("explanation") or "").strip(),
+            "intent": str(item.get("intent") or "").strip(),
+            "concept": str(item.get("concept") or "").strip()
+        }
+        if question_type == "multiple_choice":
+            options = [str(option).strip() for option in item.get("options") or []]
+            try:
+                answer = int(item.get("answer"))
+            except (TypeError, ValueError):
+                continue
+            if len(options) != 4 or not all(options) or not 1 <= answer <= 4:
+                continue
+            parsed.update(options=options, answer=answer)
+        elif question_type == "short_answer":
+            answer = str(item.get("answer") or "").strip()
+            if not answer:
+                continue
+            parsed["answer"] = answer
+        else:
+            continue
+        questions.append(parsed)
+    return questions
+
+def _normalize_question(question):
+    return re.sub(r"[\W_]+", "", question.lower())
+
+class QuestionBank:
+    """문서별 문제 은행
+    - 문서를 섹션으로 나눠 섹션마다 난이도별 객관식/단답형 문제를 백그라운드로 생성
+    - 같은 문제(정규화한 문장이 같거나 어휘가 거의 같은 문제)는 한 번만 저장
+    - cache/question_bank/{문서 해시}.json에 저장하므로 재시작 후에도 이어서 생성/사용
+      (출제 횟수는 {문서 해시}.served.json에 따로 저장해서 출제할 때 은행 전체를 다시 쓰지 않음)
+    - 생성 호출은 생성을 시작한 사용자의 api_calls 한도에서 차감
+    - 출제할 때는 덜 출제된 문제부터, 섹션을 돌아가며 골라 문서 전체를 고르게 다룸
+    - 아직 출제되지 않은 문제가 부족해지면 문제가 적은 섹션부터 보충 생성
+    """
+    
+    def __init__(self, directory=QUESTION_BANK_DIR, workers=QUESTION_BANK_WORKERS):
+        self.directory = directory
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._banks = OrderedDict()  # 문서 해시 → 문제 은행 (최근 사용 순)
+        self._building = set()
+        self._failed_at = {}
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _version():
+        return f"{QUESTION_BANK_VERSION}|{CHUNKER_VERSION}|{QUESTION_BANK_SECTION_TOKENS}"
+    
+    def _path(self, document_hash):
+        return os.path.join(self.directory, f"{document_hash}.json")
+    
+    def _served_path(self, document_hash):
+        return os.path.join(self.directory, f"{document_hash}.served.json")
+    
+    def _get_bank(self, document_hash):
+        """메모리 → 디스크 순으로 문제 은행을 찾습니다. (잠금을 잡은 상태에서 호출)"""
+        bank = self._banks.get(document_hash)
+        if bank is None:
+            try:
+                with open(self._path(document_hash), 'r', encoding='utf-8') as f:
+                    bank = json.load(f)
+                if bank.get("version") != self._version():
+                    bank = None
+            except (FileNotFoundError, ValueError):
+                bank = None
+            if bank is None:
+                return None
+            # 출제 횟수는 별도 파일에 저장 (출제할 때마다 은행 전체를 다시 쓰지 않도록)
+            try:
+                with open(self._served_path(document_hash), 'r', encoding='utf-8') as f:
+                    served = json.load(f)
+            except (FileNotFoundError, ValueError):
+                served = {}
+            for question in bank["questions"]:
+                question["served"] = served.get(question["id"], 0)
+            self._banks[document_hash] = bank
+        self._banks.move_to_end(document_hash)
+        while len(self._banks) > QUESTION_BANK_MEMORY_DOCS:
+            self._banks.popitem(last=False)
+        return bank
+    
+    def _write(self, path, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_file = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_file, path)
+        except Exception as e:
+            print(f"문제 은행 저장 오류: {e}")
+    
+    def _save(self, document_hash):
+        """문제가 추가됐을 때 은행을 저장 (출제 횟수는 _save_served로 따로 저장)"""
+        with self._lock:
+            bank = self._banks.get(document_hash)
+            if bank is None:
+                return
+            questions = [{key: value for key, value in q.items() if key != "served"} for q in bank["questions"]]
+            data = json.dumps({**bank, "questions": questions}, ensure_ascii=False)
+        self._write(self._path(document_hash), data)
+    
+    def _save_served(self, document_hash):
+        with self._lock:
+            bank = self._banks.get(document_hash)
+            if bank is None:
+                return
+            data = json.dumps({q["id"]: q["served"] for q in bank["questions"] if q["served"]})
+        self._write(self._served_path(document_hash), data)
+    
+    @staticmethod
+    def document_hash(text):
+        return SemanticAnswerCache.document_hash(text)
+    
+    def ensure_built(self, text):
+        """문제 은행이 없거나 덜 만들어졌으면 백그라운드 생성을 시작하고 현재 상태를 반환합니다."""
+        document_hash = self.document_hash(text)
+        if is_pdf_text_error(text):
+            # 텍스트 추출에 실패한 문서(오류 메시지)로는 문제를 만들지 않음
+            return self.status(document_hash)
+        with self._lock:
+            bank = self._get_bank(document_hash)
+            complete = bank is not None and len(bank["sections_done"]) >= bank["sections_total"]
+        if not complete:
+            self._schedule(document_hash, text)
+        return self.status(document_hash)
+    
+    def _schedule(self, document_hash, text, topup=None):
+        with self._lock:
+            if document_hash in self._building:
+                return False
+            if topup is None and time.time() - self._failed_at.get(document_hash, 0) < QUESTION_BANK_RETRY_SECONDS:
+                return False
+            self._building.add(document_hash)
+        # 요청한 사용자의 플랜(우선순위)과 한도 차감 대상이 백그라운드 스레드에도 전달되도록 컨텍스트 복사
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._build, document_hash, text, topup), daemon=True).start()
+        return True
+    
+    def _build(self, document_hash, text, topup=None):
+        """섹션별 문제를 만들어 은행에 합칩니다. topup이 있으면 해당 (섹션, 유형)만 한 회차 더 생성"""
+        from concurrent.futures import ThreadPoolExecutor
+        
+        try:
+            sections = _split_question_bank_sections(text)
+            with self._lock:
+                bank = self._get_bank(document_hash)
+                if bank is None:
+                    bank = {
+                        "version": self._version(),
+                        "document_hash": document_hash,
+                        "sections_total": len(sections),
+                        "sections_done": [],
+                        "levels_done": {},
+                        "rounds": {},
+                        "questions": []
+                    }
+                    self._banks[document_hash] = bank
+                levels_done = bank.setdefault("levels_done", {})
+                if topup is None:
+                    # 이전에 일부 난이도만 만들어진 섹션은 남은 난이도만 생성
+                    todo = [
+                        (index, difficulty)
+                        for index in range(len(sections)) if index not in bank["sections_done"]
+                        for difficulty in QUESTION_BANK_DIFFICULTIES
+                        if difficulty not in levels_done.get(str(index), [])
+                    ]
+                else:
+                    todo = [
+                        (index, difficulty)
+                        for index in topup if index < len(sections)
+                        for difficulty in QUESTION_BANK_DIFFICULTIES
+                    ]
+            
+            username = get_request_user()
+            
+            def generate(item):
+                index, difficulty = item
+                # 생성 호출마다 요청한 사용자의 api_calls 한도에서 차감 (한도를 넘으면 나중에 다시 시도)
+                if username and not quota_service.try_consume(username, "api_calls")[0]:
+                    return index, difficulty, None
+                try:
+                    questions = self._generate_section(document_hash, sections[index], index, difficulty)
+                except Exception as e:
+                    print(f"문제 은행 섹션 생성 오류 ({index}/{difficulty}): {e}")
+                    questions = None
+                if not questions and username:
+                    quota_service.refund(username, "api_calls")
+                return index, difficulty, questions
+            
+            failed = False
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(todo) or 1))) as executor:
+                tasks = [executor.submit(contextvars.copy_context().run, generate, item) for item in todo]
+                for index, difficulty, questions in (task.result() for task in tasks):
+                    # 응답이 잘렸거나 형식이 맞지 않아 문제가 없으면 완료로 보지 않고 나중에 다시 시도
+                    if not questions:
+                        failed = True
+                        continue
+                    self._merge(document_hash, index, difficulty, questions)
+                    self._save(document_hash)
+            if failed:
+                with self._lock:
+                    self._failed_at[document_hash] = time.time()
+        except Exception as e:
+            print(f"문제 은행 생성 오류: {e}")
+            with self._lock:
+                self._failed_at[document_hash] = time.time()
+        finally:
+            with self._lock:
+                self._building.discard(document_hash)
+    
+    def _generate_section(self, document_hash, section, index, difficulty):
+        with self._lock:
+            bank = self._get_bank(document_hash)
+            first_round = bank is None or index not in bank["sections_done"]
+            existing = [
+                q["question"] for q in (bank["questions"] if bank else [])
+                if q["section"] == index and q["difficulty"] == difficulty
+            ]
+        
+        avoid = ""
+        if existing:
+            avoid = "이미 있는 다음 문제들과 겹치지 않는 새로운 문제로 만들어주세요:\n" + "\n".join(f"- {q}" for q in existing[-30:])
+        
+        prompt = f"""
+        다음 교재 내용으로 난이도 {difficulty}({QUESTION_BANK_DIFFICULTY_GUIDE[difficulty]}) 학습용 문제를 만들어주세요.
+        객관식(multiple_choice) {QUESTION_BANK_MC_PER_LEVEL}개, 단답형(short_answer) {QUESTION_BANK_SHORT_PER_LEVEL}개를 만듭니다.
+        객관식은 선택지 4개와 정답 번호(1~4), 단답형은 짧은 단어나 구문 정답을 씁니다.
+        {avoid}
+        
+        다른 설명 없이 아래 JSON 형식으로만 답해주세요:
+        {{"questions": [{{"type": "multiple_choice", "difficulty": "{difficulty}", "question": "...", "options": ["...", "...", "...", "..."], "answer": 1, "explanation": "...", "intent": "출제 의도", "concept": "관련 개념"}},
+                        {{"type": "short_answer", "difficulty": "{difficulty}", "question": "...", "answer": "...", "explanation": "...", "intent": "...", "concept": "..."}}]}}
+        
+        교재 내용:
+        {section['text']}
+        """
+        
+        content = create_chat_completion(
+            "question_bank",
+            model="gpt-4o-mini",
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=QUESTION_BANK_SECTION_MAX_TOKENS,
+            # 보충 회차는 조금 더 다양하게
+            temperature=0.4 if first_round else 0.7,
+            response_format={"type": "json_object"}
+        )
+        
+        questions = [q for q in _parse_question_bank_response(content or "") if q["difficulty"] == difficulty]
+        for question in questions:
+            question.update(
+                section=index,
+                section_title=section["title"],
+                page_start=section["page_start"],
+                page_end=section["page_end"],
+                served=0
+            )
+        return questions
+    
+    def _merge(self, document_hash, index, difficulty, questions):
+        """중복을 걸러 은행에 추가합니다. 섹션의 모든 난이도가 만들어지면 섹션을 완료로 표시"""
+        with self._lock:
+            bank = self._get_bank(document_hash)
+            if bank is None:
+                return 0
+            seen = {_normalize_question(q["question"]) for q in bank["questions"]}
+            token_sets = [(q["type"], set(tokenize_korean(q["question"]))) for q in bank["questions"]]
+            
+            added = 0
+            for question in questions:
+                key = _normalize_question(question["question"])
+                tokens = set(tokenize_korean(question["question"]))
+                if key in seen or any(
+                    question_type == question["type"] and tokens and
+                    len(tokens & other) / len(tokens | other) >= QUESTION_BANK_DUPLICATE_SIMILARITY
+                    for question_type, other in token_sets
+                ):
+                    continue
+                question["id"] = hashlib.sha256(key.encode('utf-8')).hexdigest()[:12]
+                bank["questions"].append(question)
+                seen.add(key)
+                token_sets.append((question["type"], tokens))
+                added += 1
+            
+            levels = bank.setdefault("levels_done", {}).setdefault(str(index), [])
+            if difficulty not in levels:
+                levels.append(difficulty)
+            if index not in bank["sections_done"] and all(level in levels for level in QUESTION_BANK_DIFFICULTIES):
+                bank["sections_done"].append(index)
+            bank["rounds"][str(index)] = bank["rounds"].get(str(index), 0) + 1
+            return added
+    
+    def sample(self, text, question_type, count, difficulty=None):
+        """문제 은행에서 count개를 골라 반환합니다. 충분하지 않으면 빈 목록 (LLM 생성으로 대체)"""
+        try:
+            document_hash = self.document_hash(text)
+            self.ensure_built(text)
+            with self._lock:
+                bank = self._get_bank(document_hash)
+                pool = [
+                    q for q in (bank["questions"] if bank else [])
+                    if q["type"] == question_type and (difficulty is None or q["difficulty"] == difficulty)
+                ]
+                if len(pool) < count:
+                    self.misses += 1
+                    return []
+                self.hits += 1
+                
+                # 덜 출제된 문제부터, 같은 횟수 안에서는 섹션을 돌아가며 무작위로 선택
+                random.shuffle(pool)
+                picked = []
+                for served in sorted({q["served"] for q in pool}):
+                    by_section = {}
+                    for q in pool:
+                        if q["served"] == served:
+                            by_section.setdefault(q["section"], []).append(q)
+                    queues = list(by_section.values())
+                    random.shuffle(queues)
+                    while queues and len(picked) < count:
+                        for queue in list(queues):
+                            if len(picked) >= count:
+                                break
+                            picked.append(queue.pop())
+                            if not queue:
+                                queues.remove(queue)
+                    if len(picked) >= count:
+                        break
+                
+                for q in picked:
+                    q["served"] += 1
+                
+                # 아직 안 나온 문제가 적은 섹션부터 보충
+                unserved = {}
+                for q in pool:
+                    if q["served"] == 0:
+                        unserved[q["section"]] = unserved.get(q["section"], 0) + 1
+                topup = None
+                if sum(unserved.values()) < count * QUESTION_BANK_LOW_WATERMARK:
+                    sections = range(bank["sections_total"])
+                    topup = sorted(sections, key=lambda index: unserved.get(index, 0))[:QUESTION_BANK_TOPUP_SECTIONS]
+                picked = [dict(q) for q in sorted(picked, key=lambda q: (q["section"], q["difficulty"]))]
+            
+            self._save_served(document_hash)
+            if topup:
+                self._schedule(document_hash, text, topup)
+            return picked
+        except Exception as e:
+            print(f"문제 은행 조회 오류: {e}")
+            return []
+    
+    def status(self, document_hash):
+        with self._lock:
+            bank = self._get_bank(document_hash)
+            building = document_hash in self._building
+            if bank is None:
+                return {"document_hash": document_hash, "questions": 0, "sections_total": 0, "sections_done": 0, "building": building, "counts": {}}
+            counts = {}
+            for q in bank["questions"]:
+                key = f"{q['type']}/{q['difficulty']}"
+                counts[key] = counts.get(key, 0) + 1
+            return {
+                "document_hash": document_hash,
+                "questions": len(bank["questions"]),
+                "sections_total": bank["sections_total"],
+                "sections_done": len(bank["sections_done"]),
+                "building": building,
+                "counts": counts
+            }
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded_documents": len(self._banks),
+                "building": len(self._building),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+question_bank = QuestionBank()
+
+def format_bank_questions(questions, detailed=False):
+    """문제 은행 문제를 퀴즈 생성 결과와 같은 텍스트 형식으로 만듭니다."""
+    blocks = []
+    for number, q in enumerate(questions, 1):
+        lines = [f"Q{number}: {q['question']}"]
+        if q["type"] == "multiple_choice":
+            lines.extend(f"{i}) {option}" for i, option in enumerate(q["options"], 1))
+        lines.append(f"정답: {q['answer']}")
+        if q.get("explanation"):
+            lines.append(f"해설: {q['explanation']}")
+        if detailed:
+            if q.get("intent"):
+                lines.append(f"출제 의도: {q['intent']}")
+            if q.get("concept"):
+                lines.append(f"관련 개념: {q['concept']}")
+        if q.get("page_start"):
+            pages = q["page_start"] if q["page_start"] == q.get("page_end") else f"{q['page_start']}-{q['page_end']}"
+            lines.append(f"출처: p.{pages}" + (f" · {q['section_title']}" if q.get("section_title") else ""))
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
+
+def generate_quiz(text, num_questions=5, stream=False):
+    """퀴즈 생성 기능 (문제 은행에 충분한 문제가 있으면 바로 출제, 없으면 LLM으로 생성)"""
     try:
-        client = openai.OpenAI()
+        questions = question_bank.sample(text, "multiple_choice", num_questions)
+        if questions:
+            quiz = format_bank_questions(questions)
+            return iter([quiz]) if stream else quiz
         
         prompt = f"""
         다음 텍스트를 바탕으로 {num_questions}개의 객관식 퀴즈를 생성해주세요.
@@ -3188,24 +4672,27 @@ def generate_quiz(text, num_questions=5):
         해설: [간단한 설명]
         
         텍스트:
-        {text[:2000]}
+        {fit_prompt_context(text, max_tokens=1500)}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "quiz",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1500,
-            temperature=0.5
+            temperature=0.5,
+            stream=stream
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"퀴즈 생성 중 오류가 발생했습니다: {str(e)}"
 
-def generate_short_answer_quiz(text, num_questions=5):
-    """단답형 퀴즈 생성 기능"""
+def generate_short_answer_quiz(text, num_questions=5, stream=False):
+    """단답형 퀴즈 생성 기능 (문제 은행 우선, 부족하면 LLM으로 생성)"""
     try:
-        client = openai.OpenAI()
+        questions = question_bank.sample(text, "short_answer", num_questions)
+        if questions:
+            quiz = format_bank_questions(questions)
+            return iter([quiz]) if stream else quiz
         
         prompt = f"""
         다음 텍스트를 바탕으로 {num_questions}개의 단답형 퀴즈를 생성해주세요.
@@ -3217,21 +4704,21 @@ def generate_short_answer_quiz(text, num_questions=5):
         해설: [간단한 설명]
         
         텍스트:
-        {text[:2000]}
+        {fit_prompt_context(text, max_tokens=1200)}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "short_answer_quiz",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1200,
-            temperature=0.5
+            temperature=0.5,
+            stream=stream
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"단답형 퀴즈 생성 중 오류가 발생했습니다: {str(e)}"
 
-def generate_flashcards(text, num_cards=10):
+def generate_flashcards(text, num_cards=10, stream=False):
     """플래시카드 생성 기능"""
     try:
         # 텍스트 유효성 검사
@@ -3243,10 +4730,8 @@ def generate_flashcards(text, num_cards=10):
         if not api_key:
             return "OpenAI API 키가 설정되지 않았습니다."
         
-        client = openai.OpenAI(api_key=api_key)
-        
-        # 텍스트 길이 제한 (안전하게)
-        safe_text = text[:3000] if len(text) > 3000 else text
+        # 텍스트 길이 제한 (모델 한도와 응답 길이 기준)
+        safe_text = fit_prompt_context(text, max_tokens=2000)
         
         prompt = f"""
         다음 텍스트를 바탕으로 {num_cards}개의 학습 플래시카드를 생성해주세요.
@@ -3271,25 +4756,21 @@ def generate_flashcards(text, num_cards=10):
         {safe_text}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "flashcards",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=2000,
-            temperature=0.4
+            temperature=0.4,
+            stream=stream
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"플래시카드 생성 중 오류가 발생했습니다: {str(e)}"
 
-def load_user_study_history(username):
-    """사용자별 학습 이력 로드"""
+def load_user_study_history(username, limit=None):
+    """사용자별 학습 이력 로드 (limit을 주면 최근 limit개만)"""
     try:
-        history_file = f"users/{username}_history.json"
-        with open(history_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+        return study_history_journal.read(username, limit=limit)
     except Exception as e:
         print(f"사용자 이력 로드 오류: {e}")
         return []
@@ -3357,7 +4838,6 @@ def generate_learning_recommendations(username, history):
         # 최근 질문 분석
         recent_questions = [record['question'] for record in history[-5:]]
         
-        client = openai.OpenAI()
         prompt = f"""
         다음 최근 질문들을 분석하여 학습자에게 맞춤 추천을 해주세요:
         
@@ -3370,60 +4850,233 @@ def generate_learning_recommendations(username, history):
         3. 다음 단계 제안
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "recommendations",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=500,
             temperature=0.3
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"추천 생성 실패: {str(e)}"
 
 # 다중 벡터스토어 관리 클래스
+MULTI_SEARCH_MAX_WORKERS = int(os.getenv("MULTI_SEARCH_MAX_WORKERS", "8"))
+VECTOR_MANAGER_MAX_BYTES = int(os.getenv("VECTOR_MANAGER_MAX_MB", "512")) * 1024 * 1024
+VECTOR_MANAGER_TTL_SECONDS = float(os.getenv("VECTOR_MANAGER_TTL_SECONDS", "3600"))
+
+def estimate_vectorstore_bytes(vectorstore):
+    """벡터스토어가 차지하는 메모리를 대략 계산 (벡터 + 청크 텍스트)"""
+    index = vectorstore.index
+    total = index.ntotal * index.d * 4
+    for doc_id in vectorstore.index_to_docstore_id.values():
+        doc = vectorstore.docstore.search(doc_id)
+        if hasattr(doc, "page_content"):
+            total += len(doc.page_content.encode('utf-8'))
+    return total
+
 class MultiVectorStoreManager:
-    def __init__(self):
-        self.vectorstores = {}
-        self.document_mapping = {}
+    """벡터스토어 메모리 관리 (문서별 벡터스토어와 여러 문서를 합친 통합 벡터스토어 모두)
+    - 인덱스 키(문서 내용 + 청크 설정 + 임베딩 모델)별로 한 번만 메모리에 올림
+    - 메모리 사용량(max_bytes)을 넘거나 ttl_seconds 동안 쓰지 않으면 오래된 것부터 내림 (고정한 문서 제외)
+    - 내린 문서는 다음에 필요할 때 인덱스 저장소에서 다시 불러옴
+    """
+    
+    def __init__(self, shard_k=None, max_bytes=VECTOR_MANAGER_MAX_BYTES, ttl_seconds=VECTOR_MANAGER_TTL_SECONDS):
+        self.vectorstores = OrderedDict()  # 메모리에 올라온 벡터스토어 (키, 최근 사용 순)
+        self.document_mapping = {}  # 등록된 문서 이름 → 텍스트 길이
+        self.shard_k = shard_k  # 문서별로 가져올 후보 수 (None이면 k)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._documents = {}  # 등록된 문서 이름 → 인덱스 키
+        self._entries = {}  # 메모리에 올라온 키 → bytes, last_used
+        self._pinned = set()
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "reloads": 0, "evictions": 0}
+        self._search_pool = None
+        self._pool_lock = threading.Lock()
     
-    def add_document(self, doc_name, text):
+    def get_or_create(self, key, factory):
+        """key의 벡터스토어를 반환합니다. 메모리에 없으면 factory()로 만들거나 불러와서 올림"""
+        with self._lock:
+            if key in self.vectorstores:
+                self._stats["hits"] += 1
+                self._entries[key]["last_used"] = time.time()
+                self.vectorstores.move_to_end(key)
+                self._evict(keep=key)
+                return self.vectorstores[key]
+            self._stats["misses"] += 1
+        
+        vectorstore = factory()
+        if vectorstore is not None:
+            self._put(key, vectorstore)
+        return vectorstore
+    
+    def _put(self, key, vectorstore):
+        with self._lock:
+            self._entries[key] = {
+                "bytes": estimate_vectorstore_bytes(vectorstore),
+                "last_used": time.time()
+            }
+            self.vectorstores[key] = vectorstore
+            self.vectorstores.move_to_end(key)
+            # 방금 올린 벡터스토어는 내리지 않음
+            self._evict(keep=key)
+    
+    def add_document(self, doc_name, text, pinned=False):
         """개별 문서의 벡터스토어 생성"""
         try:
-            vectorstore = create_vectorstore(text)
-            if vectorstore:
-                self.vectorstores[doc_name] = vectorstore
+            index_key = get_index_key(text)
+            with self._lock:
+                if pinned:
+                    self._pinned.add(index_key)
+            vectorstore = self.get_or_create(index_key, lambda: create_vectorstore(text))
+            if vectorstore is None:
+                return False
+            with self._lock:
+                self._documents[doc_name] = index_key
                 self.document_mapping[doc_name] = len(text)
-                return True
-            return False
+            return True
         except Exception as e:
             print(f"문서 추가 오류: {e}")
             return False
     
-    def search_across_documents(self, query, k=5):
-        """모든 문서에서 검색"""
-        results = []
-        for doc_name, vectorstore in self.vectorstores.items():
+    def remove_document(self, doc_name):
+        """문서 등록 해제"""
+        with self._lock:
+            index_key = self._documents.pop(doc_name, None)
+            self.document_mapping.pop(doc_name, None)
+            if index_key is not None and index_key not in self._documents.values():
+                self._pinned.discard(index_key)
+                self.vectorstores.pop(index_key, None)
+                self._entries.pop(index_key, None)
+    
+    def pin(self, doc_name, pinned=True):
+        """자주 쓰는 문서를 메모리에 고정 (내리지 않음)"""
+        with self._lock:
+            index_key = self._documents.get(doc_name)
+            if index_key is None:
+                return False
+            if pinned:
+                self._pinned.add(index_key)
+            else:
+                self._pinned.discard(index_key)
+            return True
+    
+    def get_vectorstore(self, doc_name):
+        """문서 벡터스토어 반환 (메모리에 없으면 인덱스 저장소에서 다시 불러옴)"""
+        with self._lock:
+            index_key = self._documents.get(doc_name)
+        if index_key is None:
+            return None
+        
+        def reload():
+            vectorstore = load_index_from_store(index_key, get_embedding_model())
+            if vectorstore is None:
+                print(f"문서 인덱스를 다시 불러오지 못했습니다: {doc_name}")
+            else:
+                with self._lock:
+                    self._stats["reloads"] += 1
+            return vectorstore
+        
+        return self.get_or_create(index_key, reload)
+    
+    def _memory_bytes(self):
+        return sum(entry["bytes"] for entry in self._entries.values())
+    
+    def _drop(self, key):
+        del self.vectorstores[key]
+        del self._entries[key]
+        self._stats["evictions"] += 1
+    
+    def _evict(self, keep=None):
+        """TTL이 지난 것과 메모리 한도를 넘는 오래된 것을 내림 (잠금 안에서 호출)"""
+        now = time.time()
+        for key in list(self.vectorstores):
+            if key != keep and key not in self._pinned and now - self._entries[key]["last_used"] > self.ttl_seconds:
+                self._drop(key)
+        
+        memory = self._memory_bytes()
+        for key in list(self.vectorstores):
+            if memory <= self.max_bytes:
+                break
+            if key == keep or key in self._pinned:
+                continue
+            memory -= self._entries[key]["bytes"]
+            self._drop(key)
+    
+    def _get_search_pool(self):
+        with self._pool_lock:
+            if self._search_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._search_pool = ThreadPoolExecutor(max_workers=MULTI_SEARCH_MAX_WORKERS, thread_name_prefix="shard-search")
+            return self._search_pool
+    
+    def _search_shard(self, doc_name, vectorstore, query_embedding, shard_k):
+        """문서 하나에서 (거리, 순번, 결과) 후보를 가져옴"""
+        docs_and_scores = vectorstore.similarity_search_with_score_by_vector(query_embedding, k=shard_k)
+        return [
+            (float(distance), rank, {
+                "content": doc.page_content,
+                "source": doc_name,
+                "metadata": doc.metadata,
+                "distance": float(distance),
+                "score": 1.0 / (1.0 + float(distance))  # 거리가 가까울수록 1에 가까움
+            })
+            for rank, (doc, distance) in enumerate(docs_and_scores)
+        ]
+    
+    def search_across_documents(self, query, k=5, shard_k=None):
+        """모든 문서에서 병렬로 검색하고 실제 유사도 순으로 상위 k개를 합침
+        - shard_k: 문서별 후보 수 (기본값 k, 작게 주면 더 빠르지만 전체 상위 k를 놓칠 수 있음)
+        """
+        with self._lock:
+            doc_names = list(self.document_mapping)
+        shards = [(doc_name, self.get_vectorstore(doc_name)) for doc_name in doc_names]
+        shards = [(doc_name, vectorstore) for doc_name, vectorstore in shards if vectorstore is not None]
+        if not shards:
+            return []
+        
+        import heapq
+        shard_k = shard_k or self.shard_k or k
+        
+        # 질문 임베딩은 한 번만 계산 (모든 문서가 같은 임베딩 모델 사용)
+        query_embedding = shards[0][1].embedding_function.embed_query(query)
+        
+        pool = self._get_search_pool()
+        futures = {
+            pool.submit(self._search_shard, doc_name, vectorstore, query_embedding, shard_k): doc_name
+            for doc_name, vectorstore in shards
+        }
+        
+        candidates = []
+        for future, doc_name in futures.items():
             try:
-                docs = vectorstore.similarity_search(query, k=k//len(self.vectorstores) + 1)
-                for doc in docs:
-                    results.append({
-                        "content": doc.page_content,
-                        "source": doc_name,
-                        "score": 0  # 실제 구현에서는 유사도 점수 계산
-                    })
+                candidates.append(future.result())
             except Exception as e:
                 print(f"검색 오류 ({doc_name}): {e}")
         
-        return results[:k]
+        # 문서별 결과는 이미 거리순이므로 힙으로 병합
+        merged = heapq.merge(*candidates, key=lambda item: (item[0], item[1]))
+        return [result for _, _, result in itertools.islice(merged, k)]
     
     def get_document_stats(self):
         """문서 통계 반환"""
-        return {
-            "total_documents": len(self.vectorstores),
-            "document_sizes": self.document_mapping,
-            "total_size": sum(self.document_mapping.values())
-        }
+        with self._lock:
+            return {
+                "total_documents": len(self.document_mapping),
+                "document_sizes": dict(self.document_mapping),
+                "total_size": sum(self.document_mapping.values()),
+                "loaded_stores": len(self.vectorstores),
+                "loaded_documents": [name for name, key in self._documents.items() if key in self.vectorstores],
+                "pinned_documents": [name for name, key in self._documents.items() if key in self._pinned],
+                "memory_bytes": self._memory_bytes(),
+                "max_bytes": self.max_bytes,
+                **self._stats
+            }
+
+# 전역 벡터스토어 매니저
+vector_manager = MultiVectorStoreManager()
 
 def create_cross_document_qa_chain(vectorstore):
     """다중 문서 질의응답 체인 생성"""
@@ -3438,15 +5091,8 @@ def create_cross_document_qa_chain(vectorstore):
             print("OpenAI API 키가 설정되지 않았습니다.")
             return None
             
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 5})  # 더 많은 문서에서 검색
-        
-        # 최신 모델 사용
-        try:
-            from langchain_openai import ChatOpenAI
-        except ImportError:
-            from langchain.chat_models import ChatOpenAI
-        
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0, api_key=api_key)
+        retriever = get_hybrid_retriever(vectorstore, k=5)  # 더 많은 문서에서 검색
+        llm = ScheduledChatModel(feature="cross_document_qa", model_name="gpt-4o-mini", temperature=0)
         
         # 커스텀 프롬프트로 출처 정보 포함
         from langchain.chains import RetrievalQA
@@ -3481,11 +5127,9 @@ def create_cross_document_qa_chain(vectorstore):
         return None
 
 # 추가 기능들
-def analyze_chapters(text):
+def analyze_chapters(text, stream=False):
     """챕터별 분석 및 요약"""
     try:
-        client = openai.OpenAI()
-        
         prompt = f"""
         다음 텍스트를 분석하여 챕터나 주제별로 나누고, 각 부분의 핵심 내용을 요약해주세요.
         
@@ -3496,25 +5140,23 @@ def analyze_chapters(text):
         - 학습 포인트: [학습해야 할 점]
         
         텍스트:
-        {text[:4000]}
+        {fit_prompt_context(text, max_tokens=2000)}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "chapters",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=2000,
-            temperature=0.3
+            temperature=0.3,
+            stream=stream
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"챕터 분석 중 오류가 발생했습니다: {str(e)}"
 
-def generate_study_notes(text, style="bullet"):
+def generate_study_notes(text, style="bullet", stream=False):
     """학습 노트 자동 생성"""
     try:
-        client = openai.OpenAI()
-        
         if style == "bullet":
             format_instruction = "불릿 포인트 형식으로 정리"
         elif style == "outline":
@@ -3527,25 +5169,23 @@ def generate_study_notes(text, style="bullet"):
         학생이 복습하기 쉽도록 핵심 개념, 정의, 예시를 포함해주세요.
         
         텍스트:
-        {text[:3000]}
+        {fit_prompt_context(text, max_tokens=1500)}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "study_notes",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=1500,
-            temperature=0.3
+            temperature=0.3,
+            stream=stream
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"학습 노트 생성 중 오류가 발생했습니다: {str(e)}"
 
-def generate_cornell_notes_advanced(text, style="standard", include_questions=True):
+def generate_cornell_notes_advanced(text, style="standard", include_questions=True, stream=False):
     """코넬 노트 필기법에 따른 고급 노트 생성"""
     try:
-        client = openai.OpenAI()
-        
         # 스타일별 프롬프트 설정
         style_instructions = {
             "standard": "균형잡힌 구성으로 핵심 내용과 세부사항을 적절히 포함",
@@ -3618,17 +5258,17 @@ def generate_cornell_notes_advanced(text, style="standard", include_questions=Tr
         ---
         
         텍스트:
-        {text[:4000]}
+        {fit_prompt_context(text, max_tokens=2500)}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "cornell_notes_advanced",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=2500,
-            temperature=0.2
+            temperature=0.2,
+            stream=stream
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"코넬 노트 생성 중 오류가 발생했습니다: {str(e)}"
 
@@ -3766,10 +5406,13 @@ def text_to_speech(text, lang='ko'):
         return None
 
 # 누락된 함수들 추가
-def generate_premium_quiz(text, difficulty="medium", num_questions=10):
-    """프리미엄 퀴즈 생성"""
+def generate_premium_quiz(text, difficulty="medium", num_questions=10, stream=False):
+    """프리미엄 퀴즈 생성 (선택한 난이도의 문제 은행 문제 우선, 부족하면 LLM으로 생성)"""
     try:
-        client = openai.OpenAI()
+        questions = question_bank.sample(text, "multiple_choice", num_questions, difficulty=difficulty)
+        if questions:
+            quiz = format_bank_questions(questions, detailed=True)
+            return iter([quiz]) if stream else quiz
         
         prompt = f"""
         다음 텍스트를 바탕으로 {difficulty} 난이도의 프리미엄 퀴즈 {num_questions}개를 생성해주세요.
@@ -3786,17 +5429,17 @@ def generate_premium_quiz(text, difficulty="medium", num_questions=10):
         4. 관련 개념
         
         텍스트:
-        {text[:3000]}
+        {fit_prompt_context(text, max_tokens=2000)}
         """
         
-        response = client.chat.completions.create(
+        return create_chat_completion(
+            "premium_quiz",
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             max_tokens=2000,
-            temperature=0.4
+            temperature=0.4,
+            stream=stream
         )
-        
-        return response.choices[0].message.content
     except Exception as e:
         return f"프리미엄 퀴즈 생성 실패: {str(e)}"
 